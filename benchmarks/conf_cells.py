@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Time building a conf emitted as a dict, with and without reading its notebook cells.
+
+Cells come from VitessceConfig.to_python, so for emitted confs they need the object model
+which the builder skipped; they are only made once they are read. Entities are synthetic
+image pyramids, which take the emitted path.
+
+    python benchmarks/conf_cells.py --images 20
+"""
+
+import argparse
+import time
+
+from portal_visualization.builders.imaging_builders import ImagePyramidViewConfBuilder
+from portal_visualization.paths import IMAGE_PYRAMID_DIR
+
+
+def make_entity(n_images):
+    files = [{"rel_path": f"{IMAGE_PYRAMID_DIR}/processedMicroscopy/image_{i}.ome.tif"} for i in range(n_images)]
+    return {"uuid": "uuid", "status": "Published", "files": files, "vitessce-hints": ["pyramid", "is_image"]}
+
+
+def conf_only(builder):
+    return builder.get_conf_cells().conf_bytes
+
+
+def conf_and_cells(builder):
+    conf_cells = builder.get_conf_cells()
+    return conf_cells.conf_bytes, conf_cells.cells
+
+
+def timed(f, *args, repeat=20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20, help="Number of image pyramids (default: %(default)s)")
+    args = parser.parse_args()
+
+    builder = ImagePyramidViewConfBuilder(make_entity(args.images), "groups_token", "https://example.com")
+    print(f"{args.images} images, {len(conf_only(builder))} bytes of conf")
+    for name, f in [("conf", conf_only), ("conf and cells", conf_and_cells)]:
+        print(f"{name:>16}: {timed(f, builder) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
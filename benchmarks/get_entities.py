@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Compare the time and peak memory of the row and columnar results of ApiClient.get_entities.
+
+Hits are synthetic, with sparse metadata like the donor and sample indexes,
+and are flattened exactly as get_entities flattens them.
+
+    python benchmarks/get_entities.py --entities 50000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from portal_visualization.client import _columnar_sources, _fill_sources, _flatten_source, _flatten_sources
+
+
+def make_sources(n_entities, n_fields, fields_per_entity, seed=0):
+    rng = random.Random(seed)
+    fields = [f"field_{i}" for i in range(n_fields)]
+    return [
+        {
+            "uuid": f"{i:032x}",
+            "hubmap_id": f"HBM{i:03}.ABCD.{i % 1000:03}",
+            "mapped_metadata": {field: [rng.randint(0, 100)] for field in rng.sample(fields, fields_per_entity)},
+        }
+        for i in range(n_entities)
+    ]
+
+
+def rows(sources, non_metadata_fields):
+    return _fill_sources(_flatten_sources(iter(sources), non_metadata_fields))
+
+
+def columns(sources, non_metadata_fields):
+    return _columnar_sources(_flatten_source(source, non_metadata_fields) for source in sources)
+
+
+def measure(f, *args):
+    # Time and memory are measured in separate runs, since tracing slows allocation.
+    start = time.perf_counter()
+    f(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    f(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entities", type=int, default=50000, help="Number of entities (default: %(default)s)")
+    parser.add_argument("--fields", type=int, default=200, help="Distinct metadata fields (default: %(default)s)")
+    parser.add_argument("--fields_per_entity", type=int, default=20, help="Fields per entity (default: %(default)s)")
+    args = parser.parse_args()
+
+    sources = make_sources(args.entities, args.fields, args.fields_per_entity)
+    non_metadata_fields = ["uuid", "hubmap_id"]
+    print(f"{args.entities} entities, {args.fields_per_entity} of {args.fields} fields each")
+    for name, f in [("rows", rows), ("columnar", columns)]:
+        elapsed, peak = measure(f, sources, non_metadata_fields)
+        print(f"{name:>10}: {elapsed:6.2f} s, peak {peak / 2**20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
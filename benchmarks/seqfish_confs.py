@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Time the grouping of seqFISH images by position, and building their confs.
+
+Entities are synthetic, with every hybridization cycle of every position, and the grouping is compared
+with the earlier approach, which sorted by file name and searched each path again for every key.
+
+    python benchmarks/seqfish_confs.py --positions 200 --cycles 20
+"""
+
+import argparse
+import re
+import time
+from itertools import groupby
+from pathlib import Path
+
+from portal_visualization.builders.imaging_builders import SeqFISHViewConfBuilder
+from portal_visualization.paths import IMAGE_PYRAMID_DIR, SEQFISH_FILE_REGEX, SEQFISH_HYB_CYCLE_REGEX
+
+
+def make_entity(n_positions, n_cycles):
+    cycles = [f"HybCycle_{c}" for c in range(n_cycles)] + ["final_mRNA_background"]
+    files = [
+        {"rel_path": f"{IMAGE_PYRAMID_DIR}/{cycle}/MMStack_Pos{p}.ome.tif"}
+        for p in range(n_positions)
+        for cycle in cycles
+    ]
+    return {"uuid": "uuid", "status": "Published", "files": files}
+
+
+def earlier_grouping(file_paths):
+    full_regex = "/".join([IMAGE_PYRAMID_DIR, SEQFISH_HYB_CYCLE_REGEX, SEQFISH_FILE_REGEX])
+    found = list({match[0] for match in {re.search(full_regex, path) for path in file_paths} if match})
+    by_name = [list(g) for _, g in groupby(sorted(found, key=lambda f: Path(f).name), lambda f: Path(f).name)]
+    return [
+        (
+            re.search(SEQFISH_FILE_REGEX, images[0])[0].split(".")[0],
+            [
+                (re.search(SEQFISH_HYB_CYCLE_REGEX, path)[0], path)
+                for path in sorted(images, key=lambda path: re.search(SEQFISH_HYB_CYCLE_REGEX, path)[0])
+            ],
+        )
+        for images in by_name
+    ]
+
+
+def timed(f, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--positions", type=int, default=200, help="Number of positions (default: %(default)s)")
+    parser.add_argument(
+        "--cycles", type=int, default=20, help="Hybridization cycles per position (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    entity = make_entity(args.positions, args.cycles)
+    builder = SeqFISHViewConfBuilder(entity, "groups_token", "https://example.com")
+    file_paths = [file["rel_path"] for file in entity["files"]]
+    assert earlier_grouping(file_paths) == builder._images_by_position(file_paths)
+    print(f"{args.positions} positions, {len(file_paths)} images")
+
+    for name, f in [("earlier", earlier_grouping), ("one pass", builder._images_by_position)]:
+        print(f"{'grouping, ' + name:>22}: {timed(f, file_paths) * 1000:8.1f} ms")
+    print(f"{'build':>22}: {timed(builder.get_conf_cells, repeat=1) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Resolvers for reading assets referenced by view configurations.
+
+Builders never fetch assets directly: zarr stores, ``metadata.json`` files and
+the like are read through an ``AssetResolver``. The default resolver talks to
+the assets server over HTTP. ``LocalAssetResolver`` and ``MemoryAssetResolver``
+map the same asset URLs onto a local mirror, so conf generation can run
+without network access. Only the reads are redirected: the URLs emitted in
+the conf are unchanged.
+
+Remote zarr stores are read through a shared ``BlockCache``: blocks of
+zipped stores are cached against the zip's ETag or Last-Modified, objects of
+directory stores against their own, and zip central directories are cached too
+(see ``remote_zip``). A first open of a directory store reads each object once,
+keeping the validator of the response; reopening it then only checks the objects
+already read with HEAD requests. Other assets, such as
+``metadata.json`` files, are revalidated with conditional GETs, so unchanged
+bodies are not downloaded again.
+"""
+
+import asyncio
+import io
+import json
+import zipfile
+from pathlib import Path
+from urllib.parse import urlparse
+
+import fsspec
+import fsspec.asyn
+import requests
+import zarr
+
+from .caching import BlockCache, BlockCachedFile, CachedStore, RevalidatingCache
+from .policy import get_policy
+from .remote_zip import ZipDirectoryCache, ZipFileStore, zip_cache_key
+
+# Most requests made at once, to read or validate the objects of a zarr store read in one batch.
+MAX_OBJECT_REQUESTS = 16
+
+default_zip_directories = ZipDirectoryCache()
+default_blocks = BlockCache()
+default_responses = RevalidatingCache()
+
+
+class AssetResolver:
+    """Reads assets from the assets server over HTTP.
+
+    :param ZipDirectoryCache zip_directories: Cache of zip central directories;
+        defaults to one shared by every resolver
+    :param BlockCache blocks: Cache of blocks read from zarr stores;
+        defaults to one shared by every resolver
+    :param RevalidatingCache responses: Cache of bodies returned by ``get``;
+        defaults to one shared by every resolver
+    :param Hedger hedger: If given, ``get`` requests that are slow to answer are duplicated
+    """
+
+    def __init__(self, zip_directories=None, blocks=None, responses=None, hedger=None):
+        self.zip_directories = zip_directories or default_zip_directories
+        self.blocks = blocks or default_blocks
+        self.responses = responses or default_responses
+        self.hedger = hedger
+
+    def get(self, url, request_init=None):
+        """Fetch an asset, returning a ``requests.Response``.
+        :param str url: URL of the asset
+        :param dict request_init: Extra keyword arguments for the request, e.g. headers
+        """
+        return self.responses.fetch(self._get, url, **(request_init or {}))
+
+    def _get(self, url, **kwargs):
+        if self.hedger is None:
+            return _get(url, **kwargs)
+        return self.hedger.call(lambda: _get(url, **kwargs))
+
+    def open_zarr(self, url, request_init=None):
+        """Open a zarr store for reading.
+        :param str url: URL of the zarr store
+        :param dict request_init: Client kwargs for request customization
+        """
+        store = zarr.storage.FSStore(url, mode="r", client_kwargs=_client_kwargs(url, request_init))
+        cached = CachedStore(
+            store,
+            url.split("?")[0],
+            self.blocks,
+            lambda keys: _object_validators(store.fs, url, keys),
+            lambda keys: _read_objects(store.fs, url, keys),
+        )
+        return zarr.open(_ZarrCachedStore(cached), mode="r")
+
+    def open_zip_zarr(self, url, request_init=None):
+        """Open a zipped zarr store for reading.
+        :param str url: URL of the .zarr.zip file
+        :param dict request_init: Client kwargs for request customization
+        """
+        # With a cached directory, nothing but the HEAD request of open_file
+        # is read until zarr asks for a member.
+        file = self.open_file(url, request_init)
+        zf = self.zip_directories.open(file, file.key)
+        return zarr.open(ZipFileStore(zf, url), mode="r")
+
+    def open_file(self, url, request_init=None):
+        """Open a file for reading, so that only the ranges read are requested.
+        :param str url: URL of the file
+        :param dict request_init: Client kwargs for request customization
+        """
+        fs = fsspec.filesystem("https", client_kwargs=_client_kwargs(url, request_init))
+        # One HEAD request gives the size and validator, which key the cached blocks.
+        info = fs.info(url)
+        key = zip_cache_key(url, info)
+        return BlockCachedFile(lambda start, end: fs.cat_file(url, start, end), key, info["size"], self.blocks)
+
+
+class MirrorAssetResolver(AssetResolver):
+    """Base class for resolvers that serve assets from a mirror of the assets server,
+    laid out as ``{uuid}/{rel_path}``.
+
+    >>> resolver = MirrorAssetResolver(base_url="https://example.com/assets")
+    >>> resolver.relative_path("https://example.com/assets/uuid/path/to/file.json?token=groups_token")
+    'uuid/path/to/file.json'
+    >>> resolver.relative_path("https://other.example.com/uuid/file.json")
+    'uuid/file.json'
+    """
+
+    def __init__(self, base_url=None):
+        super().__init__()
+        self._base_url = base_url.rstrip("/") + "/" if base_url else None
+
+    def relative_path(self, url):
+        """Map an asset URL to its path relative to the root of the mirror."""
+        return relative_path(url, self._base_url)
+
+    def get(self, url, request_init=None):
+        return _make_response(url, self._read(self.relative_path(url)))
+
+    def open_zarr(self, url, request_init=None):
+        return zarr.open(self._zarr_store(self.relative_path(url)), mode="r")
+
+    def open_zip_zarr(self, url, request_init=None):
+        zf = zipfile.ZipFile(self.open_file(url, request_init))
+        return zarr.open(ZipFileStore(zf, url), mode="r")
+
+    def open_file(self, url, request_init=None):
+        rel_path = self.relative_path(url)
+        data = self._read(rel_path)
+        if data is None:
+            raise FileNotFoundError(f"{rel_path} is not in the asset mirror")
+        return io.BytesIO(data)
+
+    def _read(self, rel_path):  # pragma: no cover
+        """Return the bytes stored at rel_path, or None if it is missing."""
+        raise NotImplementedError
+
+    def _zarr_store(self, rel_path):  # pragma: no cover
+        """Return something zarr.open can read for the store at rel_path."""
+        raise NotImplementedError
+
+
+class LocalAssetResolver(MirrorAssetResolver):
+    """Serves assets from a directory on the local filesystem.
+
+    :param str root: Directory containing one subdirectory per dataset uuid
+    :param str base_url: The assets endpoint the mirror stands in for
+    """
+
+    def __init__(self, root, base_url=None):
+        super().__init__(base_url)
+        self._root = Path(root)
+
+    def _read(self, rel_path):
+        path = self._root / rel_path
+        return path.read_bytes() if path.is_file() else None
+
+    def _zarr_store(self, rel_path):
+        return str(self._root / rel_path)
+
+
+class MemoryAssetResolver(MirrorAssetResolver):
+    """Serves assets from an in-memory mapping of relative paths to contents.
+    Values may be bytes, strings, or JSON-serializable objects;
+    zarr stores are represented by their individual keys.
+
+    >>> resolver = MemoryAssetResolver({"uuid/metadata.json": {"PhysicalSizeX": 1}})
+    >>> resolver.get("https://example.com/uuid/metadata.json?token=groups_token").json()
+    {'PhysicalSizeX': 1}
+    >>> resolver.get("https://example.com/uuid/missing.json").status_code
+    404
+    """
+
+    def __init__(self, files, base_url=None):
+        super().__init__(base_url)
+        self._files = files
+
+    def _read(self, rel_path):
+        value = self._files.get(rel_path)
+        if value is None or isinstance(value, bytes):
+            return value
+        if isinstance(value, str):
+            return value.encode()
+        return json.dumps(value).encode()
+
+    def _zarr_store(self, rel_path):
+        prefix = f"{rel_path}/"
+        return {key[len(prefix) :]: self._read(key) for key in self._files if key.startswith(prefix)}
+
+
+def relative_path(url, base_url=None):
+    """Map an asset URL to its path relative to base_url, or if it is elsewhere, to its path.
+    The query string, which may carry a token, is dropped.
+    """
+    url = url.split("?")[0]
+    if base_url:
+        base_url = base_url.rstrip("/") + "/"
+        if url.startswith(base_url):
+            return url[len(base_url) :].strip("/")
+    return urlparse(url).path.strip("/")
+
+
+def _get(url, **kwargs):
+    return get_policy(url).call(lambda timeout: requests.get(url, timeout=timeout, **kwargs))
+
+
+def _client_kwargs(url, request_init):
+    """aiohttp session arguments for fsspec, with the timeouts of the policy for url."""
+    return {"timeout": get_policy(url).client_timeout(), **(request_init or {})}
+
+
+class _ZarrCachedStore(zarr.storage.KVStore):
+    """A ``CachedStore`` for zarr. Wrapped in a plain ``KVStore``, its batched reads would be made one key
+    at a time."""
+
+    def getitems(self, keys, *, contexts):
+        return self._mutable_mapping.getitems(keys, contexts=contexts)
+
+
+def _object_validators(fs, url, keys):
+    """ETag or Last-Modified, or None, of each of the objects keys of the zarr store at url which exists.
+    The objects are looked up concurrently, with HEAD requests through the session of fs."""
+    found = fsspec.asyn.sync(fs.loop, _request_objects, fs, url, keys, "HEAD")
+    return {key: validator for key, (_, validator) in found.items()}
+
+
+def _read_objects(fs, url, keys):
+    """The body, and the ETag or Last-Modified of the response, or None, of each of the objects keys
+    of the zarr store at url which exists. The objects are read concurrently, through the session of fs."""
+    return fsspec.asyn.sync(fs.loop, _request_objects, fs, url, keys, "GET")
+
+
+async def _request_objects(fs, url, keys, method):
+    session = await fs.set_session()
+    semaphore = asyncio.Semaphore(MAX_OBJECT_REQUESTS)
+
+    async def request(key):
+        object_url = f"{url.rstrip('/')}/{key}"
+        async with semaphore, session.request(method, fs.encode_url(object_url), **fs.kwargs) as response:
+            body = await response.read()
+            try:
+                fs._raise_not_found_for_status(response, object_url)
+            except FileNotFoundError:
+                return None
+            return body, response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+    results = await asyncio.gather(*(request(key) for key in keys))
+    return {key: result for key, result in zip(keys, results, strict=True) if result is not None}
+
+
+def _make_response(url, data):
+    response = requests.models.Response()
+    response.url = url
+    if data is None:
+        response.status_code = 404
+        response.reason = "Not Found"
+        response._content = b""
+    else:
+        response.status_code = 200
+        response.reason = "OK"
+        response._content = data
+    return response
+
+
+_default_resolver = AssetResolver()
+
+
+def get_asset_resolver():
+    """Return the resolver used by builders that were not given one explicitly."""
+    return _default_resolver
+
+
+def set_asset_resolver(resolver):
+    """Set the resolver used by builders that were not given one explicitly.
+    Pass None to restore the default HTTP resolver.
+    """
+    global _default_resolver
+    _default_resolver = resolver or AssetResolver()
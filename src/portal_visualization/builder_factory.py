@@ -1,5 +1,6 @@
 from .assays import MALDI_IMS, NANODESI, SALMON_RNASSEQ_SLIDE, SEQFISH
 from .builders.base_builders import NullViewConfBuilder
+from .dependencies import BUILDER_SELECTION_FIELDS
 
 
 def _lazy_import_builder(builder_name):
@@ -19,6 +20,15 @@ def _lazy_import_builder(builder_name):
     if builder_name == "NullViewConfBuilder":
         return NullViewConfBuilder
 
+    builders = _get_builders()
+    if builder_name in builders:
+        return builders[builder_name]
+    else:  # pragma: no cover
+        raise ValueError(f"Unknown builder: {builder_name}")
+
+
+def _get_builders():
+    """Import every builder class, returning a dict of them keyed by name."""
     # Import all builders at once when needed
     from .builders.anndata_builders import (
         MultiomicAnndataZarrViewConfBuilder,
@@ -48,7 +58,7 @@ def _lazy_import_builder(builder_name):
     )
 
     # Map builder names to classes
-    builders = {
+    return {
         "MultiomicAnndataZarrViewConfBuilder": MultiomicAnndataZarrViewConfBuilder,
         "RNASeqAnnDataZarrViewConfBuilder": RNASeqAnnDataZarrViewConfBuilder,
         "SpatialMultiomicAnnDataZarrViewConfBuilder": SpatialMultiomicAnnDataZarrViewConfBuilder,
@@ -69,10 +79,27 @@ def _lazy_import_builder(builder_name):
         "TiledSPRMViewConfBuilder": TiledSPRMViewConfBuilder,
     }
 
-    if builder_name in builders:
-        return builders[builder_name]
-    else:  # pragma: no cover
-        raise ValueError(f"Unknown builder: {builder_name}")
+
+# Fields of the entity read by _get_builder_name.
+_FACTORY_ENTITY_FIELDS = ["uuid", *BUILDER_SELECTION_FIELDS]
+
+
+def get_entity_fields():
+    """Get the entity fields needed to choose a builder, and for any builder to build its conf:
+    Entities fetched with only these fields can be passed to get_view_config_builder and the builder.
+
+    Requires [full] install as it imports every builder.
+
+    :return: Field names, in Elasticsearch "_source" syntax
+    :rtype: list
+    """
+    # EPIC builders are chosen separately, by epic_factory, but read the same entities.
+    from .builders.epic_builders import SegmentationMaskBuilder
+
+    fields = dict.fromkeys(_FACTORY_ENTITY_FIELDS)
+    for builder in [NullViewConfBuilder, *_get_builders().values(), SegmentationMaskBuilder]:
+        fields.update(dict.fromkeys(builder.entity_fields))
+    return list(fields)
 
 
 # This function processes the hints and returns a tuple of booleans
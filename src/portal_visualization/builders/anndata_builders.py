@@ -1,7 +1,8 @@
+import re
+from collections import namedtuple
 from functools import cached_property
 
 import numpy as np
-import zarr
 from vitessce import (
     AnnDataWrapper,
     ImageOmeTiffWrapper,
@@ -16,8 +17,16 @@ from vitessce import CoordinationLevel as CL
 from vitessce import CoordinationType as ct
 from vitessce import ViewType as vt
 
-from ..constants import MAX_OBS_FOR_HEATMAP, MULTIOMIC_ZARR_PATH, XENIUM_ZARR_PATH, ZARR_PATH, ZIP_ZARR_PATH
-from ..utils import get_conf_cells, obs_has_column, read_zip_zarr
+from ..constants import (
+    HEATMAP_SUBSET_ZARR_PATH,
+    MAX_OBS_FOR_HEATMAP,
+    MULTIOMIC_ZARR_PATH,
+    XENIUM_ZARR_PATH,
+    ZARR_PATH,
+    ZIP_ZARR_PATH,
+)
+from ..utils import get_conf_cells, obs_columns, read_zip_zarr
+from ..view_costs import HEATMAP, cost_report, estimate_view_costs
 from .base_builders import ViewConfBuilder
 
 RNA_SEQ_ANNDATA_FACTOR_PATHS = [
@@ -26,6 +35,28 @@ RNA_SEQ_ANNDATA_FACTOR_PATHS = [
 
 RNA_SEQ_FACTOR_LABEL_NAMES = [f"Marker Gene {i}" for i in range(len(RNA_SEQ_ANNDATA_FACTOR_PATHS))]
 
+AZIMUTH_COLUMNS = ["azimuth_broad", "azimuth_medium", "azimuth_fine"]
+
+# Obs columns which are used if present. Their presence is checked in one batch:
+# on a remote store, that is one concurrent round of requests, rather than a round-trip each.
+OPTIONAL_OBS_COLUMNS = [
+    "marker_gene_0",
+    "predicted.ASCT.celltype",
+    "predicted_label",
+    "predicted_CLID",
+    "CL_Label",
+    "final_level_labels",
+    "full_hierarchical_labels",
+    *AZIMUTH_COLUMNS,
+    # Clusterings of multiomic data
+    "leiden_wnn",
+    "cluster_atac",
+    "leiden_rna",
+]
+
+# A clustering of multiomic data: its obs column, display label, and the name of its genomic profiles.
+Clustering = namedtuple("Clustering", ["column_name", "label", "multivec_label"])
+
 
 class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
     """Wrapper class for creating a AnnData-backed view configuration
@@ -33,6 +64,9 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
     https://portal.hubmapconsortium.org/browse/dataset/e65175561b4b17da5352e3837aa0e497
     """
 
+    # Where the obs columns are in the zarr store.
+    _obs_path = "obs"
+
     def __init__(self, entity, groups_token, assets_endpoint, **kwargs):
         super().__init__(entity, groups_token, assets_endpoint, **kwargs)
         # Spatially resolved RNA-seq assays require some special handling,
@@ -50,6 +84,14 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
         self._is_annotated = None
         self._scatterplot_w = None
         self._scatterplot_h = None
+        # A view_costs.ClientBudget: if given, optional views are deferred when their estimated
+        # cost does not fit it, rather than by the number of observations.
+        self._client_budget = kwargs.get("client_budget")
+        self._deferred_views = []
+        # After get_conf_cells, the estimated costs of the optional views, and which were deferred,
+        # as view_costs.cost_report gives them; None if X could not be read. Kept out of the conf,
+        # which must stay a valid Vitessce conf.
+        self.cost_estimate = None
 
     @cached_property
     def zarr_store(self):
@@ -59,19 +101,36 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
         if self._is_zarr_zip:
             zarr_url = self._build_assets_url(zarr_path, use_token=True)
             try:
-                return read_zip_zarr(zarr_url, request_init)
+                return read_zip_zarr(zarr_url, request_init, self._resolver)
             except Exception as e:  # pragma: no cover
                 print(f"Error opening the zip zarr file. {e}")
                 return None
         else:
             zarr_url = self._build_assets_url(zarr_path, use_token=False)
-            return zarr.open(zarr_url, mode="r", storage_options={"client_kwargs": request_init})
+            return self._resolver.open_zarr(zarr_url, request_init)
 
     @cached_property
-    def has_marker_genes(self):
+    def obs_columns(self):
+        """Which of OPTIONAL_OBS_COLUMNS are present.
+
+        >>> from pathlib import Path
+        >>> import json
+        >>> import zarr
+        >>> fixture_path = Path(__file__).parent.parent.parent.parent / "test" / "good-fixtures" / "RNASeqAnnDataZarrViewConfBuilder" / "fake-is-not-annotated-published-entity.json"
+        >>> entity = json.loads(fixture_path.read_text())
+        >>> builder = RNASeqAnnDataZarrViewConfBuilder(entity, 'token', 'https://example.com')
+        >>> z = zarr.open_group()
+        >>> z['obs/CL_Label/codes'] = zarr.array([0, 1])
+        >>> builder.__dict__['zarr_store'] = z
+        >>> builder.obs_columns
+        {'CL_Label'}
+        """
         z = self.zarr_store
-        if z is not None and "obs/marker_gene_0" in z:
-            return True
+        return set() if z is None else obs_columns(z, OPTIONAL_OBS_COLUMNS, self._obs_path)
+
+    @cached_property
+    def has_marker_genes(self):
+        return "marker_gene_0" in self.obs_columns
 
     @cached_property
     def is_annotated(self):
@@ -120,13 +179,34 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
     def compute_scatterplot_h(self):
         return 12 if self._minimal else 6
 
+    @cached_property
+    def view_costs(self):
+        """Estimated costs of the optional views, from the metadata of X, or None if it can't be read.
+
+        >>> from pathlib import Path
+        >>> import json
+        >>> import zarr
+        >>> fixture_path = Path(__file__).parent.parent.parent.parent / "test" / "good-fixtures" / "RNASeqAnnDataZarrViewConfBuilder" / "fake-is-not-annotated-published-entity.json"
+        >>> entity = json.loads(fixture_path.read_text())
+        >>> builder = RNASeqAnnDataZarrViewConfBuilder(entity, 'token', 'https://example.com')
+        >>> z = zarr.open_group()
+        >>> z['X'] = zarr.zeros((1000, 20), chunks=(100, 20), dtype='f4')
+        >>> builder.__dict__['zarr_store'] = z
+        >>> builder.view_costs['heatmap']
+        ViewCost(bytes=80000, requests=10)
+        """
+        z = self.zarr_store
+        return None if z is None else estimate_view_costs(z, is_zip=self._is_zarr_zip)
+
     def _should_include_optional_views(self, view_type=None):
         """Determine if optional views should be included based on minimal flag and dataset size.
 
-        For heatmap views, also check if the dataset has too many observations for performance.
+        For heatmap views, also check if the dataset is too large for performance:
+        by its estimated cost if there is a client budget, and otherwise by its number of observations.
 
         >>> from pathlib import Path
         >>> import json
+        >>> from ..view_costs import ClientBudget, ViewCost
         >>> fixture_path = Path(__file__).parent.parent.parent.parent / "test" / "good-fixtures" / "RNASeqAnnDataZarrViewConfBuilder" / "fake-is-not-annotated-published-entity.json"
         >>> entity = json.loads(fixture_path.read_text())
         >>> builder = RNASeqAnnDataZarrViewConfBuilder(entity, 'token', 'https://example.com')
@@ -142,6 +222,15 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
         >>> # Test non-heatmap view with large dataset
         >>> builder._should_include_optional_views('gene_list')
         True
+        >>> # Test with a client budget: the estimated cost decides, not the number of observations
+        >>> builder._client_budget = ClientBudget(bytes=2**20, requests=100)
+        >>> builder.__dict__['view_costs'] = {'heatmap': ViewCost(bytes=2**19, requests=10)}
+        >>> builder._should_include_optional_views('heatmap')
+        True
+        >>> builder._deferred_views = []
+        >>> builder.__dict__['view_costs'] = {'heatmap': ViewCost(bytes=2**19, requests=1000)}
+        >>> builder._should_include_optional_views('heatmap'), builder._deferred_views
+        (False, ['heatmap'])
         >>> # Test minimal mode
         >>> builder._minimal = True
         >>> builder.__dict__['n_obs'] = 50000
@@ -151,10 +240,24 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
 
         if self._minimal:
             return False
-        return not (view_type == "heatmap" and self.n_obs > MAX_OBS_FOR_HEATMAP)
+        if view_type != HEATMAP:
+            return True
+        costs = None if self._client_budget is None else self.view_costs
+        include = self.n_obs <= MAX_OBS_FOR_HEATMAP if costs is None else costs[HEATMAP].fits(self._client_budget)
+        if not include:
+            self._deferred_views.append(view_type)
+        return include
+
+    def _cost_estimate(self):
+        # Only estimated for a client budget, so other builds read no more of the store;
+        # and only reported when X could be read, so the estimate is never a guess.
+        if self._client_budget is None:
+            return None
+        costs = self.view_costs
+        return None if costs is None else cost_report(costs, self._client_budget, self._deferred_views)
 
     def get_conf_cells(self, marker=None):
-        file_paths_found = [file["rel_path"] for file in self._entity["files"]]
+        file_paths_found = self._get_file_paths()
         # Use .zgroup file as proxy for whether or not the zarr store is present.
         if f"{ZARR_PATH}.zip" in file_paths_found:
             self._is_zarr_zip = True
@@ -168,10 +271,12 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
             self._scatterplot_h = self.compute_scatterplot_h()
         self._set_up_marker_gene(marker)
         self._set_up_obs_labels()
+        self._deferred_views = []
         vc = VitessceConfig(name=self._uuid, schema_version=self._schema_version)
         dataset = self._set_up_dataset(vc)
         vc = self._setup_anndata_view_config(vc, dataset)
         vc = self._link_marker_gene(vc)
+        self.cost_estimate = self._cost_estimate()
         return get_conf_cells(vc)
 
     def _set_up_marker_gene(self, marker):
@@ -249,6 +354,25 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
         )
         return dataset
 
+    def _set_up_heatmap_subset(self, vc):
+        # See subsampling.write_heatmap_subset for how the subset is made.
+        subset_paths = self._get_file_paths(f"^{re.escape(HEATMAP_SUBSET_ZARR_PATH)}/\\.zgroup$")
+        if self._minimal or not subset_paths:
+            return None
+        z = self.zarr_store
+        return vc.add_dataset(name=f"{self._uuid} (subset)").add_object(
+            AnnDataWrapper(
+                adata_url=self._build_assets_url(HEATMAP_SUBSET_ZARR_PATH, use_token=False),
+                obs_feature_matrix_path="X",
+                initial_feature_filter_path="var/marker_genes_for_heatmap",
+                obs_set_paths=self._obs_set_paths,
+                obs_set_names=self._obs_set_names,
+                request_init=self._get_request_init(),
+                feature_labels_path="var/hugo_symbol" if z is not None and "var" in z else None,
+                gene_alias=self._gene_alias,
+            )
+        )
+
     def _set_up_obs_labels(
         self,
         additional_obs_labels_paths=[],
@@ -257,8 +381,6 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
         additional_obs_set_names=[],
         # Optionally skip default obs paths and labels
         skip_default_paths=False,
-        # Support multiomic datasets
-        modality_prefix=None,
     ):
         # Some of the keys (like marker_genes_for_heatmap) here are from our pipeline
         # https://github.com/hubmapconsortium/portal-containers/blob/master/containers/anndata-to-ui
@@ -278,11 +400,10 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
         obs_label_paths.extend(additional_obs_labels_paths)
         obs_label_names.extend(additional_obs_labels_names)
 
-        z = self.zarr_store
-        obs = None if z is None else z["obs"] if modality_prefix is None else z[f"{modality_prefix}/obs"]
+        obs = self.obs_columns
         if not skip_default_paths:
             if self._is_annotated:
-                azimuth_categories = self._get_azimuth_categories(obs)
+                azimuth_categories = self._get_azimuth_categories()
                 if "predicted.ASCT.celltype" in obs:
                     obs_set_paths.append("obs/predicted.ASCT.celltype")
                     obs_set_names.append("Predicted ASCT Cell Type")
@@ -327,6 +448,10 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
             gene_list = vc.add_view(cm.FEATURE_LIST, dataset=dataset)
         if self._should_include_optional_views("heatmap"):
             heatmap = vc.add_view(cm.HEATMAP, dataset=dataset)
+        elif (subset := self._set_up_heatmap_subset(vc)) is not None:
+            # Too large to show whole, but a subset of the cells can be shown instead.
+            heatmap = vc.add_view(cm.HEATMAP, dataset=subset)
+            self._deferred_views.remove(HEATMAP)
 
         cell_sets_expr = vc.add_view(cm.OBS_SET_FEATURE_VALUE_DISTRIBUTION, dataset=dataset)
 
@@ -407,15 +532,8 @@ class RNASeqAnnDataZarrViewConfBuilder(ViewConfBuilder):
             )
         return vc
 
-    def _get_azimuth_categories(self, obs):
-        azimuth_categories = []
-        if "azimuth_broad" in obs:
-            azimuth_categories.append("obs/azimuth_broad")
-        if "azimuth_medium" in obs:
-            azimuth_categories.append("obs/azimuth_medium")
-        if "azimuth_fine" in obs:
-            azimuth_categories.append("obs/azimuth_fine")
-        return azimuth_categories
+    def _get_azimuth_categories(self):
+        return [f"obs/{column}" for column in AZIMUTH_COLUMNS if column in self.obs_columns]
 
 
 class SpatialRNASeqAnnDataZarrViewConfBuilder(RNASeqAnnDataZarrViewConfBuilder):
@@ -578,8 +696,9 @@ class SpatialMultiomicAnnDataZarrViewConfBuilder(SpatialRNASeqAnnDataZarrViewCon
             raise FileNotFoundError(message)
         adata_url = self._build_assets_url(zarr_path, use_token=False)
         image_url = self._build_assets_url("ometiff-pyramids/visium_histology_hires_pyramid.ome.tif", use_token=True)
-        offsets_url = self._build_assets_url(
-            "output_offsets/visium_histology_hires_pyramid.offsets.json", use_token=True
+        offsets_url = self._offsets_url(
+            image_url,
+            self._build_assets_url("output_offsets/visium_histology_hires_pyramid.offsets.json", use_token=True),
         )
 
         # Add dataset with Visium image and secondary analysis anndata
@@ -729,16 +848,21 @@ class MultiomicAnndataZarrViewConfBuilder(RNASeqAnnDataZarrViewConfBuilder):
     https://portal.hubmapconsortium.org/browse/dataset/024d671f28994ff76eebf1e24ee640a7
     """
 
+    _obs_path = "mod/rna/obs"
+
     def __init__(self, entity, groups_token, assets_endpoint, **kwargs):
         super().__init__(entity, groups_token, assets_endpoint, **kwargs)
         self._scatterplot_w = 3
+        # None until the obs sets are set up; then the marker they were set up for, in a list,
+        # since None is a marker too.
+        self._obs_sets_marker = None
 
     @cached_property
     def zarr_store(self):
         zarr_path = f"{MULTIOMIC_ZARR_PATH}.zip" if self._is_zarr_zip else MULTIOMIC_ZARR_PATH
         request_init = self._get_request_init() or {}
         adata_url = self._build_assets_url(zarr_path, use_token=False)
-        return zarr.open(adata_url, mode="r", storage_options={"client_kwargs": request_init})
+        return self._resolver.open_zarr(adata_url, request_init)
 
     @cached_property
     def has_marker_genes(self):
@@ -803,22 +927,26 @@ class MultiomicAnndataZarrViewConfBuilder(RNASeqAnnDataZarrViewConfBuilder):
                     return obs[key].shape[0]
         return 0
 
-    def get_conf_cells(self, marker=None):
-        modality_prefix = "mod/rna/obs"
-        z = self.zarr_store
-        obs = None if z is None else z[modality_prefix]
-        # file_paths_found = [file["rel_path"] for file in self._entity["files"] if "files" in self._entity]
-        # # Use .zgroup file as proxy for whether or not the zarr store is present.
-        # if any('.zarr.zip' in path for path in file_paths_found): # pragma: no cover
-        #     self._is_zarr_zip = True
-        # elif not self._is_zarr_zip and f'{MULTIOMIC_ZARR_PATH}/.zgroup' not in file_paths_found:  # pragma: no cover
-        #     message = f'Multiomic assay with uuid {self._uuid} has no .zarr store at {MULTIOMIC_ZARR_PATH}'
-        #     raise FileNotFoundError(message)
+    @cached_property
+    def clusterings(self):
+        """The clusterings with a conf, in order: an index which is cheap to compute,
+        so the conf of one clustering can be built with ``get_clustering_conf_cells``.
 
+        >>> from pathlib import Path
+        >>> import json
+        >>> import zarr
+        >>> fixture_path = Path(__file__).parent.parent.parent.parent / "test" / "good-fixtures" / "MultiomicAnndataZarrViewConfBuilder" / "fake-multiome-entity.json"
+        >>> entity = json.loads(fixture_path.read_text())
+        >>> builder = MultiomicAnndataZarrViewConfBuilder(entity, 'token', 'https://example.com')
+        >>> z = zarr.open_group()
+        >>> z['mod/rna/obs/leiden_rna/categories'] = zarr.array(['0', '1'])
+        >>> builder.__dict__['zarr_store'] = z
+        >>> builder.clusterings
+        [Clustering(column_name='leiden_rna', label='Leiden (RNA)', multivec_label='rna')]
+        """
         # Each clustering has its own genomic profile; since we can't currently toggle between
         # selected genomic profiles, each clustering needs its own view config.
         self._is_annotated = self.is_annotated
-        confs = []
         cluster_columns = [
             ["leiden_wnn", "Leiden (Weighted Nearest Neighbor)", "wnn"],
             ["cluster_atac", "ArchR Clusters (ATAC)", "cbb"] if self.has_cbb else None,
@@ -828,14 +956,44 @@ class MultiomicAnndataZarrViewConfBuilder(RNASeqAnnDataZarrViewConfBuilder):
             ["final_level_labels", "Final Level Labels", "label"] if self._is_annotated else None,
             ["CL_Label", "CL Label", "label"] if self._is_annotated else None,
         ]
+        return [Clustering(*col) for col in cluster_columns if col is not None and col[0] in self.obs_columns]
 
-        cluster_columns = [
-            col for col in cluster_columns if col is not None and obs_has_column(z, col[0], modality_prefix)
-        ]
+    def get_conf_cells(self, marker=None):
+        """The confs of every clustering, as a list. To build only the conf shown,
+        use ``clusterings`` and ``get_clustering_conf_cells`` instead.
+        """
+        # file_paths_found = [file["rel_path"] for file in self._entity["files"] if "files" in self._entity]
+        # # Use .zgroup file as proxy for whether or not the zarr store is present.
+        # if any('.zarr.zip' in path for path in file_paths_found): # pragma: no cover
+        #     self._is_zarr_zip = True
+        # elif not self._is_zarr_zip and f'{MULTIOMIC_ZARR_PATH}/.zgroup' not in file_paths_found:  # pragma: no cover
+        #     message = f'Multiomic assay with uuid {self._uuid} has no .zarr store at {MULTIOMIC_ZARR_PATH}'
+        #     raise FileNotFoundError(message)
+        confs = self._new_conf_list()
+        for clustering in self.clusterings:
+            confs.append(self._build_clustering_conf(clustering, marker).to_dict())
+        self.cost_estimate = self._cost_estimate()
+        return get_conf_cells(confs)
 
-        column_names, column_labels = [f"obs/{col[0]}" for col in cluster_columns], [col[1] for col in cluster_columns]
+    def get_clustering_conf_cells(self, label, marker=None):
+        """The conf of the clustering with label, one of those in ``clusterings``.
+        The stores are only probed once, however many clusterings are built.
+        """
+        clustering = next((clustering for clustering in self.clusterings if clustering.label == label), None)
+        if clustering is None:
+            raise KeyError(f"Multiomic assay with uuid {self._uuid} has no clustering {label!r}")
+        vc = self._build_clustering_conf(clustering, marker)
+        self.cost_estimate = self._cost_estimate()
+        return get_conf_cells(vc)
+
+    def _set_up_obs_sets(self, marker):
+        # Every clustering's conf has the same obs sets, so they are only set up once per marker.
+        if self._obs_sets_marker == [marker]:
+            return
+        column_names = [f"obs/{clustering.column_name}" for clustering in self.clusterings]
+        column_labels = [clustering.label for clustering in self.clusterings]
 
-        azimuth_categories = self._get_azimuth_categories(obs)
+        azimuth_categories = self._get_azimuth_categories()
 
         if len(azimuth_categories) > 0:
             column_names.append(azimuth_categories)
@@ -846,16 +1004,17 @@ class MultiomicAnndataZarrViewConfBuilder(RNASeqAnnDataZarrViewConfBuilder):
             additional_obs_set_names=column_labels,
             additional_obs_set_paths=column_names,
             skip_default_paths=True,
-            modality_prefix="mod/rna",
         )
-
-        for column_name, column_label, multivec_label in cluster_columns:
-            vc = VitessceConfig(name=f"{column_label}", schema_version=self._schema_version)
-            dataset = self._set_up_dataset(vc, multivec_label)
-            vc = self._setup_anndata_view_config(vc, dataset, column_name, column_label)
-            vc = self._link_marker_gene(vc)
-            confs.append(vc.to_dict())
-        return get_conf_cells(confs)
+        self._obs_sets_marker = [marker]
+
+    def _build_clustering_conf(self, clustering, marker):
+        self._set_up_obs_sets(marker)
+        # Every clustering's conf has the same views, so only the last build's deferrals are kept.
+        self._deferred_views = []
+        vc = VitessceConfig(name=f"{clustering.label}", schema_version=self._schema_version)
+        dataset = self._set_up_dataset(vc, clustering.multivec_label)
+        vc = self._setup_anndata_view_config(vc, dataset, clustering.column_name, clustering.label)
+        return self._link_marker_gene(vc)
 
     def _set_up_dataset(self, vc, multivec_label):
         zarr_base = "hubmap_ui/mudata-zarr"
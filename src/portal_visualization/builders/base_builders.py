@@ -1,20 +1,95 @@
+import hashlib
+import re
 import urllib
 from abc import ABC, abstractmethod
 from collections import namedtuple
+from functools import cached_property
 
-ConfCells = namedtuple("ConfCells", ["conf", "cells"])
+from .. import serialization
+from ..compact_confs import CompactConfList
+from ..dependencies import ConfDependencies
+from ..paths import VISUALIZATION_MANIFEST
+
+
+class ConfCells(namedtuple("ConfCells", ["conf", "cells"])):
+    """The conf, and notebook cells which reproduce it.
+
+    >>> conf_cells = ConfCells({"version": "1.0.15"}, None)
+    >>> conf, cells = conf_cells
+    >>> conf_cells.conf_bytes
+    b'{"version":"1.0.15"}'
+    >>> conf_cells.etag == ConfCells({"version": "1.0.15"}, None).etag
+    True
+    >>> conf_cells.etag
+    '"c96ebe1ef67c6e6a97d72e2dda1598584a6301b61fb496b746bcd8657e181ca8"'
+
+    The conf is encoded once, on first use: it should not be modified after that.
+
+    Cells may be given as a function returning them, so they are only made once they are read,
+    e.g. by unpacking:
+
+    >>> made = []
+    >>> conf_cells = ConfCells({}, lambda: made.append("cells") or ["cell"])
+    >>> made
+    []
+    >>> conf, cells = conf_cells
+    >>> cells, conf_cells.cells, conf_cells[1], made
+    (['cell'], ['cell'], ['cell'], ['cells'])
+    >>> conf_cells
+    ConfCells(conf={}, cells=['cell'])
+    """
+
+    @cached_property
+    def cells(self):
+        cells = tuple.__getitem__(self, 1)
+        return cells() if callable(cells) else cells
+
+    def __iter__(self):
+        yield self.conf
+        yield self.cells
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __repr__(self):
+        return f"ConfCells(conf={self.conf!r}, cells={self.cells!r})"
+
+    @cached_property
+    def conf_bytes(self):
+        """The conf as compact UTF-8 JSON, ready to write to a response or cache."""
+        return serialization.dumps(self.conf)
+
+    @cached_property
+    def content_hash(self):
+        """SHA-256 of the conf's canonical encoding: builders are deterministic, so the same inputs
+        give the same hash, whether or not orjson encodes ``conf_bytes``."""
+        return hashlib.sha256(serialization.canonical_dumps(self.conf)).hexdigest()
+
+    @property
+    def etag(self):
+        """A strong ETag for the conf, so repeated requests for an unchanged conf can be answered with a 304."""
+        return f'"{self.content_hash}"'
 
 
 class NullViewConfBuilder:
+    # Fields of the entity this builder reads; see builder_factory.get_entity_fields.
+    entity_fields = ["uuid"]
+
     def __init__(self, entity, groups_token, assets_endpoint, **kwargs):
-        # Just so it has the same signature as the other builders
-        pass
+        # Just so it has the same signature as the other builders.
+        # There is no conf, so it only depends on the fields that chose this builder.
+        self.dependencies = ConfDependencies()
 
     def get_conf_cells(self, **kwargs):
         return ConfCells(None, None)
 
 
 class ViewConfBuilder(ABC):
+    # Fields of the entity this builder reads, in Elasticsearch "_source" syntax,
+    # so entities can be fetched without e.g. their full file lists.
+    # Subclasses which read more of the entity should extend this.
+    entity_fields = ["uuid", "status", "files.rel_path"]
+
     def __init__(self, entity, groups_token, assets_endpoint, **kwargs):
         """Object for building the vitessce configuration.
         :param dict entity: Entity response from search index (from the entity API)
@@ -23,6 +98,11 @@ class ViewConfBuilder(ABC):
         :param dict kwargs: Additional keyword arguments
         :param str  kwargs.schema_version: The vitessce schema version to use, default "1.0.15"
         :param bool kwargs.minimal: Whether or not to build a minimal configuration, default False
+        :param AssetResolver kwargs.asset_resolver: Where to read assets from, default the global resolver
+        :param bool kwargs.compact_confs: Whether builders with several confs return them as a
+        ``CompactConfList``, whose confs share their common parts, default False
+        :param OffsetsService kwargs.offsets_service: Where to point image pyramids whose
+        ``offsets.json`` the entity does not list, default nowhere
         """
 
         self._uuid = entity["uuid"]
@@ -32,11 +112,20 @@ class ViewConfBuilder(ABC):
         self._files = []
         self._schema_version = kwargs.get("schema_version", "1.0.15")
         self._minimal = kwargs.get("minimal", False)
+        self._asset_resolver = kwargs.get("asset_resolver")
+        self._compact_confs = kwargs.get("compact_confs", False)
+        self._offsets_service = kwargs.get("offsets_service")
+        # What the conf is built from, so a cached conf can be checked against a changed entity.
+        self.dependencies = ConfDependencies()
 
     @abstractmethod
     def get_conf_cells(self, **kwargs):  # pragma: no cover
         raise NotImplementedError
 
+    def _new_conf_list(self):
+        """An empty list to append confs to, compacted if the caller asked for it."""
+        return CompactConfList() if self._compact_confs else []
+
     def _replace_url_in_file(self, file):
         """Replace url in incoming file object
         :param dict file: File dict which will have its rel_path replaced by url
@@ -85,6 +174,47 @@ class ViewConfBuilder(ABC):
         token_param = urllib.parse.urlencode({"token": self._groups_token})
         return f"{base_url}?{token_param}" if use_token else base_url
 
+    @cached_property
+    def _assets(self):
+        """The AssetResolver this builder was given, or the global one.
+        If the entity lists a visualization manifest, it is fetched once, and reads it holds are answered from it.
+
+        >>> from ..assets import MemoryAssetResolver
+        >>> builder = _DocTestBuilder(
+        ...   entity={"uuid": "uuid", "status": "Published", "files": [{"rel_path": VISUALIZATION_MANIFEST}]},
+        ...   groups_token='groups_token',
+        ...   assets_endpoint='https://example.com',
+        ...   asset_resolver=MemoryAssetResolver({f"uuid/{VISUALIZATION_MANIFEST}": {"version": 1}}))
+        >>> type(builder._assets).__name__
+        'ManifestResolver'
+        """
+        # Imported here so the thin install does not need zarr and fsspec.
+        from ..assets import get_asset_resolver
+        from ..manifest import ManifestResolver, read_manifest
+
+        resolver = self._asset_resolver or get_asset_resolver()
+        # Sub-builders are passed their parent's resolver, so the manifest is only fetched once.
+        if isinstance(resolver, ManifestResolver) or "files" not in self._entity:
+            return resolver
+        if not self._get_file_paths(f"^{re.escape(VISUALIZATION_MANIFEST)}$"):
+            return resolver
+        url = urllib.parse.urljoin(self._assets_endpoint, f"{self._uuid}/{VISUALIZATION_MANIFEST}")
+        manifest = read_manifest(self.dependencies.recording(resolver), url, self._get_request_init())
+        return resolver if manifest is None else ManifestResolver(resolver, manifest, self._assets_endpoint)
+
+    @property
+    def _resolver(self):
+        """The AssetResolver used to read assets while building the conf.
+
+        >>> builder = _DocTestBuilder(
+        ...   entity={"uuid": "uuid"},
+        ...   groups_token='groups_token',
+        ...   assets_endpoint='https://example.com')
+        >>> type(builder._resolver._resolver).__name__
+        'AssetResolver'
+        """
+        return self.dependencies.recording(self._assets)
+
     def _get_request_init(self):
         """Get request headers for requestInit parameter in Vitessce conf.
         This is needed for non-public zarr stores because the client forms URLs for zarr chunks,
@@ -104,6 +234,7 @@ class ViewConfBuilder(ABC):
         >>> repr(builder._get_request_init())
         'None'
         """
+        self.dependencies.record_status()
         if self._entity["status"] == "Published":
             # Extra headers outside of a select few cause extra CORS-preflight requests which
             # can slow down the webpage.  If the dataset is published, we don't need to use
@@ -112,8 +243,36 @@ class ViewConfBuilder(ABC):
             return None
         return {"headers": {"Authorization": f"Bearer {self._groups_token}"}}
 
-    def _get_file_paths(self):
-        """Get all rel_path keys from the entity dict.
+    def _offsets_url(self, img_url, offsets_url):
+        """Return offsets_url, or if the entity does not list that file and the builder has
+        an offsets service, the URL at which the service serves offsets of the image at img_url.
+
+        >>> from ..offsets import OffsetsService
+        >>> builder = _DocTestBuilder(
+        ...   entity={"uuid": "uuid", "files": [{"rel_path": "output_offsets/listed.offsets.json"}]},
+        ...   groups_token='groups_token',
+        ...   assets_endpoint='https://example.com',
+        ...   offsets_service=OffsetsService("https://offsets.example.com", "https://example.com"))
+        >>> builder._offsets_url("https://example.com/uuid/pyramids/listed.ome.tif",
+        ...   "https://example.com/uuid/output_offsets/listed.offsets.json")
+        'https://example.com/uuid/output_offsets/listed.offsets.json'
+        >>> builder._offsets_url("https://example.com/uuid/pyramids/missing.ome.tif",
+        ...   "https://example.com/uuid/output_offsets/missing.offsets.json")
+        'https://offsets.example.com/uuid/pyramids/missing.ome.tif.offsets.json'
+        """
+        if self._offsets_service is None:
+            return offsets_url
+        # The path after the assets endpoint and uuid, as the entity lists it.
+        path = offsets_url.split("?")[0][len(self._assets_endpoint.rstrip("/")) + 1 :]
+        rel_path = path.split("/", 1)[-1]
+        if self._get_file_paths(f"^{re.escape(rel_path)}$"):
+            return offsets_url
+        return self._offsets_service.offsets_url(img_url)
+
+    def _get_file_paths(self, pattern=None):
+        """Get all rel_path keys from the entity dict, or only those matching pattern.
+        Builders which only use some files should pass a pattern, so other files can change
+        without invalidating the conf.
 
         >>> files = [{ "rel_path": "path/to/file" }, { "rel_path": "path/to/other_file" }]
         >>> builder = _DocTestBuilder(
@@ -122,8 +281,10 @@ class ViewConfBuilder(ABC):
         ...   assets_endpoint='https://example.com')
         >>> builder._get_file_paths()
         ['path/to/file', 'path/to/other_file']
+        >>> builder._get_file_paths(pattern="other")
+        ['path/to/other_file']
         """
-        return [file["rel_path"] for file in self._entity["files"]]
+        return self.dependencies.record_files([file["rel_path"] for file in self._entity["files"]], pattern)
 
 
 class _DocTestBuilder(ViewConfBuilder):  # pragma: no cover
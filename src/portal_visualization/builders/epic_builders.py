@@ -1,8 +1,8 @@
-import random
+import hashlib
 import re
 from abc import abstractmethod
+from copy import deepcopy
 
-from requests import get
 from vitessce import (
     AnnDataWrapper,
     ObsSegmentationsOmeTiffWrapper,
@@ -30,8 +30,20 @@ zarr_path = f"{SEGMENTATION_SUBDIR}/{SEGMENTATION_ZARR_STORES}"
 
 class EPICConfBuilder(ViewConfBuilder):
     def __init__(
-        self, epic_uuid, base_conf: ConfCells, entity, groups_token, assets_endpoint, base_image_metadata, **kwargs
+        self,
+        epic_uuid,
+        base_conf: ConfCells,
+        entity,
+        groups_token,
+        assets_endpoint,
+        base_image_metadata,
+        base_vitessce_config=None,
+        **kwargs,
     ) -> None:
+        """
+        :param VitessceConfig base_vitessce_config: The base builder's config object, if it has one,
+        which is modified in place rather than rebuilt from the conf dict
+        """
         super().__init__(entity, groups_token, assets_endpoint, **kwargs)
 
         conf, cells = base_conf
@@ -42,7 +54,10 @@ class EPICConfBuilder(ViewConfBuilder):
         self._is_plural = isinstance(conf, list)
 
         if self._is_plural:  # pragma: no cover
-            self._base_conf = [VitessceConfig.from_dict(conf) for conf in conf]
+            # Confs in a CompactConfList share parts, which from_dict would share with each VitessceConfig.
+            self._base_conf = [VitessceConfig.from_dict(deepcopy(conf)) for conf in conf]
+        elif base_vitessce_config is not None:
+            self._base_conf: VitessceConfig = base_vitessce_config
         else:
             self._base_conf: VitessceConfig = VitessceConfig.from_dict(base_conf.conf)
 
@@ -75,12 +90,15 @@ class EPICConfBuilder(ViewConfBuilder):
         img_url = self._build_assets_url(f"{SEGMENTATION_SUBDIR}/{img_path}")
         return (
             img_url,
-            str(
-                re.sub(
-                    r"ome\.tiff?",
-                    "offsets.json",
-                    re.sub(IMAGE_PYRAMID_DIR, OFFSETS_DIR, img_url),
-                )
+            self._offsets_url(
+                img_url,
+                str(
+                    re.sub(
+                        r"ome\.tiff?",
+                        "offsets.json",
+                        re.sub(IMAGE_PYRAMID_DIR, OFFSETS_DIR, img_url),
+                    )
+                ),
             ),
             str(
                 re.sub(
@@ -96,7 +114,7 @@ class SegmentationMaskBuilder(EPICConfBuilder):
     def _apply(self, conf):
         zarr_url = self.zarr_store_url()
         datasets = conf.get_datasets()
-        file_paths_found = [file["rel_path"] for file in self._entity["files"]]
+        file_paths_found = self._get_file_paths()
         if any(".zarr.zip" in path for path in file_paths_found):
             self._is_zarr_zip = True
         found_images = list(
@@ -113,7 +131,7 @@ class SegmentationMaskBuilder(EPICConfBuilder):
 
         if len(filtered_images) >= 1:
             img_url, offsets_url, metadata_url = self.segmentations_ome_offset_url(filtered_images[0])
-        segmentation_metadata = get_image_metadata(self, metadata_url)
+        segmentation_metadata = get_image_metadata(self, metadata_url, img_url)
 
         segmentation_scale = get_image_scale(self.base_image_metadata, segmentation_metadata)
         segmentations = ObsSegmentationsOmeTiffWrapper(
@@ -164,7 +182,7 @@ class SegmentationMaskBuilder(EPICConfBuilder):
         mask_names = []
         url = f"{self.zarr_store_url()}/metadata.json"
         request_init = self._get_request_init() or {}
-        response = get(url, **request_init)
+        response = self._resolver.get(url, request_init)
         if response.status_code == 200:
             data = response.json()
             if isinstance(data, dict) and "mask_names" in data:
@@ -181,7 +199,7 @@ def create_segmentation_objects(self, base_url, mask_names):  # pragma: no cover
     segmentation_objects = []
     segmentations_CL = []
     for mask_name in mask_names:
-        color_channel = generate_unique_color()
+        color_channel = generate_unique_color(mask_name)
         mask_url = f"{base_url}/{mask_name}.zarr"
         if self._is_zarr_zip:
             mask_url = f"{mask_url}.zip"
@@ -204,5 +222,12 @@ def create_segmentation_objects(self, base_url, mask_names):  # pragma: no cover
     return segmentation_objects, segmentations_CL
 
 
-def generate_unique_color():  # pragma: no cover
-    return [random.randint(0, 255) for _ in range(3)]
+def generate_unique_color(name):
+    """A color derived from name, so the same mask always gets the same color, and confs do not change between builds.
+
+    >>> generate_unique_color("Cells") == generate_unique_color("Cells") != generate_unique_color("Nuclei")
+    True
+    >>> all(0 <= value <= 255 for value in generate_unique_color("Cells"))
+    True
+    """
+    return list(hashlib.sha256(name.encode()).digest()[:3])
@@ -1,4 +1,5 @@
 import re
+from collections import defaultdict
 from pathlib import Path
 
 from vitessce import (
@@ -17,6 +18,7 @@ from vitessce import (
     CoordinationLevel as CL,
 )
 
+from ..conf_emitter import ConfEmitter
 from ..constants import base_image_dirs
 from ..paths import (
     GEOMX_DIR,
@@ -34,8 +36,6 @@ from ..utils import (
     get_found_images_all,
     get_image_metadata,
     get_image_scale,
-    get_matches,
-    group_by_file_name,
 )
 from .base_builders import ViewConfBuilder
 
@@ -53,6 +53,14 @@ class AbstractImagingViewConfBuilder(ViewConfBuilder):
         self.use_physical_size_scaling = False
         self.view_type = BASE_IMAGE_VIEW_TYPE
         self.base_image_metadata = None
+        # The VitessceConfig behind the last conf built, which EPIC builders can extend in place.
+        self.base_vitessce_config = None
+        # If given, image-pyramid confs show at most this many images, one page at a time,
+        # so the browser does not read every image's header up front.
+        self._image_page_size = kwargs.get("image_page_size")
+        # After get_conf_cells, if the images are on several pages, the page shown, the page size,
+        # and the names of the images on every page. Kept out of the conf, which must stay a valid Vitessce conf.
+        self.image_page_index = None
         super().__init__(entity, groups_token, assets_endpoint, **kwargs)
 
     def _get_img_and_offset_url(self, img_path, img_dir):
@@ -79,12 +87,15 @@ class AbstractImagingViewConfBuilder(ViewConfBuilder):
         img_url = self._build_assets_url(img_path)
         return (
             img_url,
-            str(
-                re.sub(
-                    r"ome\.tiff?",
-                    "offsets.json",
-                    re.sub(img_dir, OFFSETS_DIR, img_url),
-                )
+            self._offsets_url(
+                img_url,
+                str(
+                    re.sub(
+                        r"ome\.tiff?",
+                        "offsets.json",
+                        re.sub(img_dir, OFFSETS_DIR, img_url),
+                    )
+                ),
             ),
             str(
                 re.sub(
@@ -108,12 +119,15 @@ class AbstractImagingViewConfBuilder(ViewConfBuilder):
         metadata_path = re.sub(IMAGE_PYRAMID_DIR, IMAGE_METADATA_DIR, img_dir)
         return (
             img_url,
-            str(
-                re.sub(
-                    r"ome\.tiff?",
-                    "offsets.json",
-                    re.sub(img_dir, offsets_path, img_url),
-                )
+            self._offsets_url(
+                img_url,
+                str(
+                    re.sub(
+                        r"ome\.tiff?",
+                        "offsets.json",
+                        re.sub(img_dir, offsets_path, img_url),
+                    )
+                ),
             ),
             str(
                 re.sub(
@@ -142,7 +156,7 @@ class AbstractImagingViewConfBuilder(ViewConfBuilder):
         img_url, offsets_url, metadata_url = self._get_img_and_offset_url(
             filtered_images[0], self.seg_image_pyramid_regex
         )
-        seg_meta_data = get_image_metadata(self, metadata_url)
+        seg_meta_data = get_image_metadata(self, metadata_url, img_url)
 
         scale = get_image_scale(self.base_image_metadata, seg_meta_data)
         if dataset is not None:
@@ -297,20 +311,60 @@ class AbstractImagingViewConfBuilder(ViewConfBuilder):
             scope_prefix=get_initial_coordination_scope_prefix("A", "obsSegmentations"),
         )
 
-    def get_conf_cells_common(self, get_img_and_offset_url_func, **kwargs):
-        file_paths_found = self._get_file_paths()
-        found_images = get_found_images(self.image_pyramid_regex, file_paths_found)
-        found_images = sorted(found_images)
+    def _found_images(self):
+        image_pattern = self.image_pyramid_regex + r".*\.ome\.tiff?$"
+        found_images = sorted(get_found_images(self.image_pyramid_regex, self._get_file_paths(image_pattern)))
         if len(found_images) == 0:  # pragma: no cover
             message = f"Image pyramid assay with uuid {self._uuid} has no matching files"
             raise FileNotFoundError(message)
+        return found_images
+
+    def _pages(self):
+        found_images = self._found_images()
+        if self.view_type != BASE_IMAGE_VIEW_TYPE:
+            # Segmentation views show only the first image, so there is only ever one page.
+            return [found_images[:1]]
+        size = self._image_page_size or len(found_images)
+        return [found_images[start : start + size] for start in range(0, len(found_images), size)]
+
+    def image_pages(self):
+        """The names of the images on each page of the conf, without building it.
+
+        >>> files = [{"rel_path": f"ometiff-pyramids/{name}.ome.tif"} for name in "abc"]
+        >>> builder = ImagePyramidViewConfBuilder(
+        ...   entity={"uuid": "uuid", "files": files},
+        ...   groups_token='groups_token',
+        ...   assets_endpoint='https://example.com',
+        ...   image_page_size=2)
+        >>> builder.image_pages()
+        [['a.ome.tif', 'b.ome.tif'], ['c.ome.tif']]
+        """
+        return [[Path(img_path).name for img_path in page] for page in self._pages()]
+
+    def get_conf_cells_common(self, get_img_and_offset_url_func, page=0, **kwargs):
+        pages = self._pages()
+        if not 0 <= page < len(pages):
+            raise ValueError(f"Image pyramid assay with uuid {self._uuid} has no page {page} of images")
+        self.image_page_index = (
+            {
+                "page": page,
+                "pageSize": self._image_page_size,
+                "pages": [[Path(img_path).name for img_path in images] for images in pages],
+            }
+            if len(pages) > 1
+            else None
+        )
+        found_images = pages[page]
+
+        if self.view_type == BASE_IMAGE_VIEW_TYPE:
+            return get_conf_cells(self._emit_base_image_conf(found_images, get_img_and_offset_url_func))
 
         vc = VitessceConfig(name="HuBMAP Data Portal", schema_version=self._schema_version)
         dataset = vc.add_dataset(name="Visualization Files")
 
         if "seg" in self.view_type:
             img_url, offsets_url, metadata_url = get_img_and_offset_url_func(found_images[0], self.image_pyramid_regex)
-            meta_data = get_image_metadata(self, metadata_url)
+            meta_data = get_image_metadata(self, metadata_url, img_url)
             self.base_image_metadata = meta_data
             if self.view_type == GEOMX_IMAGE_VIEW_TYPE:
                 dataset = dataset.add_object(
@@ -332,26 +386,38 @@ class AbstractImagingViewConfBuilder(ViewConfBuilder):
             if self.view_type in [KAGGLE_IMAGE_VIEW_TYPE, GEOMX_IMAGE_VIEW_TYPE]:
                 self._add_segmentation_image(dataset)
 
-        else:
-            images = [
-                OmeTiffWrapper(
-                    img_url=img_url,
-                    offsets_url=offsets_url,
-                    name=Path(img_path).name,
-                )
-                for img_path in found_images
-                for img_url, offsets_url, _ in [get_img_and_offset_url_func(img_path, self.image_pyramid_regex)]
-            ]
-            dataset.add_object(MultiImageWrapper(images, use_physical_size_scaling=self.use_physical_size_scaling))
-
         if self.view_type == GEOMX_IMAGE_VIEW_TYPE:
             self._add_aoi_rois(dataset)
-        conf = self._setup_view_config(
-            vc, dataset, self.view_type, use_full_resolution=self.use_full_resolution
-        ).to_dict()
-        if self.view_type == BASE_IMAGE_VIEW_TYPE:
-            del conf["datasets"][0]["files"][0]["options"]["renderLayers"]
-        return get_conf_cells(conf)
+        vc = self._setup_view_config(vc, dataset, self.view_type, use_full_resolution=self.use_full_resolution)
+        self.base_vitessce_config = vc
+        return get_conf_cells(vc)
+
+    def _emit_base_image_conf(self, found_images, get_img_and_offset_url_func):
+        """The conf that ``_setup_view_config`` gives for a ``MultiImageWrapper`` of the images,
+        without ``renderLayers``, emitted directly rather than through ``VitessceConfig``.
+        """
+        emitter = ConfEmitter(name="HuBMAP Data Portal", schema_version=self._schema_version)
+        dataset = emitter.add_dataset(name="Visualization Files")
+        images = [
+            (Path(img_path).name, img_url, offsets_url)
+            for img_path in found_images
+            for img_url, offsets_url, _ in [get_img_and_offset_url_func(img_path, self.image_pyramid_regex)]
+        ]
+        emitter.add_raster_images(dataset, images, use_physical_size_scaling=self.use_physical_size_scaling)
+        emitter.add_view(
+            cm.SPATIAL, dataset, x=3, y=0, w=9, h=12, props={"useFullResolutionImage": self.use_full_resolution}
+        )
+        emitter.add_view(cm.DESCRIPTION, dataset, x=0, y=8, w=3, h=4)
+        emitter.add_view(
+            cm.LAYER_CONTROLLER,
+            dataset,
+            x=0,
+            y=0,
+            w=3,
+            h=8,
+            props={"disable3d": [], "disableChannelsIfRgbDetected": True},
+        )
+        return emitter.to_dict()
 
 
 class ImagePyramidViewConfBuilder(AbstractImagingViewConfBuilder):
@@ -403,9 +469,8 @@ class KaggleSegImagePyramidViewConfBuilder(AbstractImagingViewConfBuilder):
         image_dir = SEGMENTATION_SUPPORT_IMAGE_SUBDIR
         file_paths_found = self._get_file_paths()
         paths = get_found_images_all(file_paths_found)
-        matched_dirs = {dir for dir in base_image_dirs if any(dir in img for img in paths)}
-
-        image_dir = next(iter(matched_dirs), image_dir)
+        # The first match in the order of base_image_dirs, so the choice does not depend on set order.
+        image_dir = next((dir for dir in base_image_dirs if any(dir in img for img in paths)), image_dir)
 
         self.image_pyramid_regex = f"{IMAGE_PYRAMID_DIR}/{image_dir}"
 
@@ -456,9 +521,7 @@ class NanoDESIViewConfBuilder(ImagePyramidViewConfBuilder):
     def __init__(self, entity, groups_token, assets_endpoint, **kwargs):
         super().__init__(entity, groups_token, assets_endpoint, **kwargs)
         # Do not show full pyramid - does not look good
-        image_names = [
-            Path(file["rel_path"]).name for file in self._entity["files"] if not file["rel_path"].endswith("json")
-        ]
+        image_names = [Path(path).name for path in self._get_file_paths() if not path.endswith("json")]
         self.use_full_resolution = image_names
         self.use_physical_size_scaling = True
 
@@ -469,44 +532,52 @@ class SeqFISHViewConfBuilder(AbstractImagingViewConfBuilder):
     grouped together per position in a single Vitessce configuration.
     """
 
+    # The position and hybridization cycle of an image, read in one search.
+    image_regex = re.compile(
+        f"{IMAGE_PYRAMID_DIR}/(?P<hybcycle>{SEQFISH_HYB_CYCLE_REGEX})/(?P<file_name>{SEQFISH_FILE_REGEX})"
+    )
+
+    def _images_by_position(self, file_paths):
+        """Group the images in file_paths by position, in one pass over them.
+        Positions are sorted by file name, and each position's images by hybridization cycle.
+
+        >>> builder = SeqFISHViewConfBuilder(entity={"uuid": "uuid"}, groups_token='groups_token',
+        ...   assets_endpoint='https://example.com')
+        >>> builder._images_by_position([
+        ...   "ometiff-pyramids/HybCycle_1/MMStack_Pos1.ome.tif",
+        ...   "ometiff-pyramids/HybCycle_0/MMStack_Pos1.ome.tif",
+        ...   "ometiff-pyramids/final_mRNA_background/MMStack_Pos0.ome.tif",
+        ...   "ometiff-pyramids/HybCycle_0/other.ome.tif"])
+        [('MMStack_Pos0', [('final_mRNA_background', 'ometiff-pyramids/final_mRNA_background/MMStack_Pos0.ome.tif')]), ('MMStack_Pos1', [('HybCycle_0', 'ometiff-pyramids/HybCycle_0/MMStack_Pos1.ome.tif'), ('HybCycle_1', 'ometiff-pyramids/HybCycle_1/MMStack_Pos1.ome.tif')])]
+        """
+        positions = defaultdict(set)
+        for path in file_paths:
+            match = self.image_regex.search(path)
+            if match:
+                positions[match["file_name"]].add((match["hybcycle"], match[0]))
+        return [(file_name.split(".")[0], sorted(images)) for file_name, images in sorted(positions.items())]
+
+    def _get_position_conf(self, pos_name, images):
+        vc = VitessceConfig(name=pos_name, schema_version=self._schema_version)
+        dataset = vc.add_dataset(name=pos_name)
+        image_wrappers = []
+        for hybcycle, img_path in images:
+            img_url, offsets_url, _ = self._get_img_and_offset_url(img_path, IMAGE_PYRAMID_DIR)
+            image_wrappers.append(OmeTiffWrapper(img_url=img_url, offsets_url=offsets_url, name=hybcycle))
+        dataset = dataset.add_object(MultiImageWrapper(image_wrappers))
+        vc = self._setup_view_config(vc, dataset, self.view_type, disable_3d=[hybcycle for hybcycle, _ in images])
+        conf = vc.to_dict()
+        # Don't want to render all layers
+        del conf["datasets"][0]["files"][0]["options"]["renderLayers"]
+        return conf
+
     def get_conf_cells(self, **kwargs):
-        file_paths_found = [file["rel_path"] for file in self._entity["files"]]
-        full_seqfish_regex = "/".join([IMAGE_PYRAMID_DIR, SEQFISH_HYB_CYCLE_REGEX, SEQFISH_FILE_REGEX])
-        found_images = get_matches(file_paths_found, full_seqfish_regex)
-        if len(found_images) == 0:
+        images_by_pos = self._images_by_position(self._get_file_paths())
+        if len(images_by_pos) == 0:
             message = f"seqFish assay with uuid {self._uuid} has no matching files"
             raise FileNotFoundError(message)
-        # Get all files grouped by PosN names.
-        images_by_pos = group_by_file_name(found_images)
-        confs = []
+        confs = self._new_conf_list()
         # Build up a conf for each Pos.
-        for images in images_by_pos:
-            image_wrappers = []
-            pos_name = self._get_pos_name(images[0])
-            vc = VitessceConfig(name=pos_name, schema_version=self._schema_version)
-            dataset = vc.add_dataset(name=pos_name)
-            sorted_images = sorted(images, key=self._get_hybcycle)
-            for img_path in sorted_images:
-                img_url, offsets_url, _ = self._get_img_and_offset_url(img_path, IMAGE_PYRAMID_DIR)
-                image_wrappers.append(
-                    OmeTiffWrapper(
-                        img_url=img_url,
-                        offsets_url=offsets_url,
-                        name=self._get_hybcycle(img_path),
-                    )
-                )
-            dataset = dataset.add_object(MultiImageWrapper(image_wrappers))
-            vc = self._setup_view_config(
-                vc, dataset, self.view_type, disable_3d=[self._get_hybcycle(img_path) for img_path in sorted_images]
-            )
-            conf = vc.to_dict()
-            # Don't want to render all layers
-            del conf["datasets"][0]["files"][0]["options"]["renderLayers"]
-            confs.append(conf)
+        for pos_name, images in images_by_pos:
+            confs.append(self._get_position_conf(pos_name, images))
         return get_conf_cells(confs)
-
-    def _get_hybcycle(self, image_path):
-        return re.search(SEQFISH_HYB_CYCLE_REGEX, image_path)[0]
-
-    def _get_pos_name(self, image_path):
-        return re.search(SEQFISH_FILE_REGEX, image_path)[0].split(".")[0]
@@ -59,9 +59,7 @@ class ObjectByAnalyteConfBuilder(ViewConfBuilder):
         for file in files:
             if file.endswith("secondary_analysis_metadata.json"):
                 url = super()._build_assets_url(file)
-                import requests
-
-                resp = requests.get(url)
+                resp = self._resolver.get(url)
                 resp.raise_for_status()
                 json = resp.json()
                 if json:
@@ -85,7 +83,7 @@ class ObjectByAnalyteConfBuilder(ViewConfBuilder):
     @cached_property
     def zarr_store(self):  # pragma: no cover
         request_init = self._get_request_init() or {}
-        return read_zip_zarr(self._zarr_path, request_init)
+        return read_zip_zarr(self._zarr_path, request_init, self._resolver)
 
     @cached_property
     def _get_modalities(self):
@@ -1,13 +1,13 @@
+import re
+
 from vitessce import (
     Component as cm,
 )
 from vitessce import (
     FileType as ft,
 )
-from vitessce import (
-    VitessceConfig,
-)
 
+from ..conf_emitter import ConfEmitter
 from ..paths import SCATAC_SEQ_DIR, SCRNA_SEQ_DIR
 from ..utils import create_coordination_values, get_conf_cells
 from .base_builders import ViewConfBuilder
@@ -22,7 +22,7 @@ class AbstractScatterplotViewConfBuilder(ViewConfBuilder):
 
     def get_conf_cells(self, **kwargs):
         file_paths_expected = [file["rel_path"] for file in self._files]
-        file_paths_found = self._get_file_paths()
+        file_paths_found = self._get_file_paths("^(" + "|".join(map(re.escape, file_paths_expected)) + ")$")
         # We need to check that the files we expect actually exist.
         # This is due to the volatility of the datasets.
         if not set(file_paths_expected).issubset(set(file_paths_found)):
@@ -31,18 +31,18 @@ class AbstractScatterplotViewConfBuilder(ViewConfBuilder):
                 f"Expected: {file_paths_expected}; Found: {file_paths_found}"
             )
             raise FileNotFoundError(message)
-        vc = VitessceConfig(name="HuBMAP Data Portal", schema_version=self._schema_version)
-        dataset = vc.add_dataset(name="Visualization Files")
+        # The layout is fixed, so the conf is emitted directly rather than through VitessceConfig.
+        emitter = ConfEmitter(name="HuBMAP Data Portal", schema_version=self._schema_version)
+        dataset = emitter.add_dataset(name="Visualization Files")
         # The sublcass initializes _files in its __init__ method
         for file in self._files:
-            dataset = dataset.add_file(**(self._replace_url_in_file(file)))
-        vc = self._setup_scatterplot_view_config(vc, dataset)
-        return get_conf_cells(vc)
+            emitter.add_file(dataset, **(self._replace_url_in_file(file)))
+        self._setup_scatterplot_view_config(emitter, dataset)
+        return get_conf_cells(emitter.to_dict())
 
-    def _setup_scatterplot_view_config(self, vc, dataset):
-        vc.add_view(cm.SCATTERPLOT, dataset=dataset, mapping="UMAP", x=0, y=0, w=9, h=12)
-        vc.add_view(cm.OBS_SETS, dataset=dataset, x=9, y=0, w=3, h=12)
-        return vc
+    def _setup_scatterplot_view_config(self, emitter, dataset):
+        emitter.add_view(cm.SCATTERPLOT, dataset, mapping="UMAP", x=0, y=0, w=9, h=12)
+        emitter.add_view(cm.OBS_SETS, dataset, x=9, y=0, w=3, h=12)
 
 
 class RNASeqViewConfBuilder(AbstractScatterplotViewConfBuilder):
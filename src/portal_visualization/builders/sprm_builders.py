@@ -1,7 +1,6 @@
 import re
 from pathlib import Path
 
-import zarr
 from vitessce import (
     AnnDataWrapper,
     CoordinationType,
@@ -174,12 +173,12 @@ class SPRMAnnDataViewConfBuilder(SPRMViewConfBuilder):
         if self._is_zarr_zip:  # pragma: no cover
             adata_url = self._build_assets_url(zip_zarr_path, use_token=True)
             try:
-                return read_zip_zarr(adata_url, request_init)
+                return read_zip_zarr(adata_url, request_init, self._resolver)
             except Exception as e:
                 print(f"Error opening the zip zarr file. {e}")
         else:
             adata_url = self._build_assets_url(zarr_path, use_token=False)
-            return zarr.open(adata_url, mode="r", storage_options={"client_kwargs": request_init})
+            return self._resolver.open_zarr(adata_url, request_init)
 
     def _get_bitmask_image_path(self):
         return f"{self._mask_path_regex}/{self._mask_name}" + r"\.ome\.tiff?"
@@ -280,7 +279,7 @@ class MultiImageSPRMAnndataViewConfBuilder(ViewConfBuilder):
         """Search the image pyramid directory for all of the names of OME-TIFF files
         to use as unique identifiers.
         """
-        file_paths_found = [file["rel_path"] for file in self._entity["files"]]
+        file_paths_found = self._get_file_paths()
         full_pyramid_path = IMAGE_PYRAMID_DIR + "/" + self._image_pyramid_subdir
         pyramid_files = [file for file in file_paths_found if full_pyramid_path in file]
         found_ids = [
@@ -296,12 +295,14 @@ class MultiImageSPRMAnndataViewConfBuilder(ViewConfBuilder):
 
     def get_conf_cells(self, marker=None):
         found_ids = self._find_ids()
-        confs = []
+        confs = self._new_conf_list()
         for id in sorted(found_ids):
             builder = SPRMAnnDataViewConfBuilder(
                 entity=self._entity,
                 groups_token=self._groups_token,
                 assets_endpoint=self._assets_endpoint,
+                asset_resolver=self._assets,
+                offsets_service=self._offsets_service,
                 base_name=id,
                 imaging_path=self._image_pyramid_subdir,
                 mask_path=self._mask_pyramid_subdir,
@@ -309,6 +310,7 @@ class MultiImageSPRMAnndataViewConfBuilder(ViewConfBuilder):
                 mask_name=f"{id}_{self._mask_id}",
             )
             conf = builder.get_conf_cells(marker=marker).conf
+            self.dependencies.update(builder.dependencies)
             if conf == {}:
                 raise MultiImageSPRMAnndataViewConfigError(  # pragma: no cover
                     f"Cytokit SPRM assay with uuid {self._uuid} has empty view\
@@ -344,21 +346,24 @@ class TiledSPRMViewConfBuilder(ViewConfBuilder):
     """
 
     def get_conf_cells(self, **kwargs):
-        file_paths_found = [file["rel_path"] for file in self._entity["files"]]
+        file_paths_found = self._get_file_paths()
         found_tiles = get_matches(file_paths_found, TILE_REGEX) or get_matches(file_paths_found, STITCHED_REGEX)
         if len(found_tiles) == 0:  # pragma: no cover
             message = f"Cytokit SPRM assay with uuid {self._uuid} has no matching tiles"
             raise FileNotFoundError(message)
-        confs = []
+        confs = self._new_conf_list()
         for tile in sorted(found_tiles):
             builder = SPRMJSONViewConfBuilder(
                 entity=self._entity,
                 groups_token=self._groups_token,
                 assets_endpoint=self._assets_endpoint,
+                asset_resolver=self._assets,
+                offsets_service=self._offsets_service,
                 base_name=tile,
                 imaging_path=CODEX_TILE_DIR,
             )
             conf = builder.get_conf_cells().conf
+            self.dependencies.update(builder.dependencies)
             if conf == {}:  # pragma: no cover
                 message = f"Cytokit SPRM assay with uuid {self._uuid} has empty view config"
                 raise CytokitSPRMViewConfigError(message)
@@ -0,0 +1,512 @@
+"""Small caches shared by the asset readers.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from pathlib import Path
+
+_MISSING = object()
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache, optionally backed by disk.
+
+    Entries live in memory until more than ``max_entries`` are held, or their
+    total ``sizeof`` exceeds ``max_bytes``, when the least recently used are
+    dropped. If ``cache_dir`` is given, entries are also pickled there: every
+    entry as it is set, or with ``spill``, only those evicted from memory.
+    Keys must have a stable ``repr``; values must be picklable if persisted.
+
+    >>> cache = LRUCache(max_entries=2)
+    >>> cache.set("a", 1)
+    >>> cache.set("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.set("c", 3)
+    >>> "b" in cache, cache.get("c")
+    (False, 3)
+    >>> cache.get("b", "default")
+    'default'
+    >>> cache.stats
+    {'entries': 2, 'bytes': 0, 'hits': 2, 'misses': 1, 'hit_ratio': 0.667}
+
+    >>> blocks = LRUCache(max_entries=None, max_bytes=8, sizeof=len)
+    >>> blocks.set(0, b"12345")
+    >>> blocks.set(1, b"67890")
+    >>> 0 in blocks, blocks.stats["bytes"]
+    (False, 5)
+
+    :param int max_entries: Maximum number of entries to hold in memory, or None for no limit
+    :param int max_bytes: Maximum total size of the entries held in memory, or None for no limit
+    :param str cache_dir: Optional directory in which to persist entries
+    :param bool spill: Only persist entries when they are evicted from memory
+    :param sizeof: Function giving the size of a value; required with max_bytes
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, cache_dir=None, spill=False, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.spill = spill
+        self._sizeof = sizeof or (lambda value: 0)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self._path(key) is not None and self._path(key).is_file()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or default if there is none."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        value = self._load(key)
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            evicted = self._remember(key, value)
+        self._spill(evicted)
+        return value
+
+    def set(self, key, value):
+        """Cache value under key, persisting it if the cache has a directory."""
+        with self._lock:
+            evicted = self._remember(key, value)
+        if not self.spill:
+            self._dump(key, value)
+        self._spill(evicted)
+
+    def clear(self):
+        """Drop every entry held in memory. Persisted entries are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+    def _remember(self, key, value):
+        """Store value in memory, returning the (key, value) pairs evicted to make room."""
+        if key in self._entries:
+            self._bytes -= self._sizeof(self._entries[key])
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._bytes += self._sizeof(value)
+        evicted = []
+        while len(self._entries) > 1 and self._over_budget():
+            old_key, old_value = self._entries.popitem(last=False)
+            self._bytes -= self._sizeof(old_value)
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def _over_budget(self):
+        return (self.max_entries is not None and len(self._entries) > self.max_entries) or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        )
+
+    def _spill(self, evicted):
+        if self.spill:
+            for key, value in evicted:
+                self._dump(key, value)
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return self.cache_dir / f"{digest}.pickle"
+
+    def _load(self, key):
+        path = self._path(key)
+        if path is None or not path.is_file():
+            return _MISSING
+        try:
+            stored_key, value = pickle.loads(path.read_bytes())
+        except Exception:
+            # A partial or stale file is just a miss.
+            return _MISSING
+        return value if stored_key == key else _MISSING
+
+    def _dump(self, key, value):
+        path = self._path(key)
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial file.
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((key, value), f)
+        os.replace(tmp_name, path)
+
+
+class BlockCache:
+    """Fixed-size blocks of remote files, and small objects from remote stores,
+    shared across opens and held within a memory budget.
+
+    Every key passed in should include a validator for the remote content,
+    such as its ETag, so that stale blocks are never returned once it changes.
+    Besides its bytes, every entry is charged ``entry_cost`` against the budget, for its
+    key and bookkeeping, so that many small or empty entries cannot grow without bound:
+
+    >>> cache = BlockCache(max_bytes=1000, entry_cost=100)
+    >>> cache.set("a", b"12345")
+    >>> cache.set("b", None)
+    >>> cache.stats["bytes"]
+    205
+
+    :param int block_size: Size in bytes of the blocks read from remote files
+    :param int max_bytes: Memory budget for cached blocks
+    :param str cache_dir: Optional directory to which blocks evicted from memory are spilled
+    :param int entry_cost: Bytes charged for each entry, on top of its value
+    """
+
+    def __init__(self, block_size=2**16, max_bytes=2**27, cache_dir=None, entry_cost=256):
+        self.block_size = block_size
+        self._cache = LRUCache(
+            max_entries=None,
+            max_bytes=max_bytes,
+            cache_dir=cache_dir,
+            spill=True,
+            sizeof=lambda value: entry_cost + (len(value) if value is not None else 0),
+        )
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+    def read_range(self, fetch, key, size, start, end):
+        """Return bytes start to end of a file, reading whole blocks through the cache.
+        Runs of consecutive missing blocks are fetched with a single range request.
+
+        >>> data = bytes(range(100))
+        >>> requests = []
+        >>> def fetch(start, end):
+        ...     requests.append((start, end))
+        ...     return data[start:end]
+        >>> cache = BlockCache(block_size=16)
+        >>> cache.read_range(fetch, "key", len(data), 10, 40) == data[10:40]
+        True
+        >>> cache.read_range(fetch, "key", len(data), 20, 60) == data[20:60]
+        True
+        >>> requests
+        [(0, 48), (48, 64)]
+
+        :param fetch: Function reading bytes start to end of the remote file
+        :param key: Identifies the file, including its validator
+        :param int size: Size of the file
+        """
+        end = min(end, size)
+        if start >= end:
+            return b""
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        blocks = {index: self.get((key, index)) for index in range(first, last + 1)}
+        missing = [index for index, block in blocks.items() if block is None]
+        while missing:
+            run_start = run_end = missing.pop(0)
+            while missing and missing[0] == run_end + 1:
+                run_end = missing.pop(0)
+            data = fetch(run_start * self.block_size, min(size, (run_end + 1) * self.block_size))
+            for index in range(run_start, run_end + 1):
+                offset = (index - run_start) * self.block_size
+                blocks[index] = data[offset : offset + self.block_size]
+                self.set((key, index), blocks[index])
+        data = b"".join(blocks[index] for index in range(first, last + 1))
+        offset = first * self.block_size
+        return data[start - offset : end - offset]
+
+
+class BlockCachedFile(io.RawIOBase):
+    """A seekable, read-only file over a remote file, read through a ``BlockCache``.
+
+    >>> data = b"0123456789" * 10
+    >>> file = BlockCachedFile(lambda start, end: data[start:end], "key", len(data), BlockCache(block_size=16))
+    >>> _ = file.seek(-5, io.SEEK_END)
+    >>> file.read()
+    b'56789'
+    >>> _ = file.seek(12)
+    >>> file.read(4), file.tell()
+    (b'2345', 16)
+
+    :param fetch: Function reading bytes start to end of the remote file
+    :param key: Identifies the file, including its validator; if None, nothing is cached
+    :param int size: Size of the file
+    :param BlockCache blocks: Where blocks are cached
+    """
+
+    def __init__(self, fetch, key, size, blocks):
+        super().__init__()
+        self._fetch = fetch
+        self._key = key
+        self._size = size
+        self._blocks = blocks
+        self._position = 0
+
+    @property
+    def key(self):
+        """What the file's blocks are cached under."""
+        return self._key
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def readinto(self, buffer):
+        end = min(self._size, self._position + len(buffer))
+        if self._key is None:
+            data = self._fetch(self._position, end) if end > self._position else b""
+        else:
+            data = self._blocks.read_range(self._fetch, self._key, self._size, self._position, end)
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+_ABSENT = object()
+
+
+class CachedStore(MutableMapping):
+    """A read-only view of a zarr store whose objects are cached in a ``BlockCache``.
+
+    Each object is cached against its own validator, such as its ETag, so regenerating
+    any part of the store is noticed, even where its root metadata is unchanged.
+    Objects not cached are read straight through, with the validator of the response,
+    so a first open costs one request per object. Only objects cached by an earlier open
+    are validated, which is cheaper than reading them again. Either is done at most once
+    per object per ``CachedStore``, i.e. per open of the store. Objects without a validator
+    are never cached.
+
+    >>> store = {".zgroup": b"{}"}
+    >>> etags = {".zgroup": "etag"}
+    >>> requests = []
+    >>> def validators(keys):
+    ...     requests.append(("HEAD", keys))
+    ...     return {key: etags.get(key) for key in keys if key in store}
+    >>> def read(keys):
+    ...     requests.append(("GET", keys))
+    ...     return {key: (store[key], etags.get(key)) for key in keys if key in store}
+    >>> cached = CachedStore(store, "key", BlockCache(), validators, read)
+    >>> cached[".zgroup"], ".zarray" in cached, requests
+    (b'{}', False, [('GET', ['.zgroup']), ('GET', ['.zarray'])])
+    >>> store[".zgroup"] = b'{"zarr_format": 2}'
+    >>> cached[".zgroup"]
+    b'{}'
+    >>> etags[".zgroup"] = "new-etag"
+    >>> CachedStore(store, "key", cached.blocks, validators, read)[".zgroup"]
+    b'{"zarr_format": 2}'
+
+    Keys read together with ``getitems``, as zarr reads chunks, are validated together,
+    and those not cached are read in one batch:
+
+    >>> store.update({"a": b"1", "b": b"2"})
+    >>> etags["a"] = "etag"
+    >>> cached = CachedStore(store, "key", cached.blocks, validators, read)
+    >>> requests.clear()
+    >>> cached.getitems([".zgroup", "a", "b", "c"])
+    {'.zgroup': b'{"zarr_format": 2}', 'a': b'1', 'b': b'2'}
+    >>> requests
+    [('HEAD', ['.zgroup']), ('GET', ['a', 'b', 'c'])]
+
+    :param store: The underlying mapping, e.g. a zarr ``FSStore``
+    :param key: Identifies the store, e.g. its URL
+    :param BlockCache blocks: Where objects are cached
+    :param validators: Function taking a list of keys, and returning the validator, or None,
+        of each of them which is in the store
+    :param read: Function taking a list of keys, and returning the value and the validator, or None,
+        of each of them which is in the store; by default values are read from store, without validators
+    """
+
+    def __init__(self, store, key, blocks, validators, read=None):
+        self.store = store
+        self.blocks = blocks
+        self._key = key
+        self._validators_of = validators
+        self._read = read or self._read_store
+        # Validators known to be current in this open, or _ABSENT for objects not in the store.
+        self._current = {}
+        # Objects read by a membership test, without a validator to cache them by, until they are read.
+        self._unvalidated = {}
+
+    def __contains__(self, key):
+        found = self._get([key])
+        if key in found and self._current.get(key) is None:
+            self._unvalidated[key] = found[key]
+        return key in found
+
+    def __getitem__(self, key):
+        found = self._get([key])
+        if key not in found:
+            raise KeyError(key)
+        return found[key]
+
+    def getitems(self, keys, *, contexts=None):
+        return self._get(keys)
+
+    def _get(self, keys):
+        """Return the objects of keys which are in the store, validating those cached by an earlier open,
+        and reading the rest."""
+        stale = [key for key in keys if key not in self._current and self.blocks.get((self._key, key)) is not None]
+        if stale:
+            current = self._validators_of(stale)
+            for key in stale:
+                self._current[key] = current.get(key, _ABSENT)
+        found = {}
+        unread = []
+        for key in keys:
+            validator = self._current.get(key)
+            if validator is _ABSENT:
+                continue
+            if key in self._unvalidated:
+                found[key] = self._unvalidated.pop(key)
+                continue
+            value = _ABSENT if validator is None else self.blocks.get((self._key, key, validator), _ABSENT)
+            if value is _ABSENT:
+                unread.append(key)
+            else:
+                found[key] = value
+        if unread:
+            read = self._read(unread)
+            for key in unread:
+                value, validator = read.get(key, (_ABSENT, _ABSENT))
+                self._current[key] = validator
+                if value is _ABSENT:
+                    continue
+                found[key] = value
+                if validator is not None:
+                    self.blocks.set((self._key, key), validator)
+                    self.blocks.set((self._key, key, validator), value)
+        return found
+
+    def _read_store(self, keys):
+        getitems = getattr(self.store, "getitems", None)
+        if getitems is None:
+            # A plain mapping has no batched read.
+            found = {key: self.store[key] for key in keys if key in self.store}
+        else:
+            found = getitems(keys, contexts={})
+        return {key: (value, None) for key, value in found.items()}
+
+    def __setitem__(self, key, value):
+        raise PermissionError("CachedStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("CachedStore is read-only")
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+class RevalidatingCache:
+    """Response bodies cached with their validators, and refreshed with conditional GETs.
+
+    Every fetch goes to the server, but when a body is already cached the request
+    carries ``If-None-Match`` / ``If-Modified-Since``; a ``304 Not Modified`` reply
+    is then filled in with the cached body and returned as a 200. Since the server
+    is always asked, entries can be kept indefinitely and shared between users:
+    URLs are keyed without their query string, which only carries the token.
+
+    >>> class Response:  # Stands in for requests.Response
+    ...     def __init__(self, status_code, headers, body):
+    ...         self.status_code, self.headers, self._content, self.encoding = status_code, headers, body, None
+    ...     content = property(lambda self: self._content)
+    >>> def get(url, headers=None):
+    ...     if headers.get("If-None-Match") == '"v1"':
+    ...         return Response(304, {}, b"")
+    ...     return Response(200, {"ETag": '"v1"'}, b"body")
+    >>> cache = RevalidatingCache()
+    >>> cache.fetch(get, "https://example.com/a.json?token=x").content
+    b'body'
+    >>> response = cache.fetch(get, "https://example.com/a.json?token=y")
+    >>> response.status_code, response.content
+    (200, b'body')
+    >>> cache.stats["revalidated"]
+    1
+
+    :param int max_entries: Maximum number of bodies to hold in memory
+    :param str cache_dir: Optional directory in which to persist bodies
+    """
+
+    def __init__(self, max_entries=512, cache_dir=None):
+        self._cache = LRUCache(max_entries=max_entries, cache_dir=cache_dir)
+        self.revalidated = 0
+
+    def fetch(self, get, url, headers=None, **kwargs):
+        """Call ``get(url, headers=headers, **kwargs)``, revalidating any cached body.
+        :param get: Function making the request, e.g. ``requests.get``
+        """
+        key = url.split("?")[0]
+        cached = self._cache.get(key)
+        headers = dict(headers or {})
+        if cached is not None:
+            etag, last_modified, _, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        response = get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            self.revalidated += 1
+            _, _, response._content, response.encoding = cached
+            response.status_code = 200
+        elif response.status_code == 200:
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if etag or last_modified:
+                self._cache.set(key, (etag, last_modified, response.content, response.encoding))
+        return response
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def stats(self):
+        return {**self._cache.stats, "revalidated": self.revalidated}
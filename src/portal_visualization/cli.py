@@ -21,8 +21,11 @@ def main():  # pragma: no cover
     """
     # Import heavy dependencies only when CLI is actually run
     try:
+        from portal_visualization import serialization
+        from portal_visualization.assets import LocalAssetResolver
         from portal_visualization.builder_factory import get_view_config_builder
         from portal_visualization.epic_factory import get_epic_builder
+        from portal_visualization.manifest import generate_manifest
     except ImportError as e:
         print(
             "ERROR: The vis-preview CLI requires the [full] installation.\n"
@@ -46,6 +49,20 @@ def main():  # pragma: no cover
         help=f"Assets endpoint; default: {assets_default_url}",
         default=assets_default_url,
     )
+    parser.add_argument(
+        "--assets_mirror",
+        metavar="DIR",
+        type=Path,
+        help="Local mirror of the assets endpoint, laid out as DIR/uuid/rel_path; "
+        "Assets are read from here, but viewconf URLs are unchanged.",
+    )
+    parser.add_argument(
+        "--write_manifest",
+        metavar="FILE",
+        type=Path,
+        help="Also write a manifest of the assets read, to be stored as "
+        "hubmap_ui/visualization-manifest.json; With --assets_mirror, runs offline.",
+    )
     parser.add_argument("--token", help="Globus groups token; Only needed if data is not public", default="")
     parser.add_argument("--marker", help="Marker to highlight in visualization; Only used in some visualizations.")
     parser.add_argument("--to_json", action="store_true", help="Output viewconf, rather than open in browser.")
@@ -78,20 +95,38 @@ def main():  # pragma: no cover
 
     # conf = client.get_vitessce_conf_cells_and_lifted_uuid(entity, None, True, parent_uuid, epic_uuid).vitessce_conf
 
+    asset_resolver = LocalAssetResolver(args.assets_mirror, base_url=args.assets_url) if args.assets_mirror else None
+
     Builder = get_view_config_builder(entity, get_entity, parent_uuid, epic_uuid)
-    builder = Builder(entity, args.token, args.assets_url)
+    builder = Builder(entity, args.token, args.assets_url, asset_resolver=asset_resolver)
     print(f"Using: {builder.__class__.__name__}", file=stderr)
     conf_cells = builder.get_conf_cells(marker=marker)
 
+    if args.write_manifest:
+        manifest = generate_manifest(
+            Builder, entity, args.token, args.assets_url, asset_resolver, markers=[marker] if marker else []
+        )
+        args.write_manifest.write_text(json.dumps(manifest))
+        print(f"Wrote: {args.write_manifest}", file=stderr)
+
     if epic_uuid is not None and conf_cells is not None:  # pragma: no cover
         EpicBuilder = get_epic_builder(epic_uuid)
         epic_builder = EpicBuilder(
-            epic_uuid, conf_cells, entity, args.token, args.assets_url, builder.base_image_metadata
+            epic_uuid,
+            conf_cells,
+            entity,
+            args.token,
+            args.assets_url,
+            builder.base_image_metadata,
+            base_vitessce_config=getattr(builder, "base_vitessce_config", None),
+            asset_resolver=asset_resolver,
         )
         print(f"Using: {epic_builder.__class__.__name__}", file=stderr)
         conf_cells = epic_builder.get_conf_cells()
 
-    conf_as_json = json.dumps(conf_cells.conf[0]) if isinstance(conf_cells.conf, list) else json.dumps(conf_cells.conf)
+    conf_as_json = (
+        serialization.dumps(conf_cells.conf[0]) if isinstance(conf_cells.conf, list) else conf_cells.conf_bytes
+    ).decode()
 
     if args.to_json:
         print(conf_as_json)
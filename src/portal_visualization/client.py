@@ -9,9 +9,12 @@ import requests
 from flask import abort, current_app
 from werkzeug.exceptions import HTTPException
 
-from .builder_factory import get_view_config_builder
+from .builder_factory import get_entity_fields, get_view_config_builder
 from .builders.base_builders import ConfCells
+from .caching import RevalidatingCache
 from .epic_factory import get_epic_builder
+from .json_stream import JSONArrayStream
+from .policy import CircuitOpenError, get_policy
 from .utils import files_from_response
 
 Entity = namedtuple("Entity", ["uuid", "type", "name"], defaults=["TODO: name"])
@@ -39,14 +42,28 @@ def _get_hits(response_json):
     return inner_hits
 
 
-def _handle_request(url, headers=None, body_json=None):
+# Size of the chunks in which search responses redirected to S3 are read.
+_STREAM_CHUNK_SIZE = 2**16
+
+# Files from the assets server, e.g. publication_ancillary.json, are revalidated rather than refetched.
+_file_responses = RevalidatingCache()
+
+
+def _handle_request(url, headers=None, body_json=None, stream=False):
+    def send(timeout):
+        if body_json:
+            return requests.post(url, headers=headers, json=body_json, timeout=timeout)
+        return requests.get(url, headers=headers, stream=stream, timeout=timeout)
+
     try:
-        response = (
-            requests.post(url, headers=headers, json=body_json) if body_json else requests.get(url, headers=headers)
-        )
-    except requests.exceptions.ConnectTimeout as error:  # pragma: no cover
+        # Searches are POSTs, which are not retried.
+        response = get_policy(url).call(send, idempotent=not body_json)
+    except requests.exceptions.Timeout as error:
         current_app.logger.error(error)
         abort(504)
+    except CircuitOpenError as error:
+        current_app.logger.error(error)
+        abort(503)
     try:
         response.raise_for_status()
     except requests.exceptions.HTTPError as error:  # pragma: no cover
@@ -76,11 +93,17 @@ class ApiClient:
         soft_assay_endpoint=None,
         soft_assay_endpoint_path=None,
         entity_api_endpoint=None,
+        asset_resolver=None,
+        offsets_service=None,
     ):
         self.groups_token = groups_token
         self.ubkg_endpoint = ubkg_endpoint
         self.assets_endpoint = assets_endpoint
         self.entity_api_endpoint = entity_api_endpoint
+        # Optional AssetResolver passed to builders, e.g. to read from a local mirror.
+        self.asset_resolver = asset_resolver
+        # Optional OffsetsService, for image pyramids without an offsets.json.
+        self.offsets_service = offsets_service
 
         self._elasticsearch_endpoint = elasticsearch_endpoint
         self._portal_index_path = portal_index_path
@@ -91,6 +114,14 @@ class ApiClient:
         self.elasticsearch_url = f"{elasticsearch_endpoint}{portal_index_path}"
         self.soft_assay_url = f"{soft_assay_endpoint}/{soft_assay_endpoint_path}"
 
+    @property
+    def conf_entity_fields(self):
+        """
+        Entity fields needed by get_vitessce_conf_cells_and_lifted_uuid:
+        Those needed by the builders, and whether the entity has a visualization at all.
+        """
+        return [*get_entity_fields(), "visualization"]
+
     def _get_headers(self):
         headers = {"Authorization": "Bearer " + self.groups_token} if self.groups_token else {}
         return headers
@@ -113,6 +144,22 @@ class ApiClient:
             return json.loads(s3_resp)
         return response.json()
 
+    def _request_hits(self, url, body_json=None):
+        """
+        Like _request, but for search queries: returns the hits, and the response JSON.
+        If the response is redirected to S3, the body is streamed rather than read at once:
+        the hits are an iterator, parsed one at a time as they are read,
+        and the rest of the response JSON is filled in as parsing proceeds.
+        """
+        headers = self._get_headers()
+        response = _handle_request(url, headers, body_json)
+        if response.status_code in [303]:
+            s3_response = _handle_request(response.content, stream=True)
+            stream = JSONArrayStream(s3_response.iter_content(chunk_size=_STREAM_CHUNK_SIZE), ["hits", "hits"])
+            return stream, stream.document
+        response_json = response.json()
+        return _get_hits(response_json), response_json
+
     def get_all_dataset_uuids(self):
         size = 10000  # Default ES limit
         query = {
@@ -129,7 +176,34 @@ class ApiClient:
             raise Exception("At least 10k datasets: need to make multiple requests")
         return uuids
 
-    def get_entities(
+    def get_modified_datasets(self, since, fields=("uuid", "status", "last_modified_timestamp"), page_size=1000):
+        """
+        Yields the datasets modified after since, a timestamp in milliseconds, oldest first.
+        Pages are requested as they are consumed, using search_after, so there is no 10k limit.
+        """
+        query = {
+            "size": page_size,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"entity_type.keyword": "Dataset"}},
+                        {"range": {"last_modified_timestamp": {"gt": since}}},
+                    ]
+                }
+            },
+            # uuid breaks ties, so no dataset is skipped or repeated between pages.
+            "sort": [{"last_modified_timestamp": "asc"}, {"uuid.keyword": "asc"}],
+            "_source": list(fields),
+        }
+        while True:
+            hits = _get_hits(self._request(self.elasticsearch_url, body_json=query))
+            for hit in hits:
+                yield hit["_source"]
+            if len(hits) < page_size:
+                return
+            query["search_after"] = hits[-1]["sort"]
+
+    def iter_entities(
         self,
         plural_lc_entity_type=None,
         non_metadata_fields=[],
@@ -137,6 +211,11 @@ class ApiClient:
         uuids=[],
         query_override=None,
     ):
+        """
+        Yields the flattened metadata of the matching entities, one dict per entity, as the response is read.
+        Rows are not filled in, so keys missing from an entity are missing from its dict.
+        Once the last is yielded, raises if the response did not include every match.
+        """
         entity_type = plural_lc_entity_type[:-1].capitalize()
         query = {
             "size": 10000,  # Default ES limit,
@@ -147,16 +226,43 @@ class ApiClient:
                 "exclude": ["*.files"],
             },
         }
-        response_json = self._request(self.elasticsearch_url, body_json=query)
-        sources = [hit["_source"] for hit in _get_hits(response_json)]
+        hits, response_json = self._request_hits(self.elasticsearch_url, body_json=query)
+        n_rows = 0
+        # Each hit is flattened as it is read, so the raw hits are never all in memory.
+        for hit in hits:
+            yield _flatten_source(hit["_source"], non_metadata_fields)
+            n_rows += 1
         total_hits = response_json["hits"]["total"]["value"]
-        if len(sources) < total_hits:
+        if n_rows < total_hits:
             raise Exception("Incomplete results: need to make multiple requests")
-        flat_sources = _flatten_sources(sources, non_metadata_fields)
-        filled_flat_sources = _fill_sources(flat_sources)
-        return filled_flat_sources
 
-    def get_entity(self, uuid=None, hbm_id=None):
+    def get_entities(
+        self,
+        plural_lc_entity_type=None,
+        non_metadata_fields=[],
+        constraints={},
+        uuids=[],
+        query_override=None,
+        columnar=False,
+    ):
+        """
+        Returns the flattened metadata of the matching entities, as a list of dicts with the same keys;
+        or if columnar, as a dict of equal-length column lists, which avoids building a dict per row.
+        To handle one entity at a time instead, use iter_entities.
+        """
+        flat_sources = self.iter_entities(
+            plural_lc_entity_type, non_metadata_fields, constraints, uuids, query_override
+        )
+        if columnar:
+            return _columnar_sources(flat_sources)
+        return _fill_sources(list(flat_sources))
+
+    def get_entity(self, uuid=None, hbm_id=None, fields=None):
+        """
+        Returns the entity with the given UUID or HuBMAP ID.
+        If fields are given, only those are fetched; e.g. for conf generation,
+        pass builder_factory.get_entity_fields() to skip the rest of the document.
+        """
         if uuid is not None and hbm_id is not None:
             raise Exception("Only UUID or HBM ID should be provided, not both")
         query = {
@@ -166,6 +272,8 @@ class ApiClient:
             # With default mapping, without ".keyword", it splits into tokens,
             # and we get multiple substring matches, instead of unique match.
         }
+        if fields is not None:
+            query["_source"] = fields
 
         response_json = self._request(self.elasticsearch_url, body_json=query)
 
@@ -192,9 +300,12 @@ class ApiClient:
     ):
         """
         Returns a dataclass with vitessce_conf and is_lifted.
+        The entity needs at least the fields in conf_entity_fields.
         """
         vis_lifted_uuid = None  # default, only gets set if there is a vis-lifted entity
-        image_pyramid_descendants = self.get_descendant_to_lift(entity["uuid"])
+        image_pyramid_descendants = self.get_descendant_to_lift(
+            entity["uuid"], fields=[*self.conf_entity_fields, "metadata.files.rel_path"]
+        )
 
         # First, try "vis-lifting": Display image pyramids on their parent entity pages.
         # Historical context: the visualization requires pyramidal ome tiff images, which
@@ -232,11 +343,18 @@ class ApiClient:
 
                 def get_entity(entity):
                     if isinstance(entity, str):
-                        return self.get_entity(uuid=entity)
-                    return self.get_entity(uuid=entity.get("uuid"))
+                        return self.get_entity(uuid=entity, fields=self.conf_entity_fields)
+                    return self.get_entity(uuid=entity.get("uuid"), fields=self.conf_entity_fields)
 
                 Builder = get_view_config_builder(entity, get_entity, parent, epic_uuid)
-                builder = Builder(entity, self.groups_token, self.assets_endpoint, minimal=minimal)
+                builder = Builder(
+                    entity,
+                    self.groups_token,
+                    self.assets_endpoint,
+                    minimal=minimal,
+                    asset_resolver=self.asset_resolver,
+                    offsets_service=self.offsets_service,
+                )
                 vitessce_conf = builder.get_conf_cells(marker=marker)
             except Exception as e:
                 if not wrap_error:
@@ -247,7 +365,15 @@ class ApiClient:
         if epic_uuid is not None and vitessce_conf.conf is not None:  # pragma: no cover  # TODO
             EPICBuilder = get_epic_builder(epic_uuid)
             vitessce_conf = EPICBuilder(
-                epic_uuid, vitessce_conf, entity, self.groups_token, self.assets_endpoint, builder.base_image_metadata
+                epic_uuid,
+                vitessce_conf,
+                entity,
+                self.groups_token,
+                self.assets_endpoint,
+                builder.base_image_metadata,
+                base_vitessce_config=getattr(builder, "base_vitessce_config", None),
+                asset_resolver=self.asset_resolver,
+                offsets_service=self.offsets_service,
             ).get_conf_cells()
 
         return VitessceConfLiftedUUID(vitessce_conf=vitessce_conf, vis_lifted_uuid=vis_lifted_uuid)
@@ -258,13 +384,14 @@ class ApiClient:
         if self.groups_token:
             url += f"?token={self.groups_token}"
 
-        return _handle_request(url, headers).text
+        return _file_responses.fetch(_handle_request, url, headers=headers).text
 
-    def get_descendant_to_lift(self, uuid, is_publication=False):
+    def get_descendant_to_lift(self, uuid, is_publication=False, fields=None):
         """
         Given the data type of the descendant and a uuid,
         returns the doc of the most recent descendant
         that is in QA or Published status.
+        If fields are given, only those are fetched.
         """
 
         hints = [{"term": {"vitessce-hints": "is_support"}}]
@@ -284,6 +411,8 @@ class ApiClient:
             "sort": [{"last_modified_timestamp": {"order": "desc"}}],
             "size": 1,
         }
+        if fields is not None:
+            query["_source"] = fields
         response_json = self._request(
             self.elasticsearch_url,
             body_json=query,
@@ -305,7 +434,9 @@ class ApiClient:
         """
         publication_json = {}
         publication_ancillary_uuid = None
-        publication_ancillary_descendant = self.get_descendant_to_lift(entity["uuid"], is_publication=True)
+        publication_ancillary_descendant = self.get_descendant_to_lift(
+            entity["uuid"], is_publication=True, fields=["uuid"]
+        )
         if publication_ancillary_descendant:
             publication_ancillary_uuid = publication_ancillary_descendant["uuid"]
             publication_json_path = f"{self.assets_endpoint}/{publication_ancillary_uuid}/publication_ancillary.json"
@@ -412,39 +543,69 @@ def _flatten_sources(sources, non_metadata_fields):
     >>> pp(_flatten_sources(sample_sources, ['uuid', 'name']))
     [{'uuid': 'abcd1234', 'name': None, 'organ': 'belly button'}]
     """
-    flat_sources = [
-        {
-            **{field: _get_nested(field, source) for field in non_metadata_fields},
-            # This gets sample and donor metadata.
-            **source.get("metadata", {}),
-            # This gets donor metadata, and concatenates nested lists.
-            **{k: ", ".join(str(s) for s in v) for (k, v) in source.get("mapped_metadata", {}).items()},
-        }
-        for source in sources
-    ]
-    for source in flat_sources:
-        if "assay_type" in source.get("metadata", {}):
-            # For donors, this is the metadata in EAV form,
-            # for samples, this is a placeholder for dev-search,
-            # but for datasets, we want to move it up a level.
-            source.update(source["metadata"])  # pragma: no cover
-
-        for field in [
-            "metadata",
-            # From datasets JSON:
-            "dag_provenance_list",
-            "extra_metadata",
-            "files_info_alt_path",
-            # Dataset TSV columns to hide:
-            "antibodies_path",
-            "contributors_path",
-            "version",
-            # From samples:
-            "organ_donor_data",
-            "living_donor_data",
-        ]:
-            source.pop(field, None)  # pragma: no cover
-    return flat_sources
+    return [_flatten_source(source, non_metadata_fields) for source in sources]
+
+
+def _flatten_source(source, non_metadata_fields):
+    flat_source = {
+        **{field: _get_nested(field, source) for field in non_metadata_fields},
+        # This gets sample and donor metadata.
+        **source.get("metadata", {}),
+        # This gets donor metadata, and concatenates nested lists.
+        **{k: ", ".join(str(s) for s in v) for (k, v) in source.get("mapped_metadata", {}).items()},
+    }
+    if "assay_type" in flat_source.get("metadata", {}):
+        # For donors, this is the metadata in EAV form,
+        # for samples, this is a placeholder for dev-search,
+        # but for datasets, we want to move it up a level.
+        flat_source.update(flat_source["metadata"])  # pragma: no cover
+
+    for field in [
+        "metadata",
+        # From datasets JSON:
+        "dag_provenance_list",
+        "extra_metadata",
+        "files_info_alt_path",
+        # Dataset TSV columns to hide:
+        "antibodies_path",
+        "contributors_path",
+        "version",
+        # From samples:
+        "organ_donor_data",
+        "living_donor_data",
+    ]:
+        flat_source.pop(field, None)  # pragma: no cover
+    return flat_source
+
+
+def _columnar_sources(flat_sources):
+    """
+    Fills flattened sources like _fill_sources, but returns a dict of columns,
+    which can be passed directly to pandas.DataFrame.
+    Columns are built as sources are read, and padded only when a new column appears
+    and at the end, rather than back-filling every row.
+
+    >>> flat_sources = [{'uuid': 'abcd1234', 'age': '40'}, {'uuid': 'wxyz1234', 'organ': 'belly button'},
+    ...     {'uuid': 'efgh5678', 'age': '50'}]
+    >>> _columnar_sources(flat_sources)
+    {'uuid': ['abcd1234', 'wxyz1234', 'efgh5678'], 'age': ['40', '', '50'], 'organ': ['', 'belly button', '']}
+    >>> _columnar_sources([])
+    {}
+    """
+    columns = {}
+    n_rows = 0
+    for flat_source in flat_sources:
+        for key, value in flat_source.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [""] * n_rows
+            elif len(column) < n_rows:
+                column.extend([""] * (n_rows - len(column)))
+            column.append(value)
+        n_rows += 1
+    for column in columns.values():
+        column.extend([""] * (n_rows - len(column)))
+    return columns
 
 
 def _fill_sources(sources):
@@ -0,0 +1,144 @@
+"""Compact storage for lists of confs that share most of their structure.
+
+Builders which return one conf per position, region or clustering repeat the same
+layout and coordination space in every conf, with only names and URLs differing.
+``CompactConfList`` is a list of those confs in which every part of a conf that is
+the same as in the first conf is that part of the first conf, rather than a copy,
+so the shared structure is held only once. For transfer, ``compact()`` gives the
+first conf and a JSON Patch (RFC 6902) against it for each conf.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+from copy import deepcopy
+
+
+def _escape(key):
+    # JSON Pointer (RFC 6901) escaping.
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _same(a, b):
+    # 1 == True and 1 == 1.0 in Python, but not in JSON.
+    return type(a) is type(b) and a == b
+
+
+def diff(base, other, path=""):
+    """Return the JSON Patch operations which turn base into other.
+    Lists of different lengths are replaced whole.
+
+    >>> diff({"name": "A", "layout": [{"x": 0}, {"x": 1}]}, {"name": "B", "layout": [{"x": 0}, {"x": 2}]})
+    [{'op': 'replace', 'path': '/name', 'value': 'B'}, {'op': 'replace', 'path': '/layout/1/x', 'value': 2}]
+    >>> diff({"a/b": 1, "c": 2}, {"a/b": True, "d": 3})
+    [{'op': 'remove', 'path': '/c'}, {'op': 'replace', 'path': '/a~1b', 'value': True}, {'op': 'add', 'path': '/d', \
+'value': 3}]
+    >>> diff({"x": 0.5}, {"x": float("0.5")})
+    []
+    """
+    if base is other:
+        return []
+    if isinstance(base, dict) and isinstance(other, dict):
+        ops = [{"op": "remove", "path": f"{path}/{_escape(key)}"} for key in base if key not in other]
+        for key, value in other.items():
+            if key in base:
+                ops.extend(diff(base[key], value, f"{path}/{_escape(key)}"))
+            else:
+                ops.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": value})
+        return ops
+    if isinstance(base, list) and isinstance(other, list) and len(base) == len(other):
+        return [op for i, (a, b) in enumerate(zip(base, other, strict=True)) for op in diff(a, b, f"{path}/{i}")]
+    if _same(base, other):
+        return []
+    return [{"op": "replace", "path": path, "value": other}]
+
+
+def apply_patch(doc, ops):
+    """Apply the add, remove and replace operations of a JSON Patch to a copy of doc.
+
+    >>> apply_patch({"a/b": 1, "c": [0, 1]}, [{"op": "replace", "path": "/c/1", "value": 2},
+    ...     {"op": "remove", "path": "/a~1b"}, {"op": "add", "path": "/d", "value": None}])
+    {'c': [0, 2], 'd': None}
+    >>> apply_patch({"a": 1}, [{"op": "replace", "path": "", "value": [1]}])
+    [1]
+    """
+    doc = deepcopy(doc)
+    for op in ops:
+        if op["path"] == "":
+            doc = deepcopy(op["value"])
+            continue
+        *parents, last = [_unescape(token) for token in op["path"].split("/")[1:]]
+        target = doc
+        for token in parents:
+            target = target[int(token) if isinstance(target, list) else token]
+        key = int(last) if isinstance(target, list) else last
+        if op["op"] == "remove":
+            del target[key]
+        else:
+            target[key] = deepcopy(op["value"])
+    return doc
+
+
+def share(base, other):
+    """Return other, with each of its parts which is the same as the part of base at that path
+    replaced by that part of base, so the two share it.
+
+    >>> base = {"name": "A", "layout": [{"x": 0}, {"x": 1}], "flag": 1}
+    >>> shared = share(base, {"name": "B", "layout": [{"x": 0}, {"x": 1}], "flag": True})
+    >>> shared
+    {'name': 'B', 'layout': [{'x': 0}, {'x': 1}], 'flag': True}
+    >>> shared["layout"] is base["layout"], share(base, deepcopy(base)) is base
+    (True, True)
+    """
+    if isinstance(base, dict) and isinstance(other, dict):
+        shared = {key: share(base[key], value) if key in base else value for key, value in other.items()}
+        if list(shared) == list(base) and all(shared[key] is base[key] for key in base):
+            return base
+        return shared
+    if isinstance(base, list) and isinstance(other, list) and len(base) == len(other):
+        shared = [share(a, b) for a, b in zip(base, other, strict=True)]
+        return base if all(a is b for a, b in zip(base, shared, strict=True)) else shared
+    return base if _same(base, other) else other
+
+
+class CompactConfList(list):
+    """A list of confs, in which each conf shares with the first conf the parts that are the same.
+
+    >>> confs = CompactConfList()
+    >>> for name in ["Pos0", "Pos1"]:
+    ...     confs.append({"name": name, "layout": [{"component": "spatial", "x": 0}]})
+    >>> len(confs), confs[-1]
+    (2, {'name': 'Pos1', 'layout': [{'component': 'spatial', 'x': 0}]})
+    >>> confs[1]["layout"] is confs[0]["layout"]
+    True
+    >>> confs.compact()["patches"]
+    [[], [{'op': 'replace', 'path': '/name', 'value': 'Pos1'}]]
+    >>> CompactConfList(confs[::-1])[:1]
+    [{'name': 'Pos1', 'layout': [{'component': 'spatial', 'x': 0}]}]
+
+    Since it is a list, it is serialized like any other list of confs. Because parts of the
+    confs are shared, a conf should be copied before it is changed. ``compact()`` gives the
+    smaller form to transfer: a client can rebuild conf ``i`` by applying ``patches[i]`` to ``base``.
+    """
+
+    def __init__(self, confs=()):
+        super().__init__()
+        self.extend(confs)
+
+    def append(self, conf):
+        super().append(share(self[0], conf) if self else conf)
+
+    def extend(self, confs):
+        for conf in confs:
+            self.append(conf)
+
+    def __repr__(self):
+        return f"CompactConfList({list(self)!r})"
+
+    def compact(self):
+        base = self[0] if self else None
+        return {"base": base, "patches": [diff(base, conf) for conf in self]}
@@ -0,0 +1,149 @@
+"""Vitessce conf dicts built directly, without the vitessce object model.
+
+Builders with fixed layouts don't need ``VitessceConfig``: constructing its
+wrappers and views and then serializing them with ``to_dict()`` costs more than
+the conf itself. ``ConfEmitter`` writes the same dict that ``to_dict()`` would,
+key for key, from the same inputs.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+from string import ascii_uppercase
+
+
+def _scope_name(index):
+    """Scope names as vitessce assigns them: A to Z, then AA, AB, and so on.
+
+    >>> [_scope_name(i) for i in (0, 25, 26, 27)]
+    ['A', 'Z', 'AA', 'AB']
+    """
+    name = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = ascii_uppercase[remainder] + name
+    return name
+
+
+def _value(constant):
+    # Builders pass vitessce enums, like Component.SPATIAL, or plain strings.
+    return getattr(constant, "value", constant)
+
+
+class ConfEmitter:
+    """Accumulates datasets, files and views, and emits them as a conf dict.
+
+    >>> from pprint import pprint
+    >>> emitter = ConfEmitter(name="HuBMAP Data Portal", schema_version="1.0.15")
+    >>> dataset = emitter.add_dataset(name="Visualization Files")
+    >>> emitter.add_file(dataset, url="https://example.com/cells.json", file_type="obsSets.cell-sets.json",
+    ...     coordination_values={"obsType": "cell"})
+    >>> emitter.add_view("scatterplot", dataset, mapping="UMAP", x=0, y=0, w=9, h=12)
+    >>> emitter.add_view("obsSets", dataset, x=9, y=0, w=3, h=12, props={"title": "Sets"})
+    >>> pprint(emitter.to_dict(), sort_dicts=False)
+    {'version': '1.0.15',
+     'name': 'HuBMAP Data Portal',
+     'description': '',
+     'datasets': [{'uid': 'A',
+                   'name': 'Visualization Files',
+                   'files': [{'fileType': 'obsSets.cell-sets.json',
+                              'url': 'https://example.com/cells.json',
+                              'coordinationValues': {'obsType': 'cell'}}]}],
+     'coordinationSpace': {'dataset': {'A': 'A'}, 'embeddingType': {'A': 'UMAP'}},
+     'layout': [{'component': 'scatterplot',
+                 'coordinationScopes': {'dataset': 'A', 'embeddingType': 'A'},
+                 'x': 0,
+                 'y': 0,
+                 'w': 9,
+                 'h': 12},
+                {'component': 'obsSets',
+                 'coordinationScopes': {'dataset': 'A'},
+                 'x': 9,
+                 'y': 0,
+                 'w': 3,
+                 'h': 12,
+                 'props': {'title': 'Sets'}}],
+     'initStrategy': 'auto'}
+
+    :param str name: Name of the conf
+    :param str schema_version: Vitessce schema version
+    """
+
+    def __init__(self, name, schema_version):
+        self._name = name
+        self._schema_version = schema_version
+        self._datasets = []
+        self._coordination_space = {}
+        self._layout = []
+
+    def _add_scope(self, coordination_type, value):
+        scopes = self._coordination_space.setdefault(coordination_type, {})
+        scope = _scope_name(len(scopes))
+        scopes[scope] = value
+        return scope
+
+    def add_dataset(self, name):
+        """Add an empty dataset, returning its uid."""
+        uid = _scope_name(len(self._datasets))
+        self._datasets.append({"uid": uid, "name": name, "files": []})
+        self._add_scope("dataset", uid)
+        return uid
+
+    def add_file(self, dataset, file_type, url=None, options=None, coordination_values=None):
+        """Add a file to the dataset with the given uid."""
+        file = {"fileType": _value(file_type)}
+        if url is not None:
+            file["url"] = url
+        if options is not None:
+            file["options"] = options
+        if coordination_values is not None:
+            file["coordinationValues"] = coordination_values
+        next(d for d in self._datasets if d["uid"] == dataset)["files"].append(file)
+
+    def add_raster_images(self, dataset, images, use_physical_size_scaling=False):
+        """Add OME-TIFF images, as a ``MultiImageWrapper`` of ``OmeTiffWrapper`` would,
+        but without ``renderLayers``, so every image is shown.
+
+        :param list images: ``(name, url, offsets_url)`` for each image
+        """
+        self.add_file(
+            dataset,
+            "raster.json",
+            options={
+                "schemaVersion": "0.0.2",
+                "usePhysicalSizeScaling": use_physical_size_scaling,
+                "images": [
+                    {
+                        "name": name,
+                        "type": "ome-tiff",
+                        "url": url,
+                        "metadata": {"omeTiffOffsetsUrl": offsets_url, "isBitmask": False},
+                    }
+                    for name, url, offsets_url in images
+                ],
+            },
+        )
+
+    def add_view(self, component, dataset, x=0, y=0, w=1, h=1, mapping=None, props=None):
+        """Add a view of the dataset with the given uid.
+        As in vitessce, a mapping gets an embeddingType scope of its own.
+        """
+        scopes = {"dataset": dataset}
+        if mapping is not None:
+            scopes["embeddingType"] = self._add_scope("embeddingType", mapping)
+        view = {"component": _value(component), "coordinationScopes": scopes, "x": x, "y": y, "w": w, "h": h}
+        if props is not None:
+            view["props"] = props
+        self._layout.append(view)
+
+    def to_dict(self):
+        return {
+            "version": self._schema_version,
+            "name": self._name,
+            "description": "",
+            "datasets": self._datasets,
+            "coordinationSpace": self._coordination_space,
+            "layout": self._layout,
+            "initStrategy": "auto",
+        }
@@ -8,6 +8,8 @@ base_image_dirs = ["lab_processed", "processed_microscopy", "processedMicroscopy
 
 ZARR_PATH = "hubmap_ui/anndata-zarr/secondary_analysis.zarr"
 ZIP_ZARR_PATH = f"{ZARR_PATH}.zip"
+# A stratified subset of the cells in ZARR_PATH, for heatmaps of datasets too large to show whole.
+HEATMAP_SUBSET_ZARR_PATH = "hubmap_ui/anndata-zarr/heatmap_subset.zarr"
 MULTIOMIC_ZARR_PATH = "hubmap_ui/mudata-zarr/secondary_analysis.zarr"
 XENIUM_ZARR_PATH = "Xenium.zarr"
 
@@ -0,0 +1,190 @@
+"""What a conf was built from, so a cached conf can outlive changes to its entity.
+
+When an entity is reindexed, usually only a few fields change: its status goes from
+QA to Published, or a few files are added. Builders record what they read in a
+``ConfDependencies``, and given the old and new entity, ``decide`` says whether
+the cached conf is still valid, can be patched, or needs a full rebuild.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+import re
+from collections import namedtuple
+
+# Fields which choose the builder: if they change, so might the builder.
+BUILDER_SELECTION_FIELDS = ["soft_assaytype", "vitessce-hints"]
+
+VALID = "valid"
+PATCH = "patch"
+REBUILD = "rebuild"
+
+Decision = namedtuple("Decision", ["action", "reasons"])
+
+
+def _file_paths(entity):
+    return [file["rel_path"] for file in entity.get("files", [])]
+
+
+def _matching(file_paths, pattern):
+    return [path for path in file_paths if re.search(pattern, path)]
+
+
+def _is_published(entity):
+    return entity.get("status") == "Published"
+
+
+def drop_request_init(conf):
+    """Return a copy of conf, a dict or list of them, without any ``requestInit``.
+    Builders only add request headers for unpublished datasets.
+
+    >>> drop_request_init([{"files": [{"url": "a", "requestInit": {"headers": {}}}]}])
+    [{'files': [{'url': 'a'}]}]
+    """
+    if isinstance(conf, dict):
+        return {key: drop_request_init(value) for key, value in conf.items() if key != "requestInit"}
+    if isinstance(conf, list):
+        return [drop_request_init(value) for value in conf]
+    return conf
+
+
+class ConfDependencies:
+    """Records the entity fields, file paths and remote resources a conf was built from.
+
+    >>> deps = ConfDependencies()
+    >>> deps.record_status()
+    >>> deps.record_files(["cells.json", "raw/a.fastq"], pattern=r"\\.json$")
+    ['cells.json']
+    >>> old = {"uuid": "abc", "status": "QA", "files": [{"rel_path": "cells.json"}]}
+    >>> deps.decide(old, {**old, "files": [*old["files"], {"rel_path": "raw/b.fastq"}]})
+    Decision(action='valid', reasons=[])
+    >>> deps.decide(old, {**old, "status": "Published"})
+    Decision(action='patch', reasons=['status: QA -> Published'])
+    >>> deps.decide(old, {**old, "files": []})
+    Decision(action='rebuild', reasons=['files matching "\\\\.json$" changed'])
+
+    Without a pattern, any change to the files needs a rebuild. Everything recorded
+    can be stored with the conf, and restored with ``from_dict``.
+    """
+
+    def __init__(self):
+        self.fields = ["uuid", *BUILDER_SELECTION_FIELDS]
+        self.file_patterns = []
+        self.all_files = False
+        self.status = False
+        self.resources = []
+
+    def record_field(self, name):
+        if name not in self.fields:
+            self.fields.append(name)
+
+    def record_status(self):
+        """Record that the conf depends on whether the entity is published, as request headers do."""
+        self.status = True
+
+    def record_files(self, file_paths, pattern=None):
+        """Record that the conf depends on the file paths matching pattern, or all of them,
+        and return those paths.
+        """
+        if pattern is None:
+            self.all_files = True
+            return list(file_paths)
+        if pattern not in self.file_patterns:
+            self.file_patterns.append(pattern)
+        return _matching(file_paths, pattern)
+
+    def record_resource(self, url):
+        # The query string is dropped, so tokens are not kept.
+        url = url.split("?")[0]
+        if url not in self.resources:
+            self.resources.append(url)
+
+    def update(self, other):
+        """Add the dependencies of other, e.g. of a builder used to build part of this conf."""
+        for name in other.fields:
+            self.record_field(name)
+        self.file_patterns.extend(pattern for pattern in other.file_patterns if pattern not in self.file_patterns)
+        self.all_files = self.all_files or other.all_files
+        self.status = self.status or other.status
+        for url in other.resources:
+            self.record_resource(url)
+
+    def recording(self, resolver):
+        """Wrap an ``AssetResolver``, recording the URLs read through it."""
+        return _RecordingResolver(resolver, self)
+
+    def decide(self, old_entity, new_entity):
+        """Whether a conf built from old_entity is still valid for new_entity,
+        can be patched with ``patch``, or must be rebuilt.
+        Remote resources are not checked: callers can revalidate ``resources`` themselves.
+
+        :rtype: Decision
+        """
+        rebuild = [f"{name} changed" for name in self.fields if old_entity.get(name) != new_entity.get(name)]
+        old_files, new_files = _file_paths(old_entity), _file_paths(new_entity)
+        if self.all_files:
+            if old_files != new_files:
+                rebuild.append("files changed")
+        else:
+            rebuild.extend(
+                f'files matching "{pattern}" changed'
+                for pattern in self.file_patterns
+                if _matching(old_files, pattern) != _matching(new_files, pattern)
+            )
+        patch = []
+        if self.status and _is_published(old_entity) != _is_published(new_entity):
+            reason = f"status: {old_entity.get('status')} -> {new_entity.get('status')}"
+            # Headers can be dropped, but where they would go has to be worked out again.
+            (patch if _is_published(new_entity) else rebuild).append(reason)
+        if rebuild:
+            return Decision(REBUILD, rebuild + patch)
+        if patch:
+            return Decision(PATCH, patch)
+        return Decision(VALID, [])
+
+    def patch(self, conf, new_entity):
+        """Bring a conf up to date with new_entity, when ``decide`` says it can be patched.
+        Notebook cells should be regenerated from the result.
+        """
+        return drop_request_init(conf) if _is_published(new_entity) else conf
+
+    def to_dict(self):
+        return {
+            "fields": self.fields,
+            "file_patterns": self.file_patterns,
+            "all_files": self.all_files,
+            "status": self.status,
+            "resources": self.resources,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        >>> deps = ConfDependencies()
+        >>> deps.record_resource("https://example.com/uuid/a.zarr?token=secret")
+        >>> ConfDependencies.from_dict(deps.to_dict()).resources
+        ['https://example.com/uuid/a.zarr']
+        """
+        deps = cls()
+        for key, value in d.items():
+            setattr(deps, key, value)
+        return deps
+
+
+class _RecordingResolver:
+    _recorded = ("get", "open_zarr", "open_zip_zarr", "open_file")
+
+    def __init__(self, resolver, dependencies):
+        self._resolver = resolver
+        self._dependencies = dependencies
+
+    def __getattr__(self, name):
+        attr = getattr(self._resolver, name)
+        if name not in self._recorded:
+            return attr
+
+        def recorded(url, *args, **kwargs):
+            self._dependencies.record_resource(url)
+            return attr(url, *args, **kwargs)
+
+        return recorded
@@ -0,0 +1,181 @@
+"""Incremental parsing of large JSON documents, such as search responses redirected to S3.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Runs of characters which cannot end a string, cannot change the depth of a container, or end a number or literal.
+_STRING_BODY = re.compile(r'[^"\\]*')
+_CONTAINER_BODY = re.compile(r'[^"{}\[\]]*')
+_SCALAR = re.compile(r"[^ \t\n\r,:\]}]*")
+
+
+class JSONArrayStream:
+    """Iterates over the items of one array in a JSON document that is read in chunks,
+    so that only one item needs to be held in memory at a time.
+
+    The array is found by following path, a list of keys, from the top-level object.
+    Every other value along the path is decoded into ``document``, which is complete
+    once iteration finishes.
+
+    >>> chunks = [b'{"hits": {"total": {"valu', b'e": 2}, "hits": [{"_id": "\\xc3', b'\\xa9"}, 1', b'2]}}']
+    >>> stream = JSONArrayStream(chunks, ["hits", "hits"])
+    >>> list(stream)
+    [{'_id': 'é'}, 12]
+    >>> stream.document
+    {'hits': {'total': {'value': 2}}}
+
+    Values may be split anywhere, even within an escape or a number:
+
+    >>> list(JSONArrayStream([b'{"hits": ["a\\\\', b'"b", 1', b'0]}'], ["hits"]))
+    ['a"b', 10]
+
+    >>> list(JSONArrayStream(['{"hits": []}'], ["hits"])), list(JSONArrayStream(['{"hits": {}}'], ["hits", "hits"]))
+    ([], [])
+    >>> list(JSONArrayStream(['{"hits": {"hits": [1}}'], ["hits", "hits"]))
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected one of ',]' in JSON stream, got '}'
+
+    Truncated input is an error too:
+
+    >>> list(JSONArrayStream([b'{"hits": [1, 2'], ["hits"]))
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected one of ',]' in JSON stream, got ''
+    >>> list(JSONArrayStream([b'{"hits": [{"_id": '], ["hits"]))
+    Traceback (most recent call last):
+    ...
+    json.decoder.JSONDecodeError: Expecting value: line 1 column 9 (char 8)
+
+    :param chunks: Iterable of bytes (UTF-8) or str
+    :param list path: Keys leading from the top-level object to the array
+    """
+
+    def __init__(self, chunks, path):
+        self.document = {}
+        self._chunks = iter(chunks)
+        self._path = list(path)
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        return self._object(self.document, 0)
+
+    def _object(self, target, depth):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key != self._path[depth]:
+                target[key] = self._value()
+            elif depth == len(self._path) - 1:
+                yield from self._array()
+            else:
+                target[key] = {}
+                yield from self._object(target[key], depth + 1)
+            if self._expect(",}") == "}":
+                return
+
+    def _array(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def _fill(self):
+        """Append the next chunk to the buffer, dropping what has been parsed.
+        Returns False at the end of the input.
+        """
+        if self._eof:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            chunk = b""
+        text = self._text_decoder.decode(chunk, final=self._eof) if isinstance(chunk, bytes) else chunk
+        self._buffer = self._buffer[self._pos :] + text
+        self._pos = 0
+        return not self._eof
+
+    def _peek(self):
+        """Skip whitespace, and return the next character, or "" at the end of the input."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} in JSON stream, got {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decode the next value, once the buffer holds all of it.
+        Chunks are scanned only once for the end of the value, from where the last fill left off,
+        so a value spanning many chunks is not decoded again from its start after each.
+        """
+        self._peek()
+        scanned, depth, in_string = 0, 0, False
+        while True:
+            buffer = self._buffer
+            i, end = self._pos + scanned, None
+            while i < len(buffer) and end is None:
+                char = buffer[i]
+                if in_string:
+                    i = _STRING_BODY.match(buffer, i).end()
+                    if i == len(buffer):
+                        break
+                    if buffer[i] == "\\":
+                        # An escape split across chunks is scanned again after the fill.
+                        if i + 1 == len(buffer):
+                            break
+                        i += 2
+                        continue
+                    i += 1
+                    in_string = False
+                    if not depth:
+                        end = i
+                elif char == '"':
+                    in_string = True
+                    i += 1
+                elif char in "{[":
+                    depth += 1
+                    i += 1
+                elif depth and char in "}]":
+                    depth -= 1
+                    i += 1
+                    if not depth:
+                        end = i
+                elif depth:
+                    i = _CONTAINER_BODY.match(buffer, i).end()
+                else:
+                    # A number or literal may continue in the next chunk, unless a delimiter follows it.
+                    i = _SCALAR.match(buffer, i).end()
+                    if i < len(buffer):
+                        end = i
+            scanned = i - self._pos
+            if end is None and self._fill():
+                continue
+            value, self._pos = self._decoder.raw_decode(self._buffer, self._pos)
+            return value
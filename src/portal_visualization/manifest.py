@@ -0,0 +1,299 @@
+"""Per-dataset manifests of what builders read from assets, so confs can be built without probing them.
+
+To build a conf, builders open zarr stores and fetch small files like ``metadata.json``,
+to find out which keys are present, the number of cells, categories, physical sizes,
+mask names and cluster columns. ``generate_manifest`` builds a conf once, offline or at
+pipeline time, and records every one of those reads. The manifest is stored with the
+dataset at ``paths.VISUALIZATION_MANIFEST``. When a builder's entity lists that file,
+it is fetched once, and reads are answered from it through a ``ManifestResolver``.
+Anything the manifest does not hold, like large chunks, is still read from the assets server.
+
+A manifest is JSON::
+
+    {"version": 1,
+     "files": {"<uuid>/<rel_path>": "<body>", ...},
+     "stores": {"<uuid>/<rel_path>.zarr": {"keys": {"<key>": "<value>", ...},
+                                           "listdirs": {"<path>": ["<name>", ...]}}}}
+
+Paths are relative to the assets endpoint, so a manifest generated against a local
+mirror also works against the assets server. Values are text, or ``{"base64": ...}``
+for binary values; ``null`` records that a file or key is absent, and ``true``
+that a key is present but too large to include.
+"""
+
+import base64
+
+import zarr
+
+from .assets import _make_response, get_asset_resolver, relative_path
+from .paths import VISUALIZATION_MANIFEST
+
+MANIFEST_VERSION = 1
+
+# Larger values, e.g. chunks of per-cell arrays, are left out and read from the assets server if needed.
+MAX_INLINE_BYTES = 2**16
+
+
+def _encode(value):
+    """
+    >>> _encode(b'{"zarr_format": 2}'), _encode(b"\\x00\\xff"), _encode(None)
+    ('{"zarr_format": 2}', {'base64': 'AP8='}, None)
+    >>> _encode(b"x" * (MAX_INLINE_BYTES + 1))
+    True
+    """
+    if value is None:
+        return None
+    if len(value) > MAX_INLINE_BYTES:
+        return True
+    try:
+        return bytes(value).decode()
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(value).decode()}
+
+
+def _decode(value):
+    """
+    >>> _decode("text"), _decode({"base64": "AP8="})
+    (b'text', b'\\x00\\xff')
+    """
+    if isinstance(value, dict):
+        return base64.b64decode(value["base64"])
+    return value.encode()
+
+
+class _TracingStore(zarr.storage.Store):
+    """Reads through to a zarr store, recording what is read."""
+
+    def __init__(self, store, entries):
+        self._store = store
+        self._entries = entries
+
+    def __getitem__(self, key):
+        try:
+            value = self._store[key]
+        except KeyError:
+            self._entries["keys"][key] = None
+            raise
+        self._entries["keys"][key] = _encode(value)
+        return value
+
+    def __contains__(self, key):
+        if key.rsplit("/", 1)[-1].startswith(".z"):
+            # Builders check for groups and arrays, e.g. "obs/x" in z, without always reading them,
+            # so their metadata is read and recorded here, to answer the check without a probe.
+            try:
+                self[key]
+            except KeyError:
+                return False
+            return True
+        present = key in self._store
+        if not present:
+            self._entries["keys"][key] = None
+        return present
+
+    def getitems(self, keys, *, contexts):
+        # Passed on as a batch, so the real store can still fetch them concurrently.
+        found = self._store.getitems(keys, contexts=contexts)
+        for key in keys:
+            self._entries["keys"][key] = _encode(found[key]) if key in found else None
+        return found
+
+    def listdir(self, path=""):
+        names = zarr.storage.listdir(self._store, path)
+        self._entries["listdirs"][path] = names
+        return names
+
+    def __setitem__(self, key, value):
+        raise PermissionError("_TracingStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("_TracingStore is read-only")
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __len__(self):
+        return len(self._store)
+
+
+class _ManifestStore(zarr.storage.Store):
+    """A zarr store answered from a manifest, opening the real store only for what it does not hold.
+
+    >>> store = _ManifestStore({"keys": {".zgroup": '{"zarr_format": 2}', "x/.zarray": None, "big": True},
+    ...     "listdirs": {"": ["x"]}}, open_store=lambda: zarr.storage.KVStore({"big": b"..."}))
+    >>> store[".zgroup"], "x/.zarray" in store, store.listdir("")
+    (b'{"zarr_format": 2}', False, ['x'])
+    >>> store["big"], list(store)
+    (b'...', ['big'])
+    >>> store.getitems([".zgroup", "x/.zarray", "big", "other"], contexts={})
+    {'big': b'...', '.zgroup': b'{"zarr_format": 2}'}
+    """
+
+    def __init__(self, entries, open_store):
+        self._entries = entries
+        self._open_store = open_store
+        self._store = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = self._open_store()
+        return self._store
+
+    def __getitem__(self, key):
+        value = self._entries["keys"].get(key, True)
+        if value is None:
+            raise KeyError(key)
+        if value is True:
+            return self.store[key]
+        return _decode(value)
+
+    def __contains__(self, key):
+        value = self._entries["keys"].get(key, True)
+        return value is not None and (value is not True or key in self.store)
+
+    def getitems(self, keys, *, contexts):
+        # Keys the manifest does not hold are fetched from the real store in one batch.
+        unknown = [key for key in keys if self._entries["keys"].get(key, True) is True]
+        found = self.store.getitems(unknown, contexts=contexts) if unknown else {}
+        for key in keys:
+            value = self._entries["keys"].get(key, True)
+            if value is not None and value is not True:
+                found[key] = _decode(value)
+        return found
+
+    def listdir(self, path=""):
+        if path in self._entries["listdirs"]:
+            return self._entries["listdirs"][path]
+        return zarr.storage.listdir(self.store, path)  # pragma: no cover
+
+    def __setitem__(self, key, value):
+        raise PermissionError("_ManifestStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("_ManifestStore is read-only")
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)  # pragma: no cover
+
+
+class _TracingResolver:
+    """Reads assets through resolver, recording what is read for a manifest."""
+
+    def __init__(self, resolver, assets_endpoint):
+        self._resolver = resolver
+        self._assets_endpoint = assets_endpoint
+        self.files = {}
+        self.stores = {}
+
+    def __getattr__(self, name):
+        return getattr(self._resolver, name)
+
+    def get(self, url, request_init=None):
+        response = self._resolver.get(url, request_init)
+        if response.status_code in (200, 404):
+            self.files[relative_path(url, self._assets_endpoint)] = (
+                _encode(response.content) if response.status_code == 200 else None
+            )
+        return response
+
+    def open_zarr(self, url, request_init=None):
+        return self._trace(url, self._resolver.open_zarr(url, request_init))
+
+    def open_zip_zarr(self, url, request_init=None):
+        return self._trace(url, self._resolver.open_zip_zarr(url, request_init))
+
+    def _trace(self, url, group):
+        entries = self.stores.setdefault(relative_path(url, self._assets_endpoint), {"keys": {}, "listdirs": {}})
+        return zarr.open(_TracingStore(group.store, entries), mode="r")
+
+    def manifest(self):
+        # Bodies too large to include are left for the assets server.
+        files = {path: body for path, body in self.files.items() if body is not True}
+        return {"version": MANIFEST_VERSION, "files": files, "stores": self.stores}
+
+
+class ManifestResolver:
+    """Answers reads from a manifest, and passes anything it does not hold to resolver.
+
+    >>> from .assets import MemoryAssetResolver
+    >>> manifest = {"version": 1, "files": {"uuid/metadata.json": '{"PhysicalSizeX": 1}', "uuid/gone.json": None},
+    ...     "stores": {}}
+    >>> resolver = ManifestResolver(MemoryAssetResolver({"uuid/other.json": "{}"}), manifest, "https://example.com")
+    >>> resolver.get("https://example.com/uuid/metadata.json?token=groups_token").json()
+    {'PhysicalSizeX': 1}
+    >>> resolver.get("https://example.com/uuid/gone.json").status_code
+    404
+    >>> resolver.get("https://example.com/uuid/other.json").json()
+    {}
+    """
+
+    def __init__(self, resolver, manifest, assets_endpoint):
+        self._resolver = resolver
+        self._manifest = manifest
+        self._assets_endpoint = assets_endpoint
+
+    def __getattr__(self, name):
+        return getattr(self._resolver, name)
+
+    def get(self, url, request_init=None):
+        files = self._manifest["files"]
+        path = relative_path(url, self._assets_endpoint)
+        if path not in files:
+            return self._resolver.get(url, request_init)
+        body = files[path]
+        return _make_response(url, None if body is None else _decode(body))
+
+    def open_zarr(self, url, request_init=None):
+        return self._open(url, lambda: self._resolver.open_zarr(url, request_init))
+
+    def open_zip_zarr(self, url, request_init=None):
+        return self._open(url, lambda: self._resolver.open_zip_zarr(url, request_init))
+
+    def _open(self, url, open_group):
+        entries = self._manifest["stores"].get(relative_path(url, self._assets_endpoint))
+        if entries is None:
+            return open_group()
+        return zarr.open(_ManifestStore(entries, lambda: open_group().store), mode="r")
+
+
+def read_manifest(resolver, url, request_init=None):
+    """Fetch the manifest at url, or return None if it is missing, unreadable, or of another version,
+    in which case builders probe assets as usual.
+
+    >>> from .assets import MemoryAssetResolver
+    >>> resolver = MemoryAssetResolver({"uuid/manifest.json": {"version": 0}, "uuid/bad.json": "{"})
+    >>> [read_manifest(resolver, f"https://example.com/uuid/{name}") for name in ["manifest.json", "bad.json"]]
+    [None, None]
+    """
+    response = resolver.get(url, request_init)
+    if response.status_code != 200:
+        return None
+    try:
+        manifest = response.json()
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return {"files": {}, "stores": {}, **manifest}
+
+
+def generate_manifest(Builder, entity, groups_token, assets_endpoint, asset_resolver=None, markers=(), **kwargs):
+    """Build a conf for entity, and return a manifest of everything read from assets to build it.
+    To run offline or at pipeline time, pass a ``LocalAssetResolver`` over the dataset's assets.
+
+    :param type Builder: The builder for entity, from ``get_view_config_builder``
+    :param AssetResolver asset_resolver: Where to read assets from, default the global resolver
+    :param markers: Markers to also build confs for, so that what they read is recorded too
+    :param dict kwargs: Passed on to the builder
+    """
+    tracer = _TracingResolver(asset_resolver or get_asset_resolver(), assets_endpoint)
+    # The manifest describes the rest of the dataset, so any existing one is ignored.
+    entity = {**entity, "files": [file for file in entity["files"] if file["rel_path"] != VISUALIZATION_MANIFEST]}
+    for marker in [None, *markers]:
+        builder = Builder(entity, groups_token, assets_endpoint, asset_resolver=tracer, **kwargs)
+        builder.get_conf_cells(marker=marker)
+    return tracer.manifest()
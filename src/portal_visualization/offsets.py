@@ -0,0 +1,104 @@
+"""IFD offsets for OME-TIFF pyramids that have no ``offsets.json``.
+
+Imaging builders point the browser at ``output_offsets/*.offsets.json``, the byte offsets
+of the IFDs of each pyramid. Without that file, the browser walks the IFDs itself over
+HTTP, one request after another, which is very slow for large pyramids. An ``OffsetsService``
+computes the offsets instead, with ranged reads of the TIFF (see ``ome_tiff.read_ifd_offsets``),
+and caches them in memory and on disk against the TIFF's URL and ETag or Last-Modified.
+
+Generated offsets are laid out like the assets they describe, at
+``{base_url}/{uuid}/{rel_path of the TIFF}.offsets.json``. A web handler can answer those URLs
+with ``serve``, or ``materialize`` can write the files under a directory to be served statically.
+Builders given an ``offsets_service`` point pyramids whose entity does not list an offsets file
+at those URLs.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install; reading a TIFF requires the [full] dependencies.
+"""
+
+import json
+import urllib.parse
+from pathlib import Path
+
+from .caching import LRUCache
+from .ome_tiff import read_ifd_offsets
+
+OFFSETS_SUFFIX = ".offsets.json"
+
+
+def _split_query(url):
+    path, _, query = url.partition("?")
+    return path, f"?{query}" if query else ""
+
+
+class OffsetsService:
+    """Computes, caches, and serves the IFD offsets of OME-TIFFs on the assets server.
+
+    >>> service = OffsetsService("https://offsets.example.com/", "https://example.com")
+    >>> service.offsets_url("https://example.com/uuid/ometiff-pyramids/image.ome.tif?token=groups_token")
+    'https://offsets.example.com/uuid/ometiff-pyramids/image.ome.tif.offsets.json?token=groups_token'
+    >>> service.image_url("https://offsets.example.com/uuid/ometiff-pyramids/image.ome.tif.offsets.json?token=t")
+    'https://example.com/uuid/ometiff-pyramids/image.ome.tif?token=t'
+
+    :param str base_url: Where the generated offsets are served
+    :param str assets_endpoint: The assets endpoint the TIFFs are read from
+    :param AssetResolver resolver: Where to read TIFFs from, default the global resolver
+    :param str cache_dir: Optional directory in which to also persist computed offsets
+    :param int max_entries: How many images' offsets to hold in memory
+    """
+
+    def __init__(self, base_url, assets_endpoint, resolver=None, cache_dir=None, max_entries=1024):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.assets_endpoint = assets_endpoint.rstrip("/") + "/"
+        self._resolver = resolver
+        self.cache = LRUCache(max_entries=max_entries, cache_dir=cache_dir)
+
+    def _rel_path(self, url, base_url, suffix=""):
+        path, _ = _split_query(url)
+        if not path.startswith(base_url) or not path.endswith(suffix):
+            raise ValueError(f"{url} is not under {base_url}")
+        return path[len(base_url) : len(path) - len(suffix)]
+
+    def offsets_url(self, img_url):
+        """The URL at which this service serves the offsets of the TIFF at img_url."""
+        _, query = _split_query(img_url)
+        return f"{self.base_url}{self._rel_path(img_url, self.assets_endpoint)}{OFFSETS_SUFFIX}{query}"
+
+    def image_url(self, offsets_url):
+        """The URL of the TIFF whose offsets this service serves at offsets_url."""
+        _, query = _split_query(offsets_url)
+        return f"{self.assets_endpoint}{self._rel_path(offsets_url, self.base_url, OFFSETS_SUFFIX)}{query}"
+
+    def get_offsets(self, img_url, request_init=None):
+        """Return the IFD offsets of the TIFF at img_url, computing them if they are not cached.
+        Raises ``FileNotFoundError`` if there is no such TIFF, and ``ValueError`` if it is not one.
+        """
+        if self._resolver is None:
+            # Requires [full] dependencies, so only imported once a TIFF is read.
+            from .assets import get_asset_resolver
+
+            resolver = get_asset_resolver()
+        else:
+            resolver = self._resolver
+        with resolver.open_file(img_url, request_init) as file:
+            # Remote files are keyed by URL, size and validator; others are read afresh.
+            key = getattr(file, "key", None)
+            offsets = None if key is None else self.cache.get(key)
+            if offsets is None:
+                offsets = read_ifd_offsets(file)
+                if key is not None:
+                    self.cache.set(key, offsets)
+        return offsets
+
+    def serve(self, offsets_url, request_init=None):
+        """Return the body of the ``offsets.json`` this service serves at offsets_url."""
+        return json.dumps(self.get_offsets(self.image_url(offsets_url), request_init)).encode()
+
+    def materialize(self, img_url, root, request_init=None):
+        """Write the offsets of the TIFF at img_url under root, where a static server
+        with this service's base_url would serve them, and return the path written.
+        """
+        path = Path(root) / urllib.parse.unquote(self._rel_path(self.offsets_url(img_url), self.base_url))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.get_offsets(img_url, request_init)))
+        return path
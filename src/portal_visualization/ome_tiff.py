@@ -0,0 +1,147 @@
+"""Physical sizes from the header of an OME-TIFF, without reading the whole pyramid.
+
+Builders scale segmentations by the physical sizes in ``image_metadata/*.metadata.json``.
+When that file is missing, the same sizes are in the OME-XML which OME-TIFFs carry as
+the ImageDescription of their first IFD. ``read_physical_sizes`` reads the TIFF header,
+that IFD, and the OME-XML, and nothing else. ``read_ifd_offsets`` likewise walks the
+chain of IFDs, for pyramids without an ``offsets.json`` (see ``offsets``). Over HTTP,
+a file from ``AssetResolver.open_file`` turns those reads into a few range requests,
+whose blocks are cached for the next conf.
+
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+import struct
+import xml.etree.ElementTree as ET
+
+IMAGE_DESCRIPTION_TAG = 270
+
+# The OME schema's unit when a size has none.
+DEFAULT_UNIT = "µm"
+
+# Formats of an offset and of the count of entries in an IFD, then format and size of an entry.
+_CLASSIC = ("I", "H", "HHII", 12)
+_BIG = ("Q", "Q", "HHQQ", 20)
+
+
+def _read(file, offset, size):
+    file.seek(offset)
+    data = file.read(size)
+    if len(data) < size:
+        raise ValueError("TIFF is truncated")
+    return data
+
+
+def _read_header(file):
+    """Return the byte order and layout of the TIFF file, and the offset of its first IFD."""
+    header = _read(file, 0, 8)
+    byte_order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if byte_order is None:
+        raise ValueError("Not a TIFF file")
+    (version,) = struct.unpack(f"{byte_order}H", header[2:4])
+    if version == 42:
+        layout = _CLASSIC
+        (ifd_offset,) = struct.unpack(f"{byte_order}I", header[4:8])
+    elif version == 43:
+        layout = _BIG
+        (ifd_offset,) = struct.unpack(f"{byte_order}Q", _read(file, 8, 8))
+    else:
+        raise ValueError(f"Unknown TIFF version {version}")
+    return byte_order, layout, ifd_offset
+
+
+def read_image_description(file):
+    """Return the ImageDescription of the first IFD of the TIFF file, or None if it has none.
+
+    >>> import io
+    >>> header = b"II" + struct.pack("<HI", 42, 8)
+    >>> ifd = struct.pack("<H", 1) + struct.pack("<HHII", IMAGE_DESCRIPTION_TAG, 2, 6, 26) + struct.pack("<I", 0)
+    >>> read_image_description(io.BytesIO(header + ifd + b"<OME/>"))
+    '<OME/>'
+    >>> read_image_description(io.BytesIO(b"GIF89a..."))
+    Traceback (most recent call last):
+    ...
+    ValueError: Not a TIFF file
+    """
+    byte_order, layout, ifd_offset = _read_header(file)
+    offset_format, count_format, entry_format, entry_size = layout
+    count_size = struct.calcsize(count_format)
+    (n_entries,) = struct.unpack(f"{byte_order}{count_format}", _read(file, ifd_offset, count_size))
+    entries = _read(file, ifd_offset + count_size, n_entries * entry_size)
+    inline_size = struct.calcsize(offset_format)
+    for start in range(0, len(entries), entry_size):
+        entry = entries[start : start + entry_size]
+        tag, _, count, value = struct.unpack(f"{byte_order}{entry_format}", entry)
+        if tag != IMAGE_DESCRIPTION_TAG:
+            continue
+        # ASCII values which fit in the entry are stored in it, rather than at an offset.
+        data = entry[-inline_size:][:count] if count <= inline_size else _read(file, value, count)
+        return data.rstrip(b"\0").decode("utf-8", errors="replace")
+    return None
+
+
+def read_ifd_offsets(file):
+    """Return the offsets of the IFDs of the TIFF file, in the order of the chain from the first,
+    as an ``offsets.json`` lists them. Only the count of entries and the offset of the next IFD
+    are read from each, so a pyramid's offsets cost two small reads per plane.
+
+    >>> import io
+    >>> header = b"MM" + struct.pack(">HI", 42, 8)
+    >>> first = struct.pack(">H12sI", 1, bytes(12), 26)
+    >>> second = struct.pack(">H12sI", 1, bytes(12), 0)
+    >>> read_ifd_offsets(io.BytesIO(header + first + second))
+    [8, 26]
+    >>> read_ifd_offsets(io.BytesIO(header + struct.pack(">H12sI", 1, bytes(12), 8)))
+    Traceback (most recent call last):
+    ...
+    ValueError: IFD at 8 is in a loop
+    """
+    byte_order, layout, ifd_offset = _read_header(file)
+    offset_format, count_format, _, entry_size = layout
+    count_size = struct.calcsize(count_format)
+    offsets = []
+    seen = set()
+    while ifd_offset:
+        if ifd_offset in seen:
+            raise ValueError(f"IFD at {ifd_offset} is in a loop")
+        seen.add(ifd_offset)
+        offsets.append(ifd_offset)
+        (n_entries,) = struct.unpack(f"{byte_order}{count_format}", _read(file, ifd_offset, count_size))
+        next_at = ifd_offset + count_size + n_entries * entry_size
+        (ifd_offset,) = struct.unpack(
+            f"{byte_order}{offset_format}", _read(file, next_at, struct.calcsize(offset_format))
+        )
+    return offsets
+
+
+def physical_sizes(ome_xml):
+    """Return the physical sizes of the first image in ome_xml, with the keys of a
+    ``metadata.json``, or None if they are not given.
+
+    >>> ome_xml = '''<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"><Image><Pixels
+    ...     PhysicalSizeX="0.5" PhysicalSizeY="0.25" PhysicalSizeYUnit="nm"/></Image></OME>'''
+    >>> physical_sizes(ome_xml)
+    {'PhysicalSizeX': 0.5, 'PhysicalSizeY': 0.25, 'PhysicalSizeUnitX': 'µm', 'PhysicalSizeUnitY': 'nm'}
+    >>> physical_sizes("<OME><Image><Pixels/></Image></OME>") is None, physical_sizes("Not OME") is None
+    (True, True)
+    """
+    try:
+        root = ET.fromstring(ome_xml)
+    except ET.ParseError:
+        return None
+    pixels = root.find(".//{*}Pixels")
+    if pixels is None or pixels.get("PhysicalSizeX") is None:
+        return None
+    return {
+        "PhysicalSizeX": float(pixels.get("PhysicalSizeX")),
+        "PhysicalSizeY": float(pixels.get("PhysicalSizeY", pixels.get("PhysicalSizeX"))),
+        "PhysicalSizeUnitX": pixels.get("PhysicalSizeXUnit", DEFAULT_UNIT),
+        "PhysicalSizeUnitY": pixels.get("PhysicalSizeYUnit", DEFAULT_UNIT),
+    }
+
+
+def read_physical_sizes(file):
+    """Return the physical sizes in the OME-XML of the OME-TIFF file, or None if it has none."""
+    description = read_image_description(file)
+    return None if description is None else physical_sizes(description)
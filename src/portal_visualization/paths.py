@@ -17,3 +17,4 @@ SEGMENTATION_ZARR_STORES = "hubmap_ui/seg-to-mudata-zarr/objects.zarr"
 SEGMENTATION_SUPPORT_IMAGE_SUBDIR = "lab_processed/images"
 IMAGE_METADATA_DIR = "image_metadata"
 GEOMX_DIR = "output_ome_segments"
+VISUALIZATION_MANIFEST = "hubmap_ui/visualization-manifest.json"
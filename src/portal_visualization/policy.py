@@ -0,0 +1,426 @@
+"""How outbound HTTP calls are made: timeouts, retries, and circuit breakers.
+
+Each host (the search API, the assets server, ...) gets its own ``RequestPolicy``,
+so one degraded dependency fails fast without holding up calls to the others,
+or pinning worker threads on requests that will not succeed.
+``snapshot()`` reports the state of every policy, for monitoring.
+
+Separately, a ``Hedger`` can cut the latency tail of small idempotent reads
+by duplicating those that are slow to answer, and a ``RateLimiter`` can keep
+background work, like pre-warming confs, from crowding out interactive requests.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import requests
+
+# Failures worth retrying, and counted against the circuit breaker.
+# Other errors, e.g. 404s, are the caller's business.
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calls to an endpoint after repeated failures, until it has had time to recover.
+
+    After ``failure_threshold`` consecutive failures the circuit opens, and calls are
+    rejected. Once ``reset_timeout`` seconds have passed, one trial call is let through:
+    if it succeeds the circuit closes, and if not it opens again.
+
+    >>> now = [0]
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    >>> breaker.record_failure()
+    >>> breaker.allow(), breaker.state
+    (True, 'closed')
+    >>> breaker.record_failure()
+    >>> breaker.allow(), breaker.state
+    (False, 'open')
+    >>> now[0] = 10
+    >>> breaker.state, breaker.allow(), breaker.allow()
+    ('half-open', True, False)
+    >>> breaker.record_success()
+    >>> breaker.snapshot()
+    {'state': 'closed', 'failures': 0, 'rejected': 2}
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._rejected = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Whether a call may be made now. In the half-open state, only the first caller is let through."""
+        with self._lock:
+            state = self.state
+            if state == "half-open":
+                # Other callers wait for the trial call's result.
+                self._opened_at = self._clock()
+            elif state == "open":
+                self._rejected += 1
+            return state != "open"
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+
+    def snapshot(self):
+        return {"state": self.state, "failures": self._failures, "rejected": self._rejected}
+
+
+class RequestPolicy:
+    """Timeouts, retries with jittered exponential backoff, and a circuit breaker,
+    for calls to one endpoint.
+
+    >>> policy = RequestPolicy(retries=2, sleep=lambda seconds: None)
+    >>> responses = iter([requests.exceptions.ConnectionError(), _status(503), _status(200)])
+    >>> def send(timeout):
+    ...     response = next(responses)
+    ...     if isinstance(response, Exception):
+    ...         raise response
+    ...     return response
+    >>> policy.call(send).status_code
+    200
+    >>> policy.snapshot()["breaker"]
+    {'state': 'closed', 'failures': 0, 'rejected': 0}
+
+    Only idempotent calls are retried:
+
+    >>> policy.call(lambda timeout: _status(503), idempotent=False).status_code
+    503
+    >>> policy.snapshot()["breaker"]["failures"]
+    1
+
+    A call counts once against the circuit breaker, however many times it was retried:
+
+    >>> policy.call(lambda timeout: _status(503)).status_code
+    503
+    >>> policy.snapshot()["breaker"]["failures"]
+    2
+
+    :param float connect_timeout: Seconds to wait for a connection
+    :param float read_timeout: Seconds to wait between bytes of the response
+    :param int retries: How many times to retry idempotent calls that fail
+    :param float backoff: Upper bound of the delay in seconds before the first retry, doubled for each retry after
+    :param float max_backoff: Upper bound of the delay before any retry
+    :param int failure_threshold: Consecutive failures before the circuit breaker opens
+    :param float reset_timeout: Seconds before an open circuit breaker lets a trial call through
+    """
+
+    def __init__(
+        self,
+        connect_timeout=3.05,
+        read_timeout=30.0,
+        retries=2,
+        backoff=0.25,
+        max_backoff=4.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        sleep=time.sleep,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._sleep = sleep
+
+    def call(self, send, idempotent=True):
+        """Make a call, returning its response.
+        :param send: Function making the request, given the ``(connect, read)`` timeout
+        :param bool idempotent: Whether the call may be retried, as for GETs
+        :raises CircuitOpenError: If the endpoint has been failing, and is not called
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Not calling failing endpoint: {self.breaker.snapshot()}")
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if attempt:
+                self._sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))))
+            is_last = attempt == attempts - 1
+            try:
+                response = send(self.timeout)
+            except RETRYABLE_EXCEPTIONS:
+                # Only the call as a whole, once its retries have run out, counts against the breaker.
+                if is_last:
+                    self.breaker.record_failure()
+                    raise
+                continue
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                self.breaker.record_success()
+                return response
+            if is_last:
+                self.breaker.record_failure()
+                return response
+
+    def client_timeout(self):
+        """The same timeouts, for aiohttp sessions such as those fsspec uses to read zarr stores."""
+        import aiohttp
+
+        connect_timeout, read_timeout = self.timeout
+        return aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+    def snapshot(self):
+        connect_timeout, read_timeout = self.timeout
+        return {
+            "connect_timeout": connect_timeout,
+            "read_timeout": read_timeout,
+            "retries": self.retries,
+            "breaker": self.breaker.snapshot(),
+        }
+
+
+class Hedger:
+    """Sends a duplicate of a slow request, and takes whichever answers first.
+
+    A call is hedged if it has not answered within the ``percentile`` latency of recent
+    calls (or ``initial_delay``, until ``min_samples`` have been seen). Hedges are capped at
+    ``budget`` times the number of calls, plus a small burst, so a slow server is not
+    swamped with duplicates. Only use this for idempotent requests, like small JSON GETs.
+
+    >>> import threading
+    >>> answers = iter([0.5, 0])
+    >>> def send():
+    ...     delay = next(answers)
+    ...     threading.Event().wait(delay)
+    ...     return delay
+    >>> hedger = Hedger(initial_delay=0.05, budget=1)
+    >>> hedger.call(send)
+    0
+    >>> hedger.stats
+    {'calls': 1, 'hedged': 1, 'hedge_wins': 1, 'hedge_rate': 1.0, 'delay': 0.05}
+
+    :param float percentile: Latency percentile, from recent calls, after which to hedge
+    :param float initial_delay: Seconds after which to hedge, until there are enough samples
+    :param int min_samples: Calls to see before the percentile is used
+    :param float budget: Maximum hedges, as a fraction of calls
+    :param int burst: Hedges allowed beyond the budget
+    :param int window: How many recent latencies to keep
+    :param int max_workers: Threads available for concurrent attempts
+    """
+
+    def __init__(
+        self,
+        percentile=95,
+        initial_delay=0.5,
+        min_samples=20,
+        budget=0.05,
+        burst=2,
+        window=200,
+        max_workers=8,
+    ):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.burst = burst
+        self._latencies = deque(maxlen=window)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @property
+    def delay(self):
+        """Seconds to wait for the first attempt before hedging."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def _take_hedge(self):
+        with self._lock:
+            if self.hedged < self.budget * self.calls + self.burst:
+                self.hedged += 1
+                return True
+            return False
+
+    def _submit(self, send):
+        """Run send() on a worker, returning its future, of the result and the seconds it took to run,
+        and an event set once it starts running."""
+        started = threading.Event()
+
+        def attempt():
+            started.set()
+            start = time.monotonic()
+            return send(), time.monotonic() - start
+
+        return self._executor.submit(attempt), started
+
+    def call(self, send):
+        """Call send(), hedging if it is slow, and return the first result.
+        If an attempt raises, the other's result is used; if both raise, the first error is raised.
+        """
+        with self._lock:
+            self.calls += 1
+        first, started = self._submit(send)
+        attempts = [first]
+        # Attempts are timed from when they start running: time queued for a worker is not the server's latency.
+        started.wait()
+        done, _ = wait(attempts, timeout=self.delay)
+        if not done and self._take_hedge():
+            attempts.append(self._submit(send)[0])
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in attempts if future in done and future.exception() is None), None)
+            if winner is not None:
+                result, latency = winner.result()
+                with self._lock:
+                    self._latencies.append(latency)
+                    if winner is not first:
+                        self.hedge_wins += 1
+                return result
+        return first.result()
+
+    @property
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_rate": round(self.hedged / self.calls, 3) if self.calls else None,
+            "delay": self.delay,
+        }
+
+
+class RateLimiter:
+    """A token bucket: calls are let through at ``rate`` per second on average, in bursts of up to ``burst``.
+
+    Callers that are over the limit reserve the next token and sleep until it is due,
+    so concurrent callers are spaced out rather than all waking at once.
+
+    >>> now, slept = [0], []
+    >>> limiter = RateLimiter(rate=2, burst=2, clock=lambda: now[0], sleep=slept.append)
+    >>> [limiter.acquire() for _ in range(4)]
+    [0, 0, 0.5, 1.0]
+    >>> now[0] = 10
+    >>> limiter.acquire(), limiter.stats
+    (0, {'rate': 2, 'acquired': 5, 'waited': 1.5})
+
+    :param float rate: Calls per second
+    :param int burst: Calls allowed at once after a quiet period
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = clock()
+        self.acquired = 0
+        self.waited = 0
+
+    def acquire(self):
+        """Wait until a call may be made, returning the seconds waited."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.acquired += 1
+            self.waited += wait
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    @property
+    def stats(self):
+        return {"rate": self.rate, "acquired": self.acquired, "waited": round(self.waited, 3)}
+
+
+def _status(status_code):
+    response = requests.models.Response()
+    response.status_code = status_code
+    return response
+
+
+_policy_settings = {}
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(url):
+    """Return the policy for calls to the host of url, creating it on first use."""
+    if isinstance(url, bytes):
+        url = url.decode()
+    host = urlparse(url).netloc
+    with _policies_lock:
+        if host not in _policies:
+            _policies[host] = RequestPolicy(**_policy_settings.get(host, _policy_settings.get(None, {})))
+        return _policies[host]
+
+
+def configure_policy(host=None, **settings):
+    """Set the ``RequestPolicy`` arguments for calls to host, or with no host, the defaults for every host
+    without settings of its own. Any policy already created for the affected hosts is replaced.
+
+    >>> get_policy("https://search.example.com/portal/search").retries
+    2
+    >>> configure_policy("search.example.com", retries=0)
+    >>> get_policy("https://search.example.com/portal/search").retries
+    0
+    >>> reset_policies()
+    """
+    with _policies_lock:
+        _policy_settings[host] = settings
+        for existing in list(_policies):
+            if host in (None, existing) and (host is not None or existing not in _policy_settings):
+                del _policies[existing]
+
+
+def reset_policies():
+    """Forget every host's settings and policy, including the state of its circuit breaker,
+    e.g. between tests, so failures in one do not open the breaker for the next.
+    """
+    with _policies_lock:
+        _policy_settings.clear()
+        _policies.clear()
+
+
+def snapshot():
+    """The state of the policy for every host called so far, for monitoring.
+
+    >>> configure_policy("search.example.com", retries=0)
+    >>> get_policy("https://search.example.com/portal/search").snapshot()["retries"]
+    0
+    >>> snapshot()["search.example.com"]["breaker"]["state"]
+    'closed'
+    >>> reset_policies()
+    >>> snapshot()
+    {}
+    """
+    with _policies_lock:
+        return {host: policy.snapshot() for host, policy in _policies.items()}
@@ -0,0 +1,217 @@
+"""Pre-warming of cached confs for recently modified datasets.
+
+After a reindex, the first visitor to each changed dataset would otherwise wait
+for its conf to be built. A ``ConfPrewarmer`` takes the changed datasets, e.g.
+from ``ApiClient.get_modified_datasets``, and builds their confs into a cache
+ahead of time: the most valuable first, a few at a time, and at a limited rate
+toward the assets server.
+"""
+
+import contextvars
+import copy
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .caching import LRUCache
+from .policy import RateLimiter
+
+# Published datasets are the most visited; the weight of any other status is OTHER_STATUS_WEIGHT.
+DEFAULT_STATUS_WEIGHTS = {"Published": 1.0, "QA": 0.5}
+OTHER_STATUS_WEIGHT = 0.1
+
+WarmConf = namedtuple("WarmConf", ["last_modified_timestamp", "vitessce_conf", "vis_lifted_uuid"])
+
+# The scope of confs built without a groups token.
+PUBLIC = "public"
+
+
+def cache_key(uuid, groups_token=None):
+    """The key of a warmed conf in the cache. Confs built with a groups token include it,
+    in their URLs and request headers, and may include unpublished data, so they are only
+    cached for readers with the same token.
+
+    >>> cache_key("a"), cache_key("a", "groups_token")
+    (('a', 'public'), ('a', 'groups_token'))
+    """
+    return (uuid, groups_token or PUBLIC)
+
+
+def priority(change, status_weights=DEFAULT_STATUS_WEIGHTS, popularity=None):
+    """How much it is worth warming the conf of a changed dataset:
+    the weight of its status, scaled up by its popularity, e.g. recent page views.
+
+    >>> priority({"uuid": "a", "status": "QA"}, popularity={"a": 3})
+    2.0
+    >>> priority({"uuid": "b", "status": "New"})
+    0.1
+    """
+    weight = status_weights.get(change.get("status"), OTHER_STATUS_WEIGHT)
+    return weight * (1 + (popularity or {}).get(change["uuid"], 0))
+
+
+class _RateLimitedResolver:
+    """Takes a token from the limiter before each read through an ``AssetResolver``.
+    Opening a zarr store counts as one read; reads within an open store are not limited.
+    """
+
+    _limited = ("get", "open_zarr", "open_zip_zarr", "open_file")
+
+    def __init__(self, resolver, limiter):
+        self._resolver = resolver
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        resolver = self._resolver
+        if resolver is None:
+            # Requires [full] dependencies, so only imported once assets are read.
+            from .assets import get_asset_resolver
+
+            resolver = get_asset_resolver()
+        attr = getattr(resolver, name)
+        if name not in self._limited:
+            return attr
+
+        def limited(*args, **kwargs):
+            self._limiter.acquire()
+            return attr(*args, **kwargs)
+
+        return limited
+
+
+class ConfPrewarmer:
+    """Builds the confs of changed datasets into a cache, keyed by ``cache_key``
+    of their UUID and the client's groups token.
+
+    Each cached value is a ``WarmConf``. A dataset whose cached conf was built
+    at the same ``last_modified_timestamp`` is skipped. Confs are built with
+    ``wrap_error=False``, so failures are counted rather than cached as error confs.
+    Work runs in the caller's context, so with Flask, call ``run`` in an app context.
+
+    :param ApiClient client: Used to fetch entities and build their confs
+    :param cache: Where confs are put: anything with ``get`` and ``set``, like an ``LRUCache``
+    :param dict status_weights: Weight of each dataset status; see ``priority``
+    :param dict popularity: Popularity of datasets by UUID, e.g. recent page views
+    :param int max_workers: How many confs are built at once
+    :param float requests_per_second: If given, the limit on reads from the assets server
+    """
+
+    def __init__(
+        self,
+        client,
+        cache=None,
+        status_weights=None,
+        popularity=None,
+        max_workers=4,
+        requests_per_second=None,
+    ):
+        self.cache = cache if cache is not None else LRUCache(max_entries=1024)
+        self.status_weights = status_weights or DEFAULT_STATUS_WEIGHTS
+        self.popularity = popularity or {}
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(requests_per_second) if requests_per_second else None
+        self._client = client
+        if self.limiter is not None:
+            # A copy, so other users of the client are not limited.
+            self._client = copy.copy(client)
+            self._client.asset_resolver = _RateLimitedResolver(client.asset_resolver, self.limiter)
+        self._lock = threading.Lock()
+        self._reset(0)
+
+    def _reset(self, total):
+        self.total = total
+        self.built = 0
+        self.skipped = 0
+        self.failures = {}
+        self.latest_timestamp = None
+        self._latest_done = None
+        self._earliest_failed = None
+        self._started = time.monotonic()
+
+    def prioritize(self, changes):
+        """Return the changes, as dicts with at least a uuid, most valuable first.
+
+        >>> prewarmer = ConfPrewarmer(client=None, popularity={"b": 1})
+        >>> [change["uuid"] for change in prewarmer.prioritize(["a", {"uuid": "b", "status": "QA"}])]
+        ['b', 'a']
+        """
+        changes = [{"uuid": change} if isinstance(change, str) else change for change in changes]
+        return sorted(changes, key=lambda change: priority(change, self.status_weights, self.popularity), reverse=True)
+
+    def run(self, changes):
+        """Warm the confs of changes, UUIDs or dicts like those from ``get_modified_datasets``,
+        returning the final ``progress``.
+        """
+        changes = self.prioritize(changes)
+        self._reset(len(changes))
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="prewarm") as executor:
+            for change in changes:
+                # Submitted in priority order, and the executor's queue is first in, first out.
+                executor.submit(contextvars.copy_context().run, self._warm, change)
+        return self.progress
+
+    def run_since(self, since, page_size=1000):
+        """Warm the confs of datasets modified after since, a timestamp in milliseconds.
+        ``progress["latest_timestamp"]`` can be passed as since to the next run:
+        it stops short of the earliest dataset which failed, so that one is tried again.
+        """
+        return self.run(self._client.get_modified_datasets(since, page_size=page_size))
+
+    def _warm(self, change):
+        uuid = change["uuid"]
+        key = cache_key(uuid, self._client.groups_token)
+        timestamp = change.get("last_modified_timestamp")
+        cached = self.cache.get(key)
+        if cached is not None and timestamp is not None and cached.last_modified_timestamp == timestamp:
+            self._done(timestamp, skipped=True)
+            return
+        try:
+            entity = self._client.get_entity(uuid=uuid, fields=self._client.conf_entity_fields)
+            result = self._client.get_vitessce_conf_cells_and_lifted_uuid(entity, wrap_error=False)
+        except Exception as error:
+            with self._lock:
+                self.failures[uuid] = f"{type(error).__name__}: {error}"
+            self._done(timestamp, failed=True)
+            return
+        self.cache.set(key, WarmConf(timestamp, result.vitessce_conf, result.vis_lifted_uuid))
+        self._done(timestamp, built=True)
+
+    def _done(self, timestamp, built=False, skipped=False, failed=False):
+        with self._lock:
+            self.built += built
+            self.skipped += skipped
+            if timestamp is None:
+                return
+            if not failed and (self._latest_done is None or timestamp > self._latest_done):
+                self._latest_done = timestamp
+            if failed and (self._earliest_failed is None or timestamp < self._earliest_failed):
+                self._earliest_failed = timestamp
+            self.latest_timestamp = self._latest_done
+            if self._earliest_failed is not None:
+                # Just before the earliest failure, so a run since then includes it.
+                before_failure = self._earliest_failed - 1
+                if self._latest_done is None or before_failure < self._latest_done:
+                    self.latest_timestamp = before_failure
+
+    @property
+    def progress(self):
+        """Counts of the confs built, skipped and failed so far in the current run, for monitoring.
+
+        >>> ConfPrewarmer(client=None).progress["pending"]
+        0
+        """
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            done = self.built + self.skipped + len(self.failures)
+            return {
+                "total": self.total,
+                "pending": self.total - done,
+                "built": self.built,
+                "skipped": self.skipped,
+                "failed": len(self.failures),
+                "elapsed": round(elapsed, 3),
+                "builds_per_second": round(self.built / elapsed, 3) if elapsed else None,
+                "latest_timestamp": self.latest_timestamp,
+                "rate_limiter": self.limiter.stats if self.limiter is not None else None,
+            }
@@ -0,0 +1,101 @@
+"""Read-only access to zipped zarr stores, with a cache of their central directories.
+
+Opening a zip means reading its end-of-central-directory record and then the
+central directory itself, which for a remote ``.zarr.zip`` are two or more
+range requests before any data is read. Builders open the same stores again
+and again, so the parsed directories are cached, keyed by URL and the
+server's validator (ETag or Last-Modified): later opens only read the members
+they need.
+"""
+
+import zipfile
+from threading import RLock
+
+import zarr
+
+from .caching import LRUCache
+
+
+class CachedZipFile(zipfile.ZipFile):
+    """A read-only ``ZipFile`` that can skip reading its central directory.
+
+    :param file: Seekable binary file object holding the zip
+    :param tuple directory: ``(start_dir, infolist)`` from an earlier ``directory()`` call
+    """
+
+    def __init__(self, file, directory=None):
+        self._cached_directory = directory
+        super().__init__(file, mode="r")
+
+    def _RealGetContents(self):
+        if self._cached_directory is None:
+            return super()._RealGetContents()
+        self.start_dir, infolist = self._cached_directory
+        for zinfo in infolist:
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+
+    def directory(self):
+        """Return the parsed central directory, in the form the constructor accepts."""
+        return (self.start_dir, list(self.filelist))
+
+
+class ZipDirectoryCache:
+    """Parsed zip central directories, keyed by the caller.
+
+    :param int max_entries: Maximum number of directories to hold in memory
+    :param str cache_dir: Optional directory in which to persist directories
+    """
+
+    def __init__(self, max_entries=256, cache_dir=None):
+        self._cache = LRUCache(max_entries=max_entries, cache_dir=cache_dir)
+
+    def open(self, file, key=None):
+        """Open file as a ``CachedZipFile``, reusing the directory cached under key.
+        Without a key, the directory is read and nothing is cached.
+        """
+        directory = self._cache.get(key) if key is not None else None
+        zf = CachedZipFile(file, directory)
+        if key is not None and directory is None:
+            self._cache.set(key, zf.directory())
+        return zf
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+
+class ZipFileStore(zarr.storage.ZipStore):
+    """A read-only zarr ``ZipStore`` over an already open ``ZipFile``,
+    rather than a path on the local filesystem.
+
+    :param zipfile.ZipFile zf: The open zip file
+    :param str path: Where the zip came from, for display only
+    """
+
+    def __init__(self, zf, path=""):
+        self.path = path
+        self.compression = zipfile.ZIP_STORED
+        self.allowZip64 = True
+        self.mode = "r"
+        self._dimension_separator = None
+        self.mutex = RLock()
+        self.zf = zf
+
+
+def zip_cache_key(url, info):
+    """Key for the directory of the zip at url, given its fsspec ``info``.
+    Returns None when the server gives nothing to validate a cached directory against.
+
+    >>> zip_cache_key("https://example.com/a.zarr.zip?token=x", {"size": 10, "ETag": '"abc"'})
+    ('https://example.com/a.zarr.zip', 10, '"abc"')
+    >>> zip_cache_key("https://example.com/a.zarr.zip", {"size": 10}) is None
+    True
+    """
+    validator = info.get("ETag") or info.get("Last-Modified")
+    if validator is None:
+        return None
+    return (url.split("?")[0], info["size"], validator)
@@ -0,0 +1,67 @@
+"""JSON encoding of confs, using orjson when it is installed.
+
+Both backends give compact UTF-8 JSON, which decodes to the same conf, and both
+accept the non-string keys which the json module does, such as ints:
+
+>>> conf = {"name": "Café", "layout": [{"x": 0, "w": 0.5}], 1: "one"}
+>>> dumps(conf)
+b'{"name":"Caf\xc3\xa9","layout":[{"x":0,"w":0.5}],"1":"one"}'
+>>> json.loads(canonical_dumps(conf)) == json.loads(dumps(conf))
+True
+
+Their bytes are not always identical, though: orjson writes ``1e-7`` and ``1e20``
+where json writes ``1e-07`` and ``1e+20``, and writes NaN as ``null``. Anything which
+must not depend on the installed backend, such as ``ConfCells.content_hash``,
+should use ``canonical_dumps``.
+
+NumPy scalars and arrays, which can end up in confs read from zarr stores,
+are encoded as plain numbers and lists.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _default(obj):
+    """Convert NumPy values, which neither backend encodes natively in every case.
+
+    >>> class Scalar:
+    ...     def item(self):
+    ...         return 1.5
+    >>> class Array(Scalar):
+    ...     def tolist(self):
+    ...         return [1.5]
+    >>> _default(Scalar()), _default(Array())
+    (1.5, [1.5])
+    >>> _default(object())
+    Traceback (most recent call last):
+    ...
+    TypeError: Object of type object is not JSON serializable
+    """
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def canonical_dumps(obj):
+    """Encode obj as compact UTF-8 JSON bytes with the json module, whichever backend is installed.
+
+    >>> canonical_dumps({"x": 1e-7, "y": float("nan")})
+    b'{"x":1e-07,"y":NaN}'
+    """
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode()
+
+
+def dumps(obj):
+    """Encode obj as compact UTF-8 JSON bytes, with the faster backend."""
+    if orjson is None:  # pragma: no cover
+        return canonical_dumps(obj)
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
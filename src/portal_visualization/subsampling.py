@@ -0,0 +1,148 @@
+"""Stratified subsets of cells, so very large datasets can still show a heatmap.
+
+A heatmap draws every cell, so above ``MAX_OBS_FOR_HEATMAP`` cells builders leave it out.
+``write_heatmap_subset`` samples at most that many cells, from every cluster in proportion
+to its size, and writes them as a small AnnData zarr store: the sampled rows of ``X`` and
+``obs``, all of ``var``, and the positions of the sampled cells in ``obs/source_index``.
+It runs offline or at pipeline time, like ``manifest.generate_manifest``, and the store
+can be written to a local directory and uploaded with the dataset at
+``constants.HEATMAP_SUBSET_ZARR_PATH``. When the entity lists that store, AnnData builders
+point the heatmap at it, rather than leaving the heatmap out.
+"""
+
+import numpy as np
+import zarr
+
+from .constants import MAX_OBS_FOR_HEATMAP
+
+# Clusters to sample from, in order of preference: annotations first, then Leiden clusters.
+SUBSET_GROUPBY_COLUMNS = ["predicted_label", "final_level_labels", "leiden"]
+
+
+def stratified_subset(groups, max_cells, seed=0):
+    """Return the sorted positions of at most max_cells cells, sampled from each group
+    in proportion to its size. Every group keeps at least one cell, so small clusters
+    still show up, and the same seed gives the same subset.
+
+    >>> groups = np.array([0] * 90 + [1] * 9 + [2])
+    >>> subset = stratified_subset(groups, 10)
+    >>> len(subset), np.bincount(groups[subset]).tolist()
+    (10, [8, 1, 1])
+    >>> np.array_equal(subset, stratified_subset(groups, 10))
+    True
+    >>> halves = np.array([0] * 55 + [1] * 45)
+    >>> np.bincount(halves[stratified_subset(halves, 10)]).tolist()
+    [6, 4]
+    >>> stratified_subset(groups, 1000).tolist() == list(range(100))
+    True
+    """
+    n_cells = len(groups)
+    if n_cells <= max_cells:
+        return np.arange(n_cells)
+    labels, inverse, sizes = np.unique(groups, return_inverse=True, return_counts=True)
+    if len(labels) > max_cells:
+        raise ValueError(f"Cannot keep a cell from each of {len(labels)} groups in {max_cells} cells")
+    # Shares in proportion to size, rounded down but to at least one cell.
+    shares = sizes * max_cells / n_cells
+    counts = np.maximum(np.floor(shares).astype(sizes.dtype), 1)
+    # Hand out what is left by largest remainder, or take back from the largest groups what small ones were given.
+    extra = max_cells - counts.sum()
+    if extra > 0:
+        counts[np.argsort(counts - shares, kind="stable")[:extra]] += 1
+    for _ in range(-extra):
+        counts[np.argmax(counts)] -= 1
+
+    rng = np.random.default_rng(seed)
+    chosen = [
+        rng.choice(np.flatnonzero(inverse == label), size=count, replace=False) for label, count in enumerate(counts)
+    ]
+    return np.sort(np.concatenate(chosen))
+
+
+def _read_groups(obs, column):
+    # Categoricals are a group of codes and categories, or in older stores,
+    # an array of codes with its categories stored elsewhere.
+    values = obs[column]
+    if isinstance(values, zarr.hierarchy.Group):
+        return values["codes"][:]
+    return values[:]
+
+
+def _write_like(target, name, values, like):
+    # Same dtype and codecs as the source array, so e.g. strings are still encoded the same way:
+    # object arrays, like strings, are encoded by their first filter.
+    filters = list(like.filters or [])
+    object_codec = filters.pop(0) if like.dtype.hasobject else None
+    array = target.array(
+        name,
+        values,
+        chunks=True,
+        dtype=like.dtype,
+        filters=filters or None,
+        compressor=like.compressor,
+        object_codec=object_codec,
+    )
+    array.attrs.update(like.attrs.asdict())
+
+
+def _copy(source, target, index=None):
+    """Copy the group source to target. With index, source is obs: keep only the rows at index
+    of its columns and of a categorical's codes, but copy the categories whole, as they are not per cell."""
+    target.attrs.update(source.attrs.asdict())
+    for name, value in source.items():
+        if isinstance(value, zarr.hierarchy.Group):
+            # Older stores keep the categories of every column in obs/__categories.
+            _copy(value, target.create_group(name), None if name == "__categories" else index)
+        elif index is not None and name != "categories":
+            _write_like(target, name, value.get_orthogonal_selection((index,)), value)
+        else:
+            _write_like(target, name, value[...], value)
+
+
+def _copy_sparse_rows(source, target, index):
+    """Copy a CSR matrix, keeping only the rows at index."""
+    indptr = source["indptr"][:]
+    starts = indptr[index]
+    lengths = indptr[index + 1] - starts
+    subset_indptr = np.concatenate([[0], np.cumsum(lengths)])
+    # Each kept row's positions run on from its start, as the subset's run on from its offset.
+    positions = np.arange(subset_indptr[-1]) + np.repeat(starts - subset_indptr[:-1], lengths)
+    shape = source.attrs["shape"]
+    target.attrs.update({**source.attrs.asdict(), "shape": [len(index), shape[1]]})
+    for name in ("data", "indices"):
+        _write_like(target, name, source[name].get_orthogonal_selection((positions,)), source[name])
+    _write_like(target, "indptr", subset_indptr, source["indptr"])
+
+
+def write_heatmap_subset(z, store, max_cells=MAX_OBS_FOR_HEATMAP, groupby=None, seed=0):
+    """Write a stratified subset of the cells of the AnnData zarr group z to store,
+    e.g. a local directory, and return the positions of the sampled cells.
+
+    :param zarr.hierarchy.Group z: The dataset's AnnData store
+    :param store: Where to write the subset: a path or any zarr store
+    :param int max_cells: How many cells the subset may have, at least one for each cluster
+    :param str groupby: The obs column to sample from, default the first of ``SUBSET_GROUPBY_COLUMNS`` present
+    :param int seed: Seeds the sample, so it can be reproduced
+    """
+    obs = z["obs"]
+    n_obs = obs["_index"].shape[0]
+    if groupby is None:
+        groupby = next((column for column in SUBSET_GROUPBY_COLUMNS if column in obs), None)
+    if groupby is None:
+        raise ValueError(f"None of the obs columns {SUBSET_GROUPBY_COLUMNS} are present to sample from")
+    index = stratified_subset(_read_groups(obs, groupby), max_cells, seed)
+
+    subset = zarr.open_group(store, mode="w")
+    subset.attrs.update(z.attrs.asdict())
+    _copy(obs, subset.create_group("obs"), index)
+    subset["obs"].array("source_index", index, chunks=True)
+    _copy(z["var"], subset.create_group("var"))
+    matrix = z["X"]
+    if isinstance(matrix, zarr.hierarchy.Group):
+        if matrix.attrs.get("encoding-type") != "csr_matrix":
+            raise ValueError(f"Only dense and CSR matrices can be subset, not {matrix.attrs.get('encoding-type')}")
+        _copy_sparse_rows(matrix, subset.create_group("X"), index)
+    else:
+        _write_like(subset, "X", matrix.get_orthogonal_selection((index, slice(None))), matrix)
+    subset.attrs["heatmap_subset"] = {"source_n_obs": n_obs, "groupby": groupby, "seed": seed}
+    return index
@@ -1,39 +1,46 @@
+import hashlib
 import re
-from itertools import groupby
-from pathlib import Path
+from functools import partial
 from unicodedata import normalize
 
-import fsspec
 import nbformat
-import zarr
-from requests import get
 from vitessce import VitessceConfig
 
+from .assets import get_asset_resolver
 from .builders.base_builders import ConfCells
 from .constants import image_units
+from .ome_tiff import read_physical_sizes
 
 
 def get_matches(files, regex):
-    return list({match[0] for match in {re.search(regex, file) for file in files} if match})
+    """The distinct matches of regex in files, sorted, so confs do not depend on set order.
+
+    >>> get_matches(["b/x.tif", "a/x.tif", "a/x.tif", "c.json"], "[ab]/x[.]tif")
+    ['a/x.tif', 'b/x.tif']
+    """
+    return sorted({match[0] for match in {re.search(regex, file) for file in files} if match})
 
 
 def create_coordination_values(obs_type="cell", **kwargs):
     return {"obsType": obs_type, **kwargs}
 
 
-def _get_path_name(file):
-    return Path(file).name
-
-
-def group_by_file_name(files):
-    sorted_files = sorted(files, key=_get_path_name)
-    return [list(g) for _, g in groupby(sorted_files, _get_path_name)]
+def get_conf_cells(vc_anything):
+    conf = vc_anything.to_dict() if hasattr(vc_anything, "to_dict") else vc_anything
+    if isinstance(vc_anything, (dict, list)):
+        # Cells come from VitessceConfig.to_python, so for confs emitted as dicts they need the object model
+        # the builder skipped: they are only made if they are read.
+        return ConfCells(conf, partial(_get_cells, vc_anything))
+    # A VitessceConfig may be changed after, e.g. by an EPIC builder, so its cells are made now.
+    return ConfCells(conf, _get_cells(vc_anything))
 
 
-def get_conf_cells(vc_anything):
+def _get_cells(vc_anything):
     cells = _get_cells_from_anything(vc_anything)
-    conf = vc_anything.to_dict() if hasattr(vc_anything, "to_dict") else vc_anything
-    return ConfCells(conf, cells)
+    # nbformat gives cells random ids; ids derived from their place and source keep the cells deterministic too.
+    for index, cell in enumerate(cells):
+        cell["id"] = hashlib.sha256(f"{index}:{cell['source']}".encode()).hexdigest()[:8]
+    return cells
 
 
 def _get_cells_from_anything(vc):
@@ -82,12 +89,39 @@ def get_found_images(image_pyramid_regex, file_paths_found):
 
 
 def obs_has_column(zroot, col_name: str, obs_path: str = "obs") -> bool:
-    """Return True if the raw column exists in obs_path"""
+    """Return True if the raw column exists in obs_path. To check for several, use obs_columns.
+
+    >>> import zarr
+    >>> z = zarr.open_group()
+    >>> z["obs/leiden"] = zarr.array([0, 1])
+    >>> obs_has_column(z, "leiden"), obs_has_column(z, "CL_Label")
+    (True, False)
+    """
+    return col_name in obs_columns(zroot, [col_name], obs_path)
+
+
+def obs_columns(zroot, col_names, obs_path: str = "obs") -> set:
+    """Return the set of col_names which exist in obs_path.
+    The metadata of every candidate is requested in one batch, so a remote store
+    fetches them concurrently, rather than making a round-trip for each.
+
+    >>> import zarr
+    >>> z = zarr.open_group()
+    >>> z["mod/rna/obs/leiden"] = zarr.array([0, 1])
+    >>> z["mod/rna/obs/predicted_label/codes"] = zarr.array([0, 0])
+    >>> sorted(obs_columns(z, ["leiden", "predicted_label", "CL_Label"], "mod/rna/obs"))
+    ['leiden', 'predicted_label']
+    >>> obs_columns(z, ["leiden"])
+    set()
+    """
     try:
         grp = zroot[obs_path]
-    except KeyError:  # pragma: no cover
-        return False
-    return col_name in grp
+    except KeyError:
+        return set()
+    prefix = f"{grp.path}/" if grp.path else ""
+    # A column is an array, or a group for e.g. categoricals.
+    keys = {f"{prefix}{col_name}/{meta_key}": col_name for col_name in col_names for meta_key in (".zarray", ".zgroup")}
+    return {keys[key] for key in grp.store.getitems(list(keys), contexts={})}
 
 
 def get_found_images_all(file_paths_found):
@@ -102,13 +136,16 @@ def get_found_images_all(file_paths_found):
     return found_images
 
 
-def get_image_metadata(self, img_url):
+def get_image_metadata(self, img_url, ome_tiff_url=None):
     """
-    Retrieve metadata from an image URL.
+    Retrieve metadata from an image URL, or if it is missing and ome_tiff_url is given,
+    from the header of the OME-TIFF.
     >>> import builtins
     >>> from unittest.mock import Mock, patch
+    >>> from portal_visualization.assets import AssetResolver
     >>> mock_instance = Mock()
     >>> mock_instance._get_request_init.return_value = {}
+    >>> mock_instance._resolver = AssetResolver()
     >>> mock_response = Mock()
     >>> mock_response.status_code = 404
     >>> mock_response.reason = 'Not Found'
@@ -121,7 +158,7 @@ def get_image_metadata(self, img_url):
 
     meta_data = None
     request_init = self._get_request_init() or {}
-    response = get(img_url, **request_init)
+    response = self._resolver.get(img_url, request_init)
     if response.status_code == 200:  # pragma: no cover
         data = response.json()
         if isinstance(data, dict) and "PhysicalSizeX" in data and "PhysicalSizeUnitX" in data:
@@ -130,6 +167,25 @@ def get_image_metadata(self, img_url):
             print("Image does not have metadata")
     else:
         print(f"Failed to retrieve {img_url}: {response.status_code} - {response.reason}")
+    if meta_data is None and ome_tiff_url is not None:
+        meta_data = read_ome_tiff_metadata(self, ome_tiff_url)
+    return meta_data
+
+
+def read_ome_tiff_metadata(self, ome_tiff_url):
+    """
+    Read the physical sizes from the OME-XML in the header of an OME-TIFF,
+    reading only its first IFD and ImageDescription, or return None if they are not there.
+    """
+    request_init = self._get_request_init() or {}
+    try:
+        with self._resolver.open_file(ome_tiff_url, request_init) as file:
+            meta_data = read_physical_sizes(file)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read OME-TIFF header of {ome_tiff_url}: {e}")
+        return None
+    if meta_data is None:
+        print(f"OME-TIFF {ome_tiff_url} does not have physical sizes")
     return meta_data
 
 
@@ -277,23 +333,18 @@ def files_from_response(response_json):
     return {hit["_id"]: [file["rel_path"] for file in hit["_source"].get("files", [])] for hit in hits}
 
 
-def read_zip_zarr(zarr_url, request_init):
+def read_zip_zarr(zarr_url, request_init, resolver=None):
     """
     Opens a zarr file provided in zip format using fsspec.
 
     Parameters:
         zarr_url (str): URL to the zipped.zarr file.
         request_init (dict): Client kwargs for request customization.
+        resolver (AssetResolver): Where to read the file from; defaults to the global resolver.
 
     Returns:
         zarr.hierarchy.Group or zarr.array: Opened Zarr store.
     """
-    fs = fsspec.filesystem(
-        "zip",
-        fo=zarr_url,
-        remote_protocol="https",
-        remote_options={"client_kwargs": request_init},
-        # expand=True
-    )
-    store = fs.get_mapper("")
-    return zarr.open(store, mode="r")
+    if resolver is None:
+        resolver = get_asset_resolver()
+    return resolver.open_zip_zarr(zarr_url, request_init)
@@ -0,0 +1,111 @@
+"""Estimates of what optional views will cost the browser to load, from zarr metadata.
+
+A heatmap of a small matrix is cheap; one of a large matrix, chunked so every
+feature touches every chunk, can take the browser hundreds of megabytes and
+thousands of requests. ``estimate_view_costs`` reads only the metadata of the
+feature matrix: its shape, chunks and dtype, or for a sparse matrix, the same
+for its ``data``, ``indices`` and ``indptr`` arrays. Builders compare the
+estimates with a ``ClientBudget``, and defer views that would not fit. Only views
+which can be deferred are estimated; today that is the heatmap.
+
+Estimates are upper bounds: chunks are counted at their full uncompressed size.
+Only the standard library is used here, so this module is safe to import
+from a thin install.
+"""
+
+import math
+from collections import namedtuple
+
+HEATMAP = "heatmap"
+
+# Sparse matrices are read whole, whichever features are shown.
+SPARSE_ENCODINGS = {"csr_matrix", "csc_matrix"}
+
+# Reading a zipped store means first finding and reading its central directory,
+# with a record of about this many bytes per entry.
+ZIP_DIRECTORY_REQUESTS = 2
+ZIP_ENTRY_BYTES = 64
+
+
+class ViewCost(namedtuple("ViewCost", ["bytes", "requests"])):
+    """What loading a view costs the browser.
+
+    >>> ViewCost(10, 1) + ViewCost(5, 2)
+    ViewCost(bytes=15, requests=3)
+    >>> ViewCost(10, 1).fits(ClientBudget(bytes=10, requests=1)), ViewCost(10, 2).fits(ClientBudget(100, 1))
+    (True, False)
+    """
+
+    def __add__(self, other):
+        return ViewCost(self.bytes + other.bytes, self.requests + other.requests)
+
+    def fits(self, budget):
+        return self.bytes <= budget.bytes and self.requests <= budget.requests
+
+
+# What one optional view may cost before it is deferred.
+ClientBudget = namedtuple("ClientBudget", ["bytes", "requests"])
+
+
+def _chunk_counts(array):
+    return [math.ceil(size / chunk) for size, chunk in zip(array.shape, array.chunks, strict=True)]
+
+
+def _array_cost(array):
+    requests = math.prod(_chunk_counts(array))
+    return ViewCost(requests * math.prod(array.chunks) * array.dtype.itemsize, requests)
+
+
+def estimate_view_costs(z, matrix_path="X", is_zip=False):
+    """Estimate what loading each optional view over the matrix at matrix_path costs,
+    or return None if the matrix or its metadata is missing.
+
+    >>> from types import SimpleNamespace
+    >>> float32 = SimpleNamespace(itemsize=4)
+    >>> dense = SimpleNamespace(shape=(1000, 30), chunks=(100, 10), dtype=float32)
+    >>> estimate_view_costs({"X": dense})
+    {'heatmap': ViewCost(bytes=120000, requests=30)}
+    >>> estimate_view_costs({"X": dense}, is_zip=True)[HEATMAP]
+    ViewCost(bytes=121920, requests=32)
+
+    >>> class Group(dict):
+    ...     attrs = {"encoding-type": "csr_matrix"}
+    >>> values = SimpleNamespace(shape=(5000,), chunks=(1000,), dtype=float32)
+    >>> indptr = SimpleNamespace(shape=(1001,), chunks=(1001,), dtype=SimpleNamespace(itemsize=8))
+    >>> estimate_view_costs({"X": Group(data=values, indices=values, indptr=indptr)})[HEATMAP]
+    ViewCost(bytes=48008, requests=11)
+    >>> estimate_view_costs({"X": {}}) is None
+    True
+    >>> estimate_view_costs({}) is None
+    True
+    """
+    if matrix_path not in z:
+        return None
+    matrix = z[matrix_path]
+    if hasattr(matrix, "chunks"):
+        # A heatmap may show features from any column chunk, each spread over every row chunk.
+        heatmap = _array_cost(matrix)
+    elif getattr(matrix, "attrs", {}).get("encoding-type") in SPARSE_ENCODINGS:
+        arrays = [matrix[name] for name in ("data", "indices", "indptr")]
+        heatmap = sum((_array_cost(array) for array in arrays), ViewCost(0, 0))
+    else:
+        return None
+    if is_zip:
+        # Every chunk read has an entry in the central directory.
+        heatmap += ViewCost(heatmap.requests * ZIP_ENTRY_BYTES, ZIP_DIRECTORY_REQUESTS)
+    return {HEATMAP: heatmap}
+
+
+def cost_report(costs, budget, deferred):
+    """The estimates as JSON, to return alongside a conf.
+
+    >>> cost_report({HEATMAP: ViewCost(10, 1)}, ClientBudget(5, 1), [HEATMAP])
+    {'budget': {'bytes': 5, 'requests': 1}, 'views': {'heatmap': {'bytes': 10, 'requests': 1}}, 'deferred': ['heatmap']}
+    >>> cost_report({}, None, [])["budget"] is None
+    True
+    """
+    return {
+        "budget": None if budget is None else budget._asdict(),
+        "views": {view: cost._asdict() for view, cost in costs.items()},
+        "deferred": list(deferred),
+    }
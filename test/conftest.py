@@ -0,0 +1,15 @@
+import sys
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def reset_request_policies():
+    """Start every test with closed circuit breakers and the default policy settings,
+    whichever of the package's import paths the test used."""
+    yield
+    for name in ["src.portal_visualization.policy", "portal_visualization.policy"]:
+        # The policy module requires [full] dependencies, so it is only reset once it has been imported.
+        policy = sys.modules.get(name)
+        if policy is not None:
+            policy.reset_policies()
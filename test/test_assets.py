@@ -0,0 +1,692 @@
+import io
+import json
+import os
+import struct
+import threading
+import zipfile
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+try:
+    import requests
+    import zarr
+
+    from src.portal_visualization import assets
+    from src.portal_visualization.assets import (
+        AssetResolver,
+        LocalAssetResolver,
+        MemoryAssetResolver,
+        _make_response,
+        get_asset_resolver,
+        set_asset_resolver,
+    )
+    from src.portal_visualization.builders.anndata_builders import RNASeqAnnDataZarrViewConfBuilder
+    from src.portal_visualization.builders.imaging_builders import ImagePyramidViewConfBuilder
+    from src.portal_visualization.caching import (
+        BlockCache,
+        BlockCachedFile,
+        CachedStore,
+        LRUCache,
+        RevalidatingCache,
+    )
+    from src.portal_visualization.manifest import (
+        ManifestResolver,
+        _ManifestStore,
+        _TracingResolver,
+        _TracingStore,
+        generate_manifest,
+    )
+    from src.portal_visualization.offsets import OffsetsService
+    from src.portal_visualization.paths import VISUALIZATION_MANIFEST
+    from src.portal_visualization.policy import Hedger
+    from src.portal_visualization.remote_zip import ZipDirectoryCache
+    from src.portal_visualization.utils import get_image_metadata, obs_columns, read_ome_tiff_metadata, read_zip_zarr
+
+    FULL_DEPS_AVAILABLE = True
+except ImportError:
+    FULL_DEPS_AVAILABLE = False
+    # Skip entire module during collection if full dependencies not available
+    pytest.skip("requires [full] optional dependencies", allow_module_level=True)
+
+# Mark all tests in this file as requiring [full] dependencies
+pytestmark = pytest.mark.requires_full
+
+assets_url = "https://example.com"
+fixtures_path = Path(__file__).parent / "good-fixtures" / "RNASeqAnnDataZarrViewConfBuilder"
+
+
+def write_zip_zarr(path):
+    group = zarr.open_group()
+    group["obs/_index"] = zarr.array(["cell_0", "cell_1"])
+    store = zarr.storage.ZipStore(str(path), mode="w")
+    zarr.copy_store(group.store, store)
+    store.close()
+
+
+def test_local_resolver_builds_same_conf(tmp_path):
+    entity = json.loads((fixtures_path / "fake-is-not-annotated-published-entity.json").read_text())
+    expected_conf = json.loads((fixtures_path / "fake-is-not-annotated-published-conf.json").read_text())
+    zarr_path = tmp_path / entity["uuid"] / "hubmap_ui/anndata-zarr/secondary_analysis.zarr"
+    group = zarr.open_group(str(zarr_path), mode="w")
+    group["obs/_index"] = zarr.array([str(i) for i in range(5)])
+
+    resolver = LocalAssetResolver(tmp_path, base_url=assets_url)
+    builder = RNASeqAnnDataZarrViewConfBuilder(entity, "groups_token", assets_url, asset_resolver=resolver)
+    conf, _ = builder.get_conf_cells()
+
+    assert builder.n_obs == 5
+    # The conf still points at the assets endpoint, not the mirror.
+    assert json.dumps(conf, sort_keys=True) == json.dumps(expected_conf, sort_keys=True)
+
+
+def test_local_resolver_get(tmp_path):
+    (tmp_path / "uuid").mkdir()
+    (tmp_path / "uuid" / "metadata.json").write_text('{"mask_names": ["cells"]}')
+    resolver = LocalAssetResolver(tmp_path)
+
+    found = resolver.get(f"{assets_url}/uuid/metadata.json?token=groups_token")
+    assert found.status_code == 200
+    assert found.json() == {"mask_names": ["cells"]}
+    assert resolver.get(f"{assets_url}/uuid/missing.json").status_code == 404
+
+
+def test_local_resolver_zip_zarr(tmp_path):
+    (tmp_path / "uuid").mkdir()
+    write_zip_zarr(tmp_path / "uuid" / "store.zarr.zip")
+    resolver = LocalAssetResolver(tmp_path, base_url=assets_url)
+
+    z = read_zip_zarr(f"{assets_url}/uuid/store.zarr.zip?token=groups_token", {}, resolver)
+    assert list(z["obs/_index"][:]) == ["cell_0", "cell_1"]
+    with pytest.raises(FileNotFoundError):
+        resolver.open_zip_zarr(f"{assets_url}/uuid/missing.zarr.zip")
+
+
+def test_memory_resolver_zarr():
+    group = zarr.open_group()
+    group["uns/cluster_columns"] = zarr.array(["leiden"])
+    files = {f"uuid/store.zarr/{key}": value for key, value in group.store.items()}
+    files["uuid/notes.txt"] = "not part of the store"
+    resolver = MemoryAssetResolver(files)
+
+    z = resolver.open_zarr(f"{assets_url}/uuid/store.zarr")
+    assert list(z.get("uns/cluster_columns")) == ["leiden"]
+    assert resolver.get(f"{assets_url}/uuid/notes.txt").text == "not part of the store"
+
+
+def test_memory_resolver_image_metadata(mocker):
+    metadata = {"PhysicalSizeX": 1, "PhysicalSizeUnitX": "μm", "PhysicalSizeY": 1, "PhysicalSizeUnitY": "μm"}
+    builder = mocker.Mock()
+    builder._get_request_init.return_value = None
+    builder._resolver = MemoryAssetResolver({"uuid/image_metadata/image.metadata.json": metadata})
+
+    assert get_image_metadata(builder, f"{assets_url}/uuid/image_metadata/image.metadata.json") == metadata
+
+
+def write_ome_tiff(path, description, bigtiff=False, byte_order="<", pixels=b"", planes=1):
+    # The header and a chain of IFDs of a TIFF, with pixels before and the description after them,
+    # as writers lay them out. Each IFD has the same two entries, and returns the offsets of the IFDs.
+    header_format, entry_format, count_format, offset_format = (
+        ("2sHHHQ", "HHQQ", "Q", "Q") if bigtiff else ("2sHI", "HHII", "H", "I")
+    )
+    ifd_format = f"{byte_order}{count_format}{entry_format * 2}{offset_format}"
+    ifd_size = struct.calcsize(ifd_format)
+    first_offset = struct.calcsize(f"{byte_order}{header_format}") + len(pixels)
+    offsets = [first_offset + plane * ifd_size for plane in range(planes)]
+    description = description.encode() + b"\0"
+    entries = [256, 3, 1, 1, 270, 2, len(description), first_offset + planes * ifd_size]
+    magic = {"<": b"II", ">": b"MM"}[byte_order]
+    header = (
+        struct.pack(f"{byte_order}{header_format}", magic, 43, 8, 0, first_offset)
+        if bigtiff
+        else struct.pack(f"{byte_order}{header_format}", magic, 42, first_offset)
+    )
+    ifds = b"".join(struct.pack(ifd_format, 2, *entries, next_offset) for next_offset in [*offsets[1:], 0])
+    path.write_bytes(header + pixels + ifds + description)
+    return offsets
+
+
+ome_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">
+  <Image ID="Image:0"><Pixels ID="Pixels:0" PhysicalSizeX="0.377" PhysicalSizeY="0.377" PhysicalSizeYUnit="nm"/></Image>
+</OME>"""
+
+
+@pytest.mark.parametrize("bigtiff", [False, True])
+@pytest.mark.parametrize("byte_order", ["<", ">"])
+def test_image_metadata_from_ome_tiff_header(mocker, tmp_path, bigtiff, byte_order):
+    (tmp_path / "uuid").mkdir()
+    write_ome_tiff(tmp_path / "uuid" / "image.ome.tif", ome_xml, bigtiff, byte_order)
+    builder = mocker.Mock()
+    builder._get_request_init.return_value = None
+    builder._resolver = LocalAssetResolver(tmp_path, base_url=assets_url)
+
+    metadata = get_image_metadata(
+        builder, f"{assets_url}/uuid/image_metadata/image.metadata.json", f"{assets_url}/uuid/image.ome.tif"
+    )
+    assert metadata == {
+        "PhysicalSizeX": 0.377,
+        "PhysicalSizeY": 0.377,
+        "PhysicalSizeUnitX": "µm",
+        "PhysicalSizeUnitY": "nm",
+    }
+
+
+def test_image_metadata_from_ome_tiff_header_missing(mocker, tmp_path):
+    (tmp_path / "uuid").mkdir()
+    write_ome_tiff(tmp_path / "uuid" / "plain.tif", "Not OME-XML")
+    (tmp_path / "uuid" / "truncated.tif").write_bytes(b"II*\0\x08\0\0\0\x05")
+    (tmp_path / "uuid" / "version.tif").write_bytes(b"II\x2c\0\x08\0\0\0")
+    (tmp_path / "uuid" / "untagged.tif").write_bytes(b"II*\0\x08\0\0\0" + struct.pack("<H12sI", 1, bytes(12), 0))
+    builder = mocker.Mock()
+    builder._get_request_init.return_value = None
+    builder._resolver = LocalAssetResolver(tmp_path, base_url=assets_url)
+
+    for name in ["plain.tif", "truncated.tif", "version.tif", "untagged.tif", "missing.tif"]:
+        assert read_ome_tiff_metadata(builder, f"{assets_url}/uuid/{name}") is None
+
+
+def test_resolver_reads_only_ome_tiff_header(mocker, tmp_path):
+    write_ome_tiff(tmp_path / "image.ome.tif", ome_xml, pixels=bytes(2**20))
+    data = (tmp_path / "image.ome.tif").read_bytes()
+    mock_fs = mocker.Mock()
+    mock_fs.info.return_value = {"size": len(data), "ETag": '"etag"'}
+    mock_fs.cat_file.side_effect = lambda url, start, end: data[start:end]
+    mocker.patch("src.portal_visualization.assets.fsspec.filesystem", return_value=mock_fs)
+    builder = mocker.Mock()
+    builder._get_request_init.return_value = None
+    builder._resolver = AssetResolver(blocks=BlockCache(block_size=4096))
+
+    url = f"{assets_url}/uuid/image.ome.tif?token=groups_token"
+    assert read_ome_tiff_metadata(builder, url)["PhysicalSizeX"] == 0.377
+    fetched = sum(end - start for _, start, end in (call.args for call in mock_fs.cat_file.call_args_list))
+    assert fetched <= 3 * 4096
+    mock_fs.cat_file.reset_mock()
+    assert read_ome_tiff_metadata(builder, url)["PhysicalSizeX"] == 0.377
+    assert not mock_fs.cat_file.called
+
+
+def test_offsets_service_caches_offsets(mocker, tmp_path):
+    expected = write_ome_tiff(tmp_path / "image.ome.tif", ome_xml, bigtiff=True, pixels=bytes(2**16), planes=4)
+    data = (tmp_path / "image.ome.tif").read_bytes()
+    mock_fs = mocker.Mock()
+    mock_fs.info.return_value = {"size": len(data), "ETag": '"etag"'}
+    mock_fs.cat_file.side_effect = lambda url, start, end: data[start:end]
+    mocker.patch("src.portal_visualization.assets.fsspec.filesystem", return_value=mock_fs)
+    resolver = AssetResolver(blocks=BlockCache(block_size=4096))
+    service = OffsetsService("https://offsets.example.com", assets_url, resolver, cache_dir=tmp_path / "cache")
+
+    img_url = f"{assets_url}/uuid/ometiff-pyramids/image.ome.tif?token=groups_token"
+    offsets_url = service.offsets_url(img_url)
+    assert (
+        offsets_url == "https://offsets.example.com/uuid/ometiff-pyramids/image.ome.tif.offsets.json?token=groups_token"
+    )
+    assert json.loads(service.serve(offsets_url)) == expected
+    assert mock_fs.cat_file.call_count == 2
+    with pytest.raises(ValueError, match="is not under"):
+        service.serve(f"{assets_url}/uuid/image.ome.tif")
+
+    # Another service with the same cache directory reads nothing but the HEAD request.
+    mock_fs.cat_file.reset_mock()
+    reloaded = OffsetsService("https://offsets.example.com", assets_url, resolver, cache_dir=tmp_path / "cache")
+    path = reloaded.materialize(img_url, tmp_path / "served")
+    assert path == tmp_path / "served" / "uuid/ometiff-pyramids/image.ome.tif.offsets.json"
+    assert json.loads(path.read_text()) == expected
+    assert not mock_fs.cat_file.called
+
+
+def test_offsets_service_reads_mirror(tmp_path):
+    (tmp_path / "uuid").mkdir()
+    expected = write_ome_tiff(tmp_path / "uuid" / "image.ome.tif", ome_xml, byte_order=">", planes=3)
+    service = OffsetsService("https://offsets.example.com", assets_url)
+    set_asset_resolver(LocalAssetResolver(tmp_path, base_url=assets_url))
+    try:
+        assert service.get_offsets(f"{assets_url}/uuid/image.ome.tif") == expected
+        assert service.cache.stats["entries"] == 0
+    finally:
+        set_asset_resolver(None)
+
+
+def test_builder_points_missing_offsets_at_service():
+    files = [
+        {"rel_path": "ometiff-pyramids/listed.ome.tif"},
+        {"rel_path": "output_offsets/listed.offsets.json"},
+        {"rel_path": "ometiff-pyramids/missing.ome.tif"},
+    ]
+    entity = {"uuid": "uuid", "status": "Published", "files": files}
+    service = OffsetsService("https://offsets.example.com", assets_url)
+    builder = ImagePyramidViewConfBuilder(
+        entity, "groups_token", assets_url, asset_resolver=MemoryAssetResolver({}), offsets_service=service
+    )
+
+    conf, _ = builder.get_conf_cells()
+    images = conf["datasets"][0]["files"][0]["options"]["images"]
+    offsets_urls = sorted(image["metadata"]["omeTiffOffsetsUrl"] for image in images)
+    assert offsets_urls == [
+        "https://example.com/uuid/output_offsets/listed.offsets.json?token=groups_token",
+        "https://offsets.example.com/uuid/ometiff-pyramids/missing.ome.tif.offsets.json?token=groups_token",
+    ]
+
+
+def test_resolver_get_revalidates(mocker):
+    def mock_get(url, headers=None, **kwargs):
+        response = requests.models.Response()
+        if headers.get("If-Modified-Since") == "Mon, 01 Jan 2024 00:00:00 GMT":
+            response.status_code = 304
+            response._content = b""
+        else:
+            response.status_code = 200
+            response.headers["Last-Modified"] = "Mon, 01 Jan 2024 00:00:00 GMT"
+            response._content = b'{"mask_names": ["cells"]}'
+        return response
+
+    mock_requests_get = mocker.patch("requests.get", side_effect=mock_get)
+    resolver = AssetResolver(responses=RevalidatingCache())
+    url = f"{assets_url}/uuid/metadata.json"
+    request_init = {"headers": {"Authorization": "Bearer token"}}
+
+    assert [resolver.get(url, request_init).json() for _ in range(2)] == [{"mask_names": ["cells"]}] * 2
+    assert mock_requests_get.call_args.kwargs["headers"] == {
+        "Authorization": "Bearer token",
+        "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+    }
+    assert resolver.responses.stats["revalidated"] == 1
+
+    resolver.responses.clear()
+    resolver.get(url, request_init)
+    assert "If-Modified-Since" not in mock_requests_get.call_args.kwargs["headers"]
+
+
+def test_resolver_hedges_slow_reads(mocker):
+    calls = []
+
+    def mock_get(url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            threading.Event().wait(1)
+        return _make_response(url, b'{"mask_names": ["cells"]}')
+
+    mocker.patch("requests.get", side_effect=mock_get)
+    resolver = AssetResolver(responses=RevalidatingCache(), hedger=Hedger(initial_delay=0.01))
+
+    assert resolver.get(f"{assets_url}/uuid/metadata.json").json() == {"mask_names": ["cells"]}
+    assert len(calls) == 2
+    assert resolver.hedger.stats["hedge_wins"] == 1
+
+
+def test_hedger_budget_and_errors():
+    hedger = Hedger(initial_delay=0.01, min_samples=2, budget=0, burst=1)
+    results = iter([ValueError("first attempt failed"), "hedge", "fast", "fast"])
+
+    def send():
+        result = next(results)
+        if isinstance(result, Exception):
+            threading.Event().wait(0.05)
+            raise result
+        return result
+
+    # The first attempt is slow, then fails: the hedge's answer is used.
+    assert hedger.call(send) == "hedge"
+    assert hedger.call(send) == "fast"
+    assert hedger.delay < 1
+
+    def slow_failure():
+        threading.Event().wait(0.05)
+        raise ValueError("slow failure")
+
+    # The burst is used up, so this is not hedged.
+    with pytest.raises(ValueError, match="slow failure"):
+        hedger.call(slow_failure)
+    assert hedger.stats["hedged"] == 1
+
+
+def test_hedger_times_attempts_from_when_they_run():
+    hedger = Hedger(initial_delay=0.05, budget=1, max_workers=1)
+    # Another call holds the only worker, so the next call's attempt is queued.
+    busy = hedger._executor.submit(threading.Event().wait, 0.2)
+
+    def send():
+        threading.Event().wait(0.01)
+        return "answer"
+
+    assert hedger.call(send) == "answer"
+    assert busy.done()
+    # Queued longer than the hedge delay, but not hedged, and only the time it ran is counted.
+    assert hedger.stats["hedged"] == 0
+    assert list(hedger._latencies)[0] < 0.1
+
+
+def test_set_asset_resolver():
+    resolver = MemoryAssetResolver({})
+    set_asset_resolver(resolver)
+    try:
+        assert get_asset_resolver() is resolver
+    finally:
+        set_asset_resolver(None)
+    assert type(get_asset_resolver()) is AssetResolver
+
+
+def test_lru_cache_persists_to_disk(tmp_path):
+    cache = LRUCache(max_entries=1, cache_dir=tmp_path)
+    cache.set(("url", 1), {"value": 1})
+    cache.set(("url", 2), {"value": 2})
+    assert len(cache) == 1
+    assert ("url", 2) in cache
+    # Evicted from memory, but still on disk
+    assert ("url", 1) in cache
+    assert cache.get(("url", 1)) == {"value": 1}
+
+    next(tmp_path.glob("*.pickle")).write_bytes(b"truncated")
+    fresh = LRUCache(cache_dir=tmp_path)
+    assert [fresh.get(("url", 1)), fresh.get(("url", 2))].count(None) == 1
+
+
+def test_block_cache_spills_to_disk(tmp_path):
+    data = bytes(range(256))
+    fetches = []
+
+    def fetch(start, end):
+        fetches.append((start, end))
+        return data[start:end]
+
+    # Each block costs 16 bytes, and 16 for its entry.
+    blocks = BlockCache(block_size=16, max_bytes=128, cache_dir=tmp_path, entry_cost=16)
+    file = BlockCachedFile(fetch, "key", len(data), blocks)
+    assert file.readable()
+    assert file.seekable()
+    assert file.read() == data
+    blocks.set(("key", 15), data[240:])
+    assert blocks.stats["bytes"] <= 128
+    assert len(list(tmp_path.glob("*.pickle"))) == 12
+
+    # Evicted blocks come back from disk, rather than being fetched again.
+    blocks.clear()
+    fetches.clear()
+    assert file.seek(0) == 0
+    assert file.read() == data
+    assert fetches == [(192, 256)]
+
+
+def test_cached_store_is_read_only():
+    store = CachedStore(zarr.storage.KVStore({".zgroup": b"{}"}), "key", BlockCache(), validators=lambda keys: {})
+    assert list(store) == [".zgroup"]
+    assert len(store) == 1
+    # Read in a batch from the store, without validators.
+    assert store.getitems([".zgroup", ".zattrs"]) == {".zgroup": b"{}"}
+    with pytest.raises(PermissionError):
+        store[".zattrs"] = b"{}"
+    with pytest.raises(PermissionError):
+        del store[".zgroup"]
+
+
+def test_cached_store_object_deleted_after_validation():
+    # Cached by an earlier open, and changed since, but gone by the time it is read.
+    blocks = BlockCache()
+    CachedStore({".zattrs": b"{}"}, "key", blocks, validators=None, read=lambda keys: {".zattrs": (b"{}", "etag")})[
+        ".zattrs"
+    ]
+    store = CachedStore({}, "key", blocks, validators=lambda keys: dict.fromkeys(keys, "new-etag"))
+    with pytest.raises(KeyError):
+        store[".zattrs"]
+
+
+class RecordingFile(io.BytesIO):
+    """Records the offset of every read, to check which parts of a zip were fetched."""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.read_offsets = []
+
+    def read(self, size=-1):
+        self.read_offsets.append(self.tell())
+        return super().read(size)
+
+
+def test_zip_directory_cache(tmp_path):
+    write_zip_zarr(tmp_path / "store.zarr.zip")
+    data = (tmp_path / "store.zarr.zip").read_bytes()
+    key = (f"{assets_url}/uuid/store.zarr.zip", len(data), '"etag"')
+
+    first = RecordingFile(data)
+    ZipDirectoryCache(cache_dir=tmp_path / "cache").open(first, key)
+    assert first.read_offsets
+
+    # A new cache over the same directory, as in a later process
+    cache = ZipDirectoryCache(cache_dir=tmp_path / "cache")
+    second = RecordingFile(data)
+    zf = cache.open(second, key)
+    assert second.read_offsets == []
+    assert cache.stats["hits"] == 1
+    assert zf.read("obs/_index/.zarray") == zipfile.ZipFile(tmp_path / "store.zarr.zip").read("obs/_index/.zarray")
+
+    uncached = RecordingFile(data)
+    cache.open(uncached)
+    assert uncached.read_offsets
+    assert (cache.stats["entries"], cache.stats["misses"]) == (1, 0)
+    cache.clear()
+    assert cache.stats["entries"] == 0
+
+
+def test_resolver_reuses_zip_directory_and_blocks(mocker, tmp_path):
+    write_zip_zarr(tmp_path / "store.zarr.zip")
+    data = (tmp_path / "store.zarr.zip").read_bytes()
+
+    mock_fs = mocker.Mock()
+    mock_fs.info.return_value = {"size": len(data), "ETag": '"etag"'}
+    mock_fs.cat_file.side_effect = lambda url, start, end: data[start:end]
+    mocker.patch("src.portal_visualization.assets.fsspec.filesystem", return_value=mock_fs)
+    resolver = AssetResolver(ZipDirectoryCache(), BlockCache(block_size=256))
+
+    z = resolver.open_zip_zarr(f"{assets_url}/uuid/store.zarr.zip?token=groups_token")
+    assert list(z["obs/_index"][:]) == ["cell_0", "cell_1"]
+    assert mock_fs.cat_file.called
+    mock_fs.cat_file.reset_mock()
+
+    z = resolver.open_zip_zarr(f"{assets_url}/uuid/store.zarr.zip?token=groups_token")
+    assert list(z["obs/_index"][:]) == ["cell_0", "cell_1"]
+    assert not mock_fs.cat_file.called
+    assert resolver.zip_directories.stats["hits"] == 1
+    assert resolver.blocks.stats["hit_ratio"] > 0.5
+
+
+class ZarrHandler(SimpleHTTPRequestHandler):
+    """Serves zarr stores from a directory, recording each request, and if not validated,
+    without Last-Modified."""
+
+    requests = []
+    validated = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_header(self, keyword, value):
+        if keyword != "Last-Modified" or self.validated:
+            super().send_header(keyword, value)
+
+    def send_head(self):
+        self.requests.append((self.command, self.path.removeprefix("/store.zarr/")))
+        return super().send_head()
+
+
+@pytest.fixture
+def zarr_server(tmp_path):
+    ZarrHandler.requests = []
+    ZarrHandler.validated = True
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ZarrHandler, directory=str(tmp_path)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield tmp_path / "store.zarr", f"http://127.0.0.1:{server.server_address[1]}/store.zarr"
+    server.shutdown()
+
+
+def test_resolver_caches_zarr_objects(zarr_server):
+    path, url = zarr_server
+    zarr.open_group(str(path), mode="w")["uns/cluster_columns"] = zarr.array(["leiden"])
+    resolver = AssetResolver(blocks=BlockCache())
+
+    z = resolver.open_zarr(url)
+    assert list(z["uns/cluster_columns"][:]) == ["leiden"]
+    # A first open reads each object once, and validates nothing.
+    cold = ZarrHandler.requests[:]
+    assert {method for method, _ in cold} == {"GET"}
+    assert len(cold) == len(set(cold))
+
+    ZarrHandler.requests.clear()
+    z = resolver.open_zarr(url)
+    assert list(z["uns/cluster_columns"][:]) == ["leiden"]
+    # A reopen validates the objects read before, rather than reading them again.
+    # Objects which are missing are not cached, so probes for them are read again.
+    assert any(not (path / key).exists() for _, key in cold)
+    assert sorted(ZarrHandler.requests) == sorted(("HEAD" if (path / key).exists() else "GET", key) for _, key in cold)
+
+    # An object regenerated under unchanged root metadata is read again.
+    chunk = path / "uns/cluster_columns/0"
+    chunk.write_bytes(zarr.array(["tissue"]).store["0"])
+    os.utime(chunk, (chunk.stat().st_atime, chunk.stat().st_mtime + 10))
+    ZarrHandler.requests.clear()
+    z = resolver.open_zarr(url)
+    assert list(z["uns/cluster_columns"][:]) == ["tissue"]
+    assert ("GET", "uns/cluster_columns/0") in ZarrHandler.requests
+
+    # An object deleted since is found missing by its validation, and not read.
+    chunk.unlink()
+    ZarrHandler.requests.clear()
+    z = resolver.open_zarr(url)
+    assert list(z["uns/cluster_columns"][:]) == [""]
+    assert ("HEAD", "uns/cluster_columns/0") in ZarrHandler.requests
+    assert ("GET", "uns/cluster_columns/0") not in ZarrHandler.requests
+    chunk.write_bytes(zarr.array(["tissue"]).store["0"])
+
+    # Without a validator, nothing is cached.
+    ZarrHandler.validated = False
+    resolver = AssetResolver(blocks=BlockCache())
+    for _ in range(2):
+        ZarrHandler.requests.clear()
+        z = resolver.open_zarr(url)
+        assert list(z["uns/cluster_columns"][:]) == ["tissue"]
+        assert {method for method, _ in ZarrHandler.requests} == {"GET"}
+        assert ("GET", "uns/cluster_columns/0") in ZarrHandler.requests
+
+
+def test_resolver_batches_zarr_reads(zarr_server, mocker):
+    path, url = zarr_server
+    group = zarr.open_group(str(path), mode="w")
+    group["obs/leiden"] = zarr.array([0, 1])
+    group["obs/predicted_label/codes"] = zarr.array([0, 0])
+    read_objects = mocker.spy(assets, "_read_objects")
+
+    resolver = AssetResolver(blocks=BlockCache())
+    z = resolver.open_zarr(url)
+    read_objects.reset_mock()
+    assert obs_columns(z, ["leiden", "predicted_label", "CL_Label"]) == {"leiden", "predicted_label"}
+    # After opening obs, the metadata of every candidate is fetched in one batch...
+    assert [len(call.args[2]) for call in read_objects.call_args_list] == [1, 1, 6]
+
+    # ...and what exists is cached, so a reopen only validates it.
+    z = resolver.open_zarr(url)
+    ZarrHandler.requests.clear()
+    assert obs_columns(z, ["leiden", "CL_Label"]) == {"leiden"}
+    column_requests = [(method, key) for method, key in ZarrHandler.requests if key.count("/") == 2]
+    assert sorted(column_requests) == [
+        ("GET", "obs/CL_Label/.zarray"),
+        ("GET", "obs/CL_Label/.zgroup"),
+        ("GET", "obs/leiden/.zgroup"),
+        ("HEAD", "obs/leiden/.zarray"),
+    ]
+
+
+def test_manifest_builds_conf_without_probes(tmp_path, mocker):
+    entity = json.loads((fixtures_path / "fake-is-not-annotated-published-entity.json").read_text())
+    expected_conf = json.loads((fixtures_path / "fake-is-not-annotated-published-conf.json").read_text())
+    zarr_path = tmp_path / entity["uuid"] / "hubmap_ui/anndata-zarr/secondary_analysis.zarr"
+    group = zarr.open_group(str(zarr_path), mode="w")
+    group["obs/_index"] = zarr.array([str(i) for i in range(5)])
+
+    # At pipeline time, against the dataset's assets:
+    mirror = LocalAssetResolver(tmp_path, base_url=assets_url)
+    manifest = generate_manifest(RNASeqAnnDataZarrViewConfBuilder, entity, "groups_token", assets_url, mirror)
+    assert f"{entity['uuid']}/hubmap_ui/anndata-zarr/secondary_analysis.zarr" in manifest["stores"]
+
+    # Later, with only the manifest available:
+    entity = {**entity, "files": [*entity["files"], {"rel_path": VISUALIZATION_MANIFEST}]}
+    resolver = MemoryAssetResolver({f"{entity['uuid']}/{VISUALIZATION_MANIFEST}": json.dumps(manifest)})
+    get, open_zarr = mocker.spy(resolver, "get"), mocker.spy(resolver, "open_zarr")
+    builder = RNASeqAnnDataZarrViewConfBuilder(entity, "groups_token", assets_url, asset_resolver=resolver)
+    conf, _ = builder.get_conf_cells()
+
+    assert builder.n_obs == 5
+    assert json.dumps(conf, sort_keys=True) == json.dumps(expected_conf, sort_keys=True)
+    assert get.call_count == 1
+    assert open_zarr.call_count == 0
+    # The store is still recorded as a dependency, though it was not read.
+    assert builder.dependencies.resources == [
+        f"{assets_url}/{entity['uuid']}/{VISUALIZATION_MANIFEST}",
+        f"{assets_url}/{entity['uuid']}/hubmap_ui/anndata-zarr/secondary_analysis.zarr",
+    ]
+
+
+def test_manifest_records_files_and_zip_stores(tmp_path):
+    (tmp_path / "uuid").mkdir()
+    write_zip_zarr(tmp_path / "uuid" / "store.zarr.zip")
+    (tmp_path / "uuid" / "metadata.json").write_text('{"mask_names": ["cells"]}')
+    tracer = _TracingResolver(LocalAssetResolver(tmp_path, base_url=assets_url), assets_url)
+
+    assert tracer.get(f"{assets_url}/uuid/metadata.json").json() == {"mask_names": ["cells"]}
+    assert tracer.get(f"{assets_url}/uuid/missing.json").status_code == 404
+    z = tracer.open_zip_zarr(f"{assets_url}/uuid/store.zarr.zip")
+    assert "uns" not in z
+    assert z.store.listdir("obs") == [".zgroup", "_index"]
+    assert list(z["obs/_index"][:]) == ["cell_0", "cell_1"]
+    assert "obs/_index/1" not in z.store
+    assert tracer.zip_directories is not None
+    manifest = json.loads(json.dumps(tracer.manifest()))
+    assert manifest["files"] == {"uuid/metadata.json": '{"mask_names": ["cells"]}', "uuid/missing.json": None}
+
+    # The zip is never read: the manifest holds everything that was read before.
+    resolver = ManifestResolver(MemoryAssetResolver({}), manifest, assets_url)
+    z = resolver.open_zip_zarr(f"{assets_url}/uuid/store.zarr.zip")
+    assert "uns" not in z
+    assert z.store.listdir("obs") == [".zgroup", "_index"]
+    assert list(z["obs/_index"][:]) == ["cell_0", "cell_1"]
+    assert resolver.get(f"{assets_url}/uuid/missing.json").status_code == 404
+    # Stores the manifest does not hold are opened as usual.
+    with pytest.raises(FileNotFoundError):
+        resolver.open_zip_zarr(f"{assets_url}/uuid/other.zarr.zip")
+
+
+def test_manifest_falls_back_to_assets(tmp_path):
+    group = zarr.open_group(str(tmp_path / "uuid" / "store.zarr"), mode="w")
+    group["obs/_index"] = zarr.array(["cell_0", "cell_1"])
+    manifest = {"version": 1, "files": {}, "stores": {"uuid/store.zarr": {"keys": {}, "listdirs": {}}}}
+    resolver = ManifestResolver(LocalAssetResolver(tmp_path, base_url=assets_url), manifest, assets_url)
+
+    # Unknown keys are read from the store itself.
+    z = resolver.open_zarr(f"{assets_url}/uuid/store.zarr")
+    assert list(z["obs/_index"][:]) == ["cell_0", "cell_1"]
+    assert "obs/_index/.zarray" in z.store
+    assert ".zgroup" in list(z.store)
+    assert resolver.zip_directories is not None
+
+
+def test_manifest_stores_are_read_only(tmp_path):
+    tracing = _TracingStore({"a": b"1"}, {"keys": {}, "listdirs": {}})
+    manifest = _ManifestStore({"keys": {}, "listdirs": {}}, dict)
+    assert list(tracing) == ["a"]
+    assert len(tracing) == 1
+    for store in [tracing, manifest]:
+        with pytest.raises(PermissionError):
+            store["a"] = b"2"
+        with pytest.raises(PermissionError):
+            del store["a"]
+
+
+def test_manifest_skipped_when_unusable(mocker):
+    entity = json.loads(
+        (Path(__file__).parent / "good-fixtures/ImagePyramidViewConfBuilder/fake-entity.json").read_text()
+    )
+    entity = {**entity, "status": "QA", "files": [*entity["files"], {"rel_path": VISUALIZATION_MANIFEST}]}
+    resolver = MemoryAssetResolver({})
+    builder = ImagePyramidViewConfBuilder(entity, "groups_token", assets_url, asset_resolver=resolver)
+    assert builder._assets is resolver
+    assert builder.dependencies.status
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import json
+from copy import deepcopy
 from dataclasses import dataclass
 from os import environ
 from pathlib import Path
@@ -8,6 +9,7 @@ from pathlib import Path
 import pytest
 
 from src.portal_visualization.builder_factory import (
+    get_entity_fields,
     get_view_config_builder,
     has_visualization,
 )
@@ -18,12 +20,24 @@ pytest_requires_full = pytest.mark.requires_full
 try:
     import yaml
     import zarr
+    from vitessce import VitessceConfig
 
+    from src.portal_visualization import serialization
+    from src.portal_visualization.assets import MemoryAssetResolver
     from src.portal_visualization.builders.base_builders import ConfCells
-    from src.portal_visualization.builders.imaging_builders import KaggleSegImagePyramidViewConfBuilder
+    from src.portal_visualization.builders.imaging_builders import (
+        ImagePyramidViewConfBuilder,
+        KaggleSegImagePyramidViewConfBuilder,
+        SeqFISHViewConfBuilder,
+    )
+    from src.portal_visualization.compact_confs import CompactConfList, apply_patch
+    from src.portal_visualization.constants import HEATMAP_SUBSET_ZARR_PATH
+    from src.portal_visualization.dependencies import ConfDependencies
     from src.portal_visualization.epic_factory import get_epic_builder
     from src.portal_visualization.paths import IMAGE_PYRAMID_DIR
-    from src.portal_visualization.utils import get_found_images, read_zip_zarr
+    from src.portal_visualization.subsampling import write_heatmap_subset
+    from src.portal_visualization.utils import get_conf_cells, get_found_images, read_zip_zarr
+    from src.portal_visualization.view_costs import ClientBudget
 
     FULL_DEPS_AVAILABLE = True
 except ImportError:
@@ -228,24 +242,107 @@ def mock_zarr_store(entity_path, mocker, obs_count):
 
 
 @pytest.mark.requires_full
-def test_read_zip_zarr_opens_store(mocker):
-    # Mock the fsspec filesystem and zarr open
-    mock_fs = mocker.Mock()
-    mock_mapper = mocker.Mock()
-    mock_zarr_obj = mocker.Mock()
+def test_get_entity_fields():
+    fields = get_entity_fields()
+    assert len(fields) == len(set(fields))
+    assert set(fields) >= {"uuid", "status", "soft_assaytype", "vitessce-hints", "files.rel_path"}
+    assert "files" not in fields
+
+
+def project_source(doc, fields):
+    # Like Elasticsearch "_source" filtering, for checking builders' entity_fields.
+    grouped = {}
+    for field in fields:
+        head, _, rest = field.partition(".")
+        grouped.setdefault(head, []).append(rest)
+    projected = {}
+    for head, rests in grouped.items():
+        if head not in doc:
+            continue
+        value = doc[head]
+        if "" not in rests and isinstance(value, list):
+            value = [project_source(item, rests) for item in value]
+        elif "" not in rests and isinstance(value, dict):
+            value = project_source(value, rests)
+        projected[head] = value
+    return projected
+
+
+# Builders which read image metadata from the assets server. Their fixture confs were generated
+# without any, so an empty mirror stands in for the server, and they build without the network.
+mirrored_builders = [
+    "GeoMxImagePyramidViewConfBuilder",
+    "KaggleSegImagePyramidViewConfBuilder",
+    "SegmentationMaskBuilder",
+]
+
+
+def fixture_resolver(entity_path):
+    if entity_path.parent.name in mirrored_builders:
+        return MemoryAssetResolver({}, base_url=assets_url)
+    return None
 
-    mock_fs.get_mapper.return_value = mock_mapper
 
-    mocker.patch("src.portal_visualization.utils.fsspec.filesystem", return_value=mock_fs)
-    mocker.patch("src.portal_visualization.utils.zarr.open", return_value=mock_zarr_obj)
+def build_fixture_conf(entity_path, entity, parent=None):
+    """Build the conf of entity as test_entity_to_vitessce_conf does, including the EPIC conf on top of
+    the base conf for segmentation masks, and return the builder class and the conf."""
+    hints = get_entity(entity["uuid"])["vitessce-hints"]
+    epic_uuid = entity["uuid"] if "epic" in hints and len(hints) > 1 else None
+    resolver = fixture_resolver(entity_path)
+    Builder = get_view_config_builder(entity, get_entity, parent, epic_uuid)
+    builder = Builder(entity, groups_token, assets_url, asset_resolver=resolver)
+    conf_cells = builder.get_conf_cells()
+    if epic_uuid is None:
+        return Builder, conf_cells.conf
+    epic_builder = get_epic_builder(epic_uuid)(
+        epic_uuid,
+        conf_cells,
+        entity,
+        groups_token,
+        assets_url,
+        builder.base_image_metadata,
+        asset_resolver=resolver,
+    )
+    return Builder, epic_builder.get_conf_cells().conf
+
+
+@pytest.mark.parametrize("entity_path", good_entity_paths, ids=lambda path: f"{path.parent.name}/{path.name}")
+@pytest.mark.requires_full
+def test_entity_fields_are_sufficient(entity_path, mocker):
+    mock_zarr_store(entity_path, mocker, 5)
+    entity = json.loads(entity_path.read_text())
+    projected = project_source(entity, get_entity_fields())
+    # Only used for image pyramids, and not part of the entity proper.
+    parent = entity.get("parent") or None
+
+    Builder, conf = build_fixture_conf(entity_path, entity, parent)
+    projected_builder, projected_conf = build_fixture_conf(entity_path, projected, parent)
+    assert projected_builder is Builder
+    assert projected_conf == conf
+
+
+@pytest.mark.requires_full
+def test_read_zip_zarr_opens_store(mocker, tmp_path):
+    zip_path = tmp_path / "fake.zarr.zip"
+    store = zarr.storage.ZipStore(str(zip_path), mode="w")
+    zarr.group(store)["obs/_index"] = zarr.array(["cell_0", "cell_1"])
+    store.close()
+
+    # Stand in for the HTTP filesystem with the local zip
+    mock_fs = mocker.Mock()
+    mock_fs.info.return_value = {"size": zip_path.stat().st_size}
+    mock_fs.cat_file.side_effect = lambda url, start, end: zip_path.read_bytes()[start:end]
+    mock_filesystem = mocker.patch("src.portal_visualization.assets.fsspec.filesystem", return_value=mock_fs)
 
     dummy_url = "https://example.com/fake.zarr.zip"
     request_init = {"headers": {"Authorization": "Bearer token"}}
 
     result = read_zip_zarr(dummy_url, request_init)
 
-    assert result == mock_zarr_obj
-    mock_fs.get_mapper.assert_called_once_with("")
+    assert list(result["obs/_index"][:]) == ["cell_0", "cell_1"]
+    client_kwargs = mock_filesystem.call_args.kwargs["client_kwargs"]
+    assert client_kwargs["headers"] == request_init["headers"]
+    assert client_kwargs["timeout"].sock_connect is not None
 
 
 @pytest.mark.parametrize("entity_path", good_entity_paths, ids=lambda path: f"{path.parent.name}/{path.name}")
@@ -273,7 +370,8 @@ def test_entity_to_vitessce_conf(entity_path, mocker):
     # epic_uuid = environ.get("EPIC_UUID", "epic_uuid")
     # Check if this is a minimal test case
     minimal = "minimal" in entity_path.name
-    builder = Builder(entity, groups_token, assets_url, minimal=minimal)
+    resolver = fixture_resolver(entity_path)
+    builder = Builder(entity, groups_token, assets_url, minimal=minimal, asset_resolver=resolver)
     conf, cells = builder.get_conf_cells(marker=marker)
 
     # Uncomment to generate a fixture
@@ -295,9 +393,22 @@ def test_entity_to_vitessce_conf(entity_path, mocker):
                     groups_token,
                     assets_url,
                     builder.base_image_metadata,  # type: ignore
+                    asset_resolver=resolver,
                 ).get_conf_cells()
             return
 
+        # Without the base builder's config object, it is rebuilt from the conf dict, to the same effect.
+        # (Vitessce's to_dict and from_dict share lists, so the overlays would interfere without a copy.)
+        rebuilt_epic_conf, _ = epic_builder(
+            epic_uuid,
+            ConfCells(deepcopy(conf), cells),
+            entity,
+            groups_token,
+            assets_url,
+            builder.base_image_metadata,  # type: ignore
+            asset_resolver=resolver,
+        ).get_conf_cells()
+
         built_epic_conf, cells = epic_builder(
             epic_uuid,
             ConfCells(conf, cells),
@@ -305,12 +416,178 @@ def test_entity_to_vitessce_conf(entity_path, mocker):
             groups_token,
             assets_url,
             builder.base_image_metadata,  # type: ignore
+            base_vitessce_config=builder.base_vitessce_config,  # type: ignore
+            asset_resolver=resolver,
         ).get_conf_cells()
         assert built_epic_conf is not None
+        assert built_epic_conf == rebuilt_epic_conf
 
         compare_confs(entity_path, built_epic_conf, cells)
 
 
+emitted_conf_builders = [
+    "RNASeqViewConfBuilder",
+    "ATACSeqViewConfBuilder",
+    "ImagePyramidViewConfBuilder",
+    "IMSViewConfBuilder",
+    "NanoDESIViewConfBuilder",
+]
+emitted_conf_paths = [path for path in good_entity_paths if path.parent.name in emitted_conf_builders]
+assert len(emitted_conf_paths) > 0
+
+
+@pytest.mark.parametrize("entity_path", emitted_conf_paths, ids=lambda path: f"{path.parent.name}/{path.name}")
+@pytest.mark.requires_full
+def test_emitted_conf_matches_fixture(entity_path, mocker):
+    # These builders emit their conf dicts directly: VitessceConfig is only used for the notebook cells,
+    # which are only made once they are read.
+    mocker.patch("src.portal_visualization.builders.imaging_builders.VitessceConfig", side_effect=AssertionError)
+    from_dict = mocker.spy(VitessceConfig, "from_dict")
+    entity = json.loads(entity_path.read_text())
+    Builder = get_view_config_builder(entity, get_entity, entity.get("parent"))
+    conf_cells = Builder(entity, groups_token, assets_url).get_conf_cells()
+    assert conf_cells.etag
+    assert not from_dict.called
+    conf, cells = conf_cells
+    assert from_dict.called
+    compare_confs(entity_path, conf, cells)
+
+
+plural_conf_paths = [
+    path
+    for path in good_entity_paths
+    if isinstance(json.loads(path.parent.joinpath(path.name.replace("-entity", "-conf")).read_text()), list)
+]
+assert len(plural_conf_paths) > 0
+
+
+@pytest.mark.parametrize("entity_path", plural_conf_paths, ids=lambda path: f"{path.parent.name}/{path.name}")
+@pytest.mark.requires_full
+def test_compact_confs_match_fixture(entity_path, mocker):
+    mock_zarr_store(entity_path, mocker, 5)
+    possible_marker = entity_path.name.split("-")[-2]
+    marker = possible_marker.split("=")[1] if possible_marker.startswith("marker=") else None
+    entity = json.loads(entity_path.read_text())
+    Builder = get_view_config_builder(entity, get_entity, entity.get("parent"))
+    conf_cells = Builder(entity, groups_token, assets_url, compact_confs=True).get_conf_cells(marker=marker)
+    expected_confs = json.loads(entity_path.parent.joinpath(entity_path.name.replace("-entity", "-conf")).read_text())
+
+    assert isinstance(conf_cells.conf, CompactConfList)
+    assert conf_cells.conf[:] == list(conf_cells.conf) == expected_confs
+    # Serialized like any list of confs, by either backend.
+    assert json.loads(conf_cells.conf_bytes) == json.loads(json.dumps(conf_cells.conf)) == expected_confs
+    compact = conf_cells.conf.compact()
+    assert [apply_patch(compact["base"], patch) for patch in compact["patches"]] == expected_confs
+    if len(expected_confs) > 1:
+        assert len(serialization.dumps(compact)) < len(conf_cells.conf_bytes)
+    assert repr(conf_cells.conf) == f"CompactConfList({list(conf_cells.conf)!r})"
+
+
+published_pair_paths = [
+    path
+    for path in good_entity_paths
+    if path.name.endswith("-qa-entity.json") and path.with_name(path.name.replace("-qa-", "-published-")).is_file()
+]
+assert len(published_pair_paths) > 0
+
+
+@pytest.mark.parametrize("qa_path", published_pair_paths, ids=lambda path: f"{path.parent.name}/{path.name}")
+@pytest.mark.requires_full
+def test_dependencies_patch_published_conf(qa_path, mocker):
+    mock_zarr_store(qa_path, mocker, 5)
+    qa_entity = json.loads(qa_path.read_text())
+    published_path = qa_path.with_name(qa_path.name.replace("-qa-", "-published-"))
+    published_entity = json.loads(published_path.read_text())
+    Builder = get_view_config_builder(qa_entity, get_entity)
+    builder = Builder(qa_entity, groups_token, assets_url)
+    qa_conf = builder.get_conf_cells().conf
+    deps = ConfDependencies.from_dict(json.loads(json.dumps(builder.dependencies.to_dict())))
+
+    assert deps.resources
+    assert all("?" not in url for url in deps.resources)
+    assert deps.decide(qa_entity, published_entity) == ("patch", ["status: QA -> Published"])
+    patched_conf = deps.patch(qa_conf, published_entity)
+    compare_confs(published_path, patched_conf, get_conf_cells(patched_conf).cells)
+
+    assert deps.decide(published_entity, qa_entity).action == "rebuild"
+    assert deps.decide(qa_entity, {**qa_entity, "status": "New"}).action == "valid"
+    assert deps.decide(qa_entity, {**qa_entity, "files": []}) == ("rebuild", ["files changed"])
+
+
+@pytest.mark.requires_full
+def test_dependencies_ignore_unused_files():
+    entity_path = next(path for path in good_entity_paths if path.parent.name == "ImagePyramidViewConfBuilder")
+    entity = json.loads(entity_path.read_text())
+    builder = get_view_config_builder(entity, get_entity, entity.get("parent"))(entity, groups_token, assets_url)
+    conf = builder.get_conf_cells().conf
+    deps = builder.dependencies
+
+    assert not deps.all_files
+    added_file = {**entity, "files": [*entity["files"], {"rel_path": "extras/new.txt"}]}
+    assert deps.decide(entity, added_file) == ("valid", [])
+    assert deps.patch(conf, added_file) is conf
+    added_image = {**entity, "files": [*entity["files"], {"rel_path": f"{IMAGE_PYRAMID_DIR}/new.ome.tif"}]}
+    assert deps.decide(entity, added_image).action == "rebuild"
+    assert deps.decide(entity, {**entity, "soft_assaytype": "other"}).reasons == ["soft_assaytype changed"]
+
+
+@pytest.mark.requires_full
+def test_dependencies_include_sub_builders():
+    entity_path = next(path for path in good_entity_paths if path.parent.name == "TiledSPRMViewConfBuilder")
+    entity = json.loads(entity_path.read_text())
+    builder = get_view_config_builder(entity, get_entity)(entity, groups_token, assets_url)
+    builder.get_conf_cells()
+    sub_builder_deps = ConfDependencies()
+    sub_builder_deps.record_field("parent")
+    builder.dependencies.update(sub_builder_deps)
+
+    assert builder.dependencies.all_files
+    assert builder.dependencies.fields[-1] == "parent"
+    # Reads through the resolver are recorded; everything else is passed through.
+    assert builder._resolver.open_zarr.__name__ == "recorded"
+    assert builder._resolver.responses is builder._resolver._resolver.responses
+
+
+@pytest.mark.requires_full
+def test_conf_bytes_are_encoded_once(mocker):
+    entity_path = emitted_conf_paths[0]
+    entity = json.loads(entity_path.read_text())
+    Builder = get_view_config_builder(entity, get_entity, entity.get("parent"))
+    conf_cells = Builder(entity, groups_token, assets_url).get_conf_cells()
+    dumps = mocker.spy(serialization, "dumps")
+
+    assert conf_cells.conf_bytes is conf_cells.conf_bytes
+    assert json.loads(conf_cells.conf_bytes) == conf_cells.conf
+    assert dumps.call_count == 1
+
+
+@pytest.mark.parametrize("builder_name", ["ImagePyramidViewConfBuilder", "TiledSPRMViewConfBuilder"])
+@pytest.mark.requires_full
+def test_same_entity_gives_same_etag(builder_name):
+    entity_path = next(path for path in good_entity_paths if path.parent.name == builder_name)
+    entity = json.loads(entity_path.read_text())
+    Builder = get_view_config_builder(entity, get_entity, entity.get("parent"))
+    first = Builder(entity, groups_token, assets_url).get_conf_cells()
+    # The same files in another order, as the search index may return them.
+    reordered = {**entity, "files": entity["files"][::-1]}
+    second = Builder(reordered, groups_token, assets_url).get_conf_cells()
+
+    assert first.etag == second.etag
+    assert first.cells == second.cells
+
+
+@pytest.mark.requires_full
+def test_etag_does_not_depend_on_backend(mocker):
+    # Floats and NaN, which orjson and json write differently, and an int key, which only json accepts by default.
+    conf = {"coordinationSpace": {"spatialZoom": {"A": 1e-7}}, "scale": 1e20, "missing": float("nan"), 1: "one"}
+    with_backend = ConfCells(conf, None)
+    assert json.loads(with_backend.conf_bytes)["1"] == "one"
+
+    mocker.patch.object(serialization, "orjson", None)
+    without_orjson = ConfCells(conf, None)
+    assert without_orjson.etag == with_backend.etag
+
+
 @pytest.mark.parametrize("entity_path", bad_entity_paths, ids=lambda path: path.name)
 @pytest.mark.requires_full
 def test_entity_to_error(entity_path, mocker):
@@ -476,6 +753,215 @@ def test_small_dataset_includes_heatmap(entity_path, mocker):
     assert "heatmap" in layout_str.lower(), "Heatmap should be present for small datasets"
 
 
+@pytest.mark.parametrize("entity_path", heatmap_test_paths, ids=lambda path: f"{path.parent.name}/{path.name}")
+@pytest.mark.parametrize(("budget_bytes", "has_heatmap"), [(2**30, True), (2**20, False)])
+@pytest.mark.requires_full
+def test_client_budget_decides_heatmap(entity_path, budget_bytes, has_heatmap, mocker):
+    """With a client budget, the estimated cost of the heatmap decides, not the number of observations."""
+    entity = json.loads(entity_path.read_text())
+    mock_zarr_store(entity_path, mocker, 5000)
+    z = zarr.open()  # The mocked store
+    # Chunked by rows, so the heatmap reads every chunk: 10 requests, 40 MB before compression.
+    z["X"] = zarr.zeros((5000, 2000), chunks=(500, 2000), dtype="f4")
+
+    Builder = get_view_config_builder(entity, get_entity)
+    builder = Builder(entity, groups_token, assets_url, client_budget=ClientBudget(bytes=budget_bytes, requests=100))
+    conf, _ = builder.get_conf_cells()
+
+    assert ("heatmap" in json.dumps(conf["layout"]).lower()) is has_heatmap
+    # The estimate is kept out of the conf, which stays a valid Vitessce conf.
+    assert "costEstimate" not in conf
+    estimate = builder.cost_estimate
+    # Zipped stores also need their central directory: two more requests, and an entry per chunk.
+    expected = (
+        {"bytes": 40_000_640, "requests": 12} if is_zip_entity(entity_path) else {"bytes": 40_000_000, "requests": 10}
+    )
+    assert estimate["views"] == {"heatmap": expected}
+    assert estimate["budget"] == {"bytes": budget_bytes, "requests": 100}
+    assert estimate["deferred"] == ([] if has_heatmap else ["heatmap"])
+
+
+@pytest.mark.requires_full
+def test_multiomic_cost_estimate_on_rebuild(mocker):
+    entity_path = Path("test/good-fixtures/MultiomicAnndataZarrViewConfBuilder/fake-multiome-is-annotated-entity.json")
+    entity = json.loads(entity_path.read_text())
+    mock_zarr_store(entity_path, mocker, 5)
+    zarr.open()["X"] = zarr.zeros((5, 20), chunks=(5, 20), dtype="f4")
+    Builder = get_view_config_builder(entity, get_entity)
+
+    # Without a client budget, nothing is estimated, so X is not read.
+    builder = Builder(entity, groups_token, assets_url)
+    builder.get_conf_cells()
+    assert builder.cost_estimate is None
+    assert "view_costs" not in builder.__dict__
+
+    builder = Builder(entity, groups_token, assets_url, client_budget=ClientBudget(bytes=2**20, requests=100))
+    builder.get_conf_cells()
+    first = builder.cost_estimate
+    assert first["views"] == {"heatmap": {"bytes": 400, "requests": 1}}
+    # Building again, in full or one clustering, gives the same estimate.
+    builder.get_conf_cells()
+    assert builder.cost_estimate == first
+    builder.get_clustering_conf_cells(builder.clusterings[0].label)
+    assert builder.cost_estimate == first
+    assert first["deferred"] == builder._deferred_views == []
+
+
+def write_strings(group, name, values):
+    # As AnnData writes them.
+    import numcodecs
+
+    group.array(name, values, dtype=object, object_codec=numcodecs.VLenUTF8())
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.requires_full
+def test_write_heatmap_subset(tmp_path, sparse):
+    import numpy as np
+    import scipy.sparse
+
+    z = zarr.open_group()
+    write_strings(z, "obs/_index", [f"cell_{i}" for i in range(100)])
+    # 80 cells in cluster 0, 20 in cluster 1.
+    z["obs/leiden/codes"] = zarr.array(np.repeat([0, 1], [80, 20]).astype("int8"))
+    write_strings(z, "obs/leiden/categories", ["0", "1"])
+    write_strings(z, "var/_index", ["gene_0", "gene_1", "gene_2"])
+    matrix = np.arange(300, dtype="float32").reshape(100, 3)
+    matrix[::2] = 0
+    if sparse:
+        csr = scipy.sparse.csr_matrix(matrix)
+        X = z.create_group("X")
+        X.attrs.update({"encoding-type": "csr_matrix", "shape": list(csr.shape)})
+        X["data"], X["indices"], X["indptr"] = csr.data, csr.indices, csr.indptr
+    else:
+        z["X"] = matrix
+
+    index = write_heatmap_subset(z, str(tmp_path / "subset.zarr"), max_cells=10)
+
+    subset = zarr.open_group(str(tmp_path / "subset.zarr"), mode="r")
+    assert len(index) == 10
+    assert subset["obs/source_index"][:].tolist() == index.tolist()
+    assert subset["obs/_index"][:].tolist() == [f"cell_{i}" for i in index]
+    assert np.bincount(subset["obs/leiden/codes"][:]).tolist() == [8, 2]
+    assert subset["obs/leiden/categories"][:].tolist() == ["0", "1"]
+    assert subset["var/_index"][:].tolist() == ["gene_0", "gene_1", "gene_2"]
+    if sparse:
+        X = subset["X"]
+        assert X.attrs["shape"] == [10, 3]
+        values = scipy.sparse.csr_matrix((X["data"][:], X["indices"][:], X["indptr"][:]), shape=(10, 3)).toarray()
+    else:
+        values = subset["X"][:]
+    assert values.tolist() == matrix[index].tolist()
+    assert subset.attrs["heatmap_subset"] == {"source_n_obs": 100, "groupby": "leiden", "seed": 0}
+
+
+@pytest.mark.requires_full
+def test_write_heatmap_subset_keeps_categories_whole(tmp_path):
+    import numpy as np
+
+    z = zarr.open_group()
+    write_strings(z, "obs/_index", [f"cell_{i}" for i in range(6)])
+    z["obs/leiden/codes"] = zarr.array(np.array([0, 0, 0, 1, 1, 1], dtype="int8"))
+    write_strings(z, "obs/leiden/categories", ["0", "1"])
+    # As many categories as cells, in the current and the older layout.
+    z["obs/cell_type/codes"] = zarr.array(np.arange(6, dtype="int8"))
+    write_strings(z, "obs/cell_type/categories", [f"type_{i}" for i in range(6)])
+    z["obs/batch"] = zarr.array(np.arange(6, dtype="int8")[::-1])
+    write_strings(z, "obs/__categories/batch", [f"batch_{i}" for i in range(6)])
+    z.create_group("var")
+    z["X"] = np.zeros((6, 1), dtype="float32")
+
+    index = write_heatmap_subset(z, str(tmp_path / "subset.zarr"), max_cells=4)
+
+    subset = zarr.open_group(str(tmp_path / "subset.zarr"), mode="r")
+    assert len(index) == 4
+    assert subset["obs/cell_type/codes"][:].tolist() == index.tolist()
+    assert subset["obs/cell_type/categories"][:].tolist() == [f"type_{i}" for i in range(6)]
+    assert subset["obs/batch"][:].tolist() == (5 - index).tolist()
+    assert subset["obs/__categories/batch"][:].tolist() == [f"batch_{i}" for i in range(6)]
+
+
+@pytest.mark.requires_full
+def test_write_heatmap_subset_needs_clusters():
+    z = zarr.open_group()
+    write_strings(z, "obs/_index", ["cell_0"])
+    with pytest.raises(ValueError, match="None of the obs columns"):
+        write_heatmap_subset(z, zarr.MemoryStore())
+    write_strings(z, "obs/leiden", ["0"])
+    z.create_group("X").attrs["encoding-type"] = "csc_matrix"
+    z.create_group("var")
+    with pytest.raises(ValueError, match="Only dense and CSR"):
+        write_heatmap_subset(z, zarr.MemoryStore())
+    with pytest.raises(ValueError, match="Cannot keep a cell"):
+        write_heatmap_subset({"obs": {"_index": zarr.zeros(3), "leiden": zarr.array([0, 1, 2])}}, None, max_cells=2)
+
+
+@pytest.mark.requires_full
+def test_large_dataset_uses_heatmap_subset(mocker):
+    entity_path = Path(
+        "test/good-fixtures/RNASeqAnnDataZarrViewConfBuilder/fake-is-not-annotated-published-entity.json"
+    )
+    entity = json.loads(entity_path.read_text())
+    entity["files"].append({"rel_path": f"{HEATMAP_SUBSET_ZARR_PATH}/.zgroup"})
+    mock_zarr_store(entity_path, mocker, 150000)
+
+    Builder = get_view_config_builder(entity, get_entity)
+    builder = Builder(entity, groups_token, assets_url)
+    conf, _ = builder.get_conf_cells()
+
+    (subset,) = (dataset for dataset in conf["datasets"] if dataset["name"].endswith("(subset)"))
+    assert subset["files"][0]["url"] == f"{assets_url}/{entity['uuid']}/{HEATMAP_SUBSET_ZARR_PATH}"
+    (heatmap,) = (view for view in conf["layout"] if view["component"] == "heatmap")
+    assert conf["coordinationSpace"]["dataset"][heatmap["coordinationScopes"]["dataset"]] == subset["uid"]
+
+    # Minimal confs have no heatmap, subset or not.
+    conf, _ = Builder(entity, groups_token, assets_url, minimal=True).get_conf_cells()
+    assert len(conf["datasets"]) == 1
+
+
+@pytest.mark.requires_full
+def test_multiomic_clustering_conf_on_demand(mocker):
+    entity_path = Path("test/good-fixtures/MultiomicAnndataZarrViewConfBuilder/fake-multiome-is-annotated-entity.json")
+    entity = json.loads(entity_path.read_text())
+    mock_zarr_store(entity_path, mocker, 5)
+    expected_confs = json.loads(entity_path.with_name("fake-multiome-is-annotated-conf.json").read_text())
+
+    Builder = get_view_config_builder(entity, get_entity)
+    builder = Builder(entity, groups_token, assets_url)
+    labels = [clustering.label for clustering in builder.clusterings]
+    assert labels == [conf["name"] for conf in expected_confs]
+
+    # Any one clustering's conf, built alone, is the same as in the full list.
+    conf, cells = builder.get_clustering_conf_cells(labels[-1])
+    assert conf == expected_confs[-1]
+    assert len(cells) == 2
+    with pytest.raises(KeyError, match="no clustering 'Missing'"):
+        builder.get_clustering_conf_cells("Missing")
+    assert builder.get_conf_cells().conf == expected_confs
+
+
+@pytest.mark.requires_full
+def test_obs_columns_probed_in_one_batch(mocker):
+    entity_path = Path(
+        "test/good-fixtures/MultiomicAnndataZarrViewConfBuilder/fake-multiome-is-annotated-pan-az-entity.json"
+    )
+    entity = json.loads(entity_path.read_text())
+    mock_zarr_store(entity_path, mocker, 5)
+    getitems = mocker.spy(zarr.storage.MemoryStore, "getitems")
+
+    Builder = get_view_config_builder(entity, get_entity)
+    Builder(entity, groups_token, assets_url).get_conf_cells()
+
+    # Chunks are read in batches too; the only batch of metadata keys is the check for obs columns.
+    metadata_batches = [
+        call.args[1]
+        for call in getitems.call_args_list
+        if all(key.endswith((".zarray", ".zgroup")) for key in call.args[1])
+    ]
+    assert len(metadata_batches) == 1
+    assert "mod/rna/obs/azimuth_fine/.zgroup" in metadata_batches[0]
+
+
 @pytest.mark.requires_full
 def test_xenium_large_dataset_hides_heatmap(mocker):
     """Test that Xenium datasets with >100k observations hide heatmap views.
@@ -523,6 +1009,54 @@ def test_xenium_large_dataset_hides_heatmap(mocker):
     assert "spatial" in layout_str.lower(), "Spatial view should still be present"
 
 
+@pytest.mark.requires_full
+def test_image_pyramid_pages():
+    files = [{"rel_path": f"{IMAGE_PYRAMID_DIR}/image_{i:02}.ome.tif"} for i in range(25)]
+    entity = {"uuid": "uuid", "status": "Published", "files": files}
+    builder = ImagePyramidViewConfBuilder(entity, groups_token, assets_url, image_page_size=10)
+
+    conf, _ = builder.get_conf_cells(page=2)
+    images = conf["datasets"][0]["files"][0]["options"]["images"]
+    assert [image["name"] for image in images] == [f"image_{i}.ome.tif" for i in range(20, 25)]
+    # The index of pages is kept out of the conf, which stays a valid Vitessce conf.
+    assert set(conf) == {"version", "name", "description", "datasets", "coordinationSpace", "layout", "initStrategy"}
+    assert builder.image_page_index["page"] == 2
+    assert builder.image_page_index["pages"] == builder.image_pages()
+    assert [len(page) for page in builder.image_pages()] == [10, 10, 5]
+    with pytest.raises(ValueError, match="no page 3"):
+        builder.get_conf_cells(page=3)
+
+    # Without a page size, every image is on the one page, and there is no index.
+    builder = ImagePyramidViewConfBuilder(entity, groups_token, assets_url)
+    conf, _ = builder.get_conf_cells()
+    assert len(conf["datasets"][0]["files"][0]["options"]["images"]) == 25
+    assert builder.image_page_index is None
+
+    # Segmentation views show only the first image, so they have one page whatever the page size.
+    files = [{"rel_path": f"{IMAGE_PYRAMID_DIR}/lab_processed/image_{i:02}.ome.tif"} for i in range(25)]
+    seg_entity = {**entity, "files": files}
+    builder = KaggleSegImagePyramidViewConfBuilder(seg_entity, groups_token, assets_url, image_page_size=10)
+    assert builder.image_pages() == [["image_00.ome.tif"]]
+    with pytest.raises(ValueError, match="no page 1"):
+        builder.get_conf_cells(page=1)
+
+
+@pytest.mark.requires_full
+def test_seqfish_positions_grouped_in_order():
+    files = [{"rel_path": f"ometiff-pyramids/HybCycle_{c}/MMStack_Pos{p}.ome.tif"} for p in range(12) for c in range(3)]
+    entity = {"uuid": "uuid", "status": "Published", "files": files}
+
+    confs, cells = SeqFISHViewConfBuilder(entity, groups_token, assets_url).get_conf_cells()
+    reordered = {**entity, "files": files[::-1]}
+    reordered_confs, reordered_cells = SeqFISHViewConfBuilder(reordered, groups_token, assets_url).get_conf_cells()
+
+    assert reordered_confs == confs
+    assert reordered_cells == cells
+    assert [conf["name"] for conf in confs] == sorted(f"MMStack_Pos{p}" for p in range(12))
+    names = [image["name"] for image in confs[0]["datasets"][0]["files"][0]["options"]["images"]]
+    assert names == ["HybCycle_0", "HybCycle_1", "HybCycle_2"]
+
+
 if __name__ == "__main__":  # pragma: no cover
     parser = argparse.ArgumentParser(description="Generate fixtures")
     parser.add_argument("--input", required=True, type=Path, help="Input JSON path")
@@ -3,10 +3,13 @@ import json
 import pytest
 
 try:
+    import requests
     from flask import Flask
+    from werkzeug.exceptions import GatewayTimeout, ServiceUnavailable
 
     from portal_visualization.builders.base_builders import ConfCells
-    from src.portal_visualization.client import ApiClient, _create_vitessce_error
+    from src.portal_visualization.client import ApiClient, _create_vitessce_error, _handle_request
+    from src.portal_visualization.policy import configure_policy, snapshot
 
     FULL_DEPS_AVAILABLE = True
 except ImportError:
@@ -67,6 +70,7 @@ def mock_get_s3_json_file(path, **kwargs):
             self.status_code = 200
             self.content = json.dumps(mock_es)
             self.text = json.dumps(mock_es)
+            self.headers = {}
 
         def raise_for_status(self):
             pass
@@ -85,6 +89,35 @@ def test_s3_redirect(mocker):
     assert response == mock_es
 
 
+def test_handle_request_circuit_breaker(app, mocker):
+    mock_get = mocker.patch("requests.get", side_effect=requests.exceptions.ConnectionError)
+    configure_policy("flaky.example.com", retries=1, failure_threshold=2, sleep=lambda seconds: None)
+    with app.app_context():
+        with pytest.raises(requests.exceptions.ConnectionError):
+            _handle_request(b"https://flaky.example.com/file.json")
+        assert mock_get.call_count == 2
+        assert mock_get.call_args.kwargs["timeout"] == (3.05, 30.0)
+        # Retries of a single call count once against the breaker.
+        assert snapshot()["flaky.example.com"]["breaker"]["state"] == "closed"
+
+        with pytest.raises(requests.exceptions.ConnectionError):
+            _handle_request("https://flaky.example.com/file.json")
+        assert mock_get.call_count == 4
+        assert snapshot()["flaky.example.com"]["breaker"]["state"] == "open"
+
+        # Now fails fast, without calling the endpoint.
+        with pytest.raises(ServiceUnavailable):
+            _handle_request("https://flaky.example.com/file.json")
+        assert mock_get.call_count == 4
+
+
+def test_handle_request_read_timeout(app, mocker):
+    mocker.patch("requests.get", side_effect=requests.exceptions.ReadTimeout)
+    configure_policy("slow.example.com", retries=0)
+    with app.app_context(), pytest.raises(GatewayTimeout):
+        _handle_request("https://slow.example.com/file.json")
+
+
 def mock_es_post(path, **kwargs):
     class MockResponse:
         def __init__(self):
@@ -196,6 +229,49 @@ def test_get_entities(app, mocker, plural_lc_entity_type):
         assert json.dumps(entities, indent=2) == json.dumps([flattened_hit_source], indent=2)
 
 
+def test_get_entities_columnar(app, mocker):
+    mocker.patch("requests.post", side_effect=mock_es_post)
+    with app.app_context():
+        api_client = ApiClient()
+        entities = api_client.get_entities("donors", columnar=True)
+    assert entities == {key: [value] for key, value in flattened_hit_source.items()}
+
+
+def test_get_entities_columnar_incomplete(app, mocker):
+    mocker.patch("requests.post", side_effect=mock_es_post_more_than_10k)
+    with app.app_context():
+        api_client = ApiClient()
+        with pytest.raises(Exception, match="Incomplete results"):
+            api_client.get_entities("donors", columnar=True)
+
+
+def test_get_entities_streams_s3_redirect(app, mocker):
+    body = json.dumps({"took": 5, "_shards": {"total": 1}, **mock_es}, indent=2).encode()
+
+    def mock_get_s3_stream(path, stream=False, **kwargs):
+        assert stream
+        response = mocker.Mock(status_code=200)
+        response.iter_content.side_effect = lambda chunk_size: (body[i : i + 7] for i in range(0, len(body), 7))
+        return response
+
+    mocker.patch("requests.post", side_effect=mock_post_303)
+    mocker.patch("requests.get", side_effect=mock_get_s3_stream)
+    with app.app_context():
+        api_client = ApiClient()
+        entities = api_client.get_entities("donors")
+    assert entities == [flattened_hit_source]
+
+
+def test_iter_entities_yields_before_checking_total(app, mocker):
+    mocker.patch("requests.post", side_effect=mock_es_post_more_than_10k)
+    with app.app_context():
+        api_client = ApiClient()
+        entities = api_client.iter_entities("donors")
+        assert next(entities) == flattened_hit_source
+        with pytest.raises(Exception, match="Incomplete results"):
+            list(entities)
+
+
 def test_get_entities_more_than_10k(app, mocker):
     mocker.patch("requests.post", side_effect=mock_es_post_more_than_10k)
     with app.app_context():
@@ -214,6 +290,14 @@ def test_get_entity(app, mocker, params):
         assert json.dumps(entity, indent=2) == json.dumps(mock_hit_source, indent=2)
 
 
+def test_get_entity_fields(app, mocker):
+    mock_post = mocker.patch("requests.post", side_effect=mock_es_post)
+    with app.app_context():
+        api_client = ApiClient()
+        api_client.get_entity(uuid="uuid", fields=["uuid", "files.rel_path"])
+    assert mock_post.call_args.kwargs["json"]["_source"] == ["uuid", "files.rel_path"]
+
+
 def test_get_entity_two_ids(app, mocker):
     with app.app_context():
         api_client = ApiClient()
@@ -344,6 +428,17 @@ def test_get_vitessce_conf_cells_and_lifted_uuid(
         assert vitessce_conf.vis_lifted_uuid == expected_vis_lifted_uuid
 
 
+def test_get_vitessce_conf_cells_and_lifted_uuid_projects_descendant(app, mocker):
+    mock_post = mocker.patch("requests.post", side_effect=mock_es_post_no_hits)
+    with app.app_context():
+        api_client = ApiClient()
+        api_client.get_vitessce_conf_cells_and_lifted_uuid({"uuid": "12345"})
+    fields = mock_post.call_args.kwargs["json"]["_source"]
+    assert {"uuid", "status", "soft_assaytype", "vitessce-hints", "files.rel_path", "visualization"} <= set(fields)
+    assert "metadata.files.rel_path" in fields
+    assert "files" not in fields
+
+
 @pytest.mark.parametrize("groups_token", [None, "token"])
 def test_get_publication_ancillary_json(app, mocker, groups_token):
     mocker.patch("requests.post", side_effect=mock_es_post)
@@ -355,6 +450,31 @@ def test_get_publication_ancillary_json(app, mocker, groups_token):
         assert result.vis_lifted_uuid == "ABC123"
 
 
+def test_get_publication_ancillary_json_revalidates(app, mocker):
+    requests_made = []
+
+    def mock_get_with_etag(path, headers=None, **kwargs):
+        requests_made.append(headers)
+        response = requests.models.Response()
+        if headers.get("If-None-Match") == '"v1"':
+            response.status_code = 304
+            response._content = b""
+        else:
+            response.status_code = 200
+            response.headers["ETag"] = '"v1"'
+            response._content = json.dumps({"publication": "ancillary"}).encode()
+        return response
+
+    mocker.patch("requests.post", side_effect=mock_es_post)
+    mocker.patch("requests.get", side_effect=mock_get_with_etag)
+    with app.app_context():
+        api_client = ApiClient(groups_token="token", assets_endpoint="https://assets.example.com/revalidate")
+        results = [api_client.get_publication_ancillary_json({"uuid": "ABC123"}) for _ in range(2)]
+    assert [result.publication_json for result in results] == [{"publication": "ancillary"}] * 2
+    assert "If-None-Match" not in requests_made[0]
+    assert requests_made[1]["If-None-Match"] == '"v1"'
+
+
 def test_get_metadata_descriptions(app, mocker):
     mocker.patch("requests.get", side_effect=mock_get_s3_json_file)
     with app.app_context():
@@ -0,0 +1,214 @@
+import json
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+try:
+    import zarr
+    from flask import Flask
+
+    from src.portal_visualization.caching import LRUCache
+    from src.portal_visualization.client import ApiClient
+    from src.portal_visualization.prewarm import ConfPrewarmer, WarmConf, cache_key
+
+    FULL_DEPS_AVAILABLE = True
+except ImportError:
+    FULL_DEPS_AVAILABLE = False
+    # Skip entire module during collection if full dependencies not available
+    pytest.skip("requires [full] optional dependencies", allow_module_level=True)
+
+# Mark all tests in this file as requiring [full] dependencies
+pytestmark = pytest.mark.requires_full
+
+fixtures_path = Path(__file__).parent / "good-fixtures" / "RNASeqAnnDataZarrViewConfBuilder"
+published_entity = json.loads((fixtures_path / "fake-is-not-annotated-published-entity.json").read_text())
+published_conf = json.loads((fixtures_path / "fake-is-not-annotated-published-conf.json").read_text())
+
+datasets = {
+    published_entity["uuid"]: {**published_entity, "last_modified_timestamp": 300},
+    # No files, so there is no conf to build.
+    "no-files": {"uuid": "no-files", "status": "QA", "vitessce-hints": [], "last_modified_timestamp": 200},
+    # Modified before the cutoff used below.
+    "older": {"uuid": "older", "status": "Published", "vitessce-hints": [], "last_modified_timestamp": 50},
+}
+
+
+def selected(key, fields):
+    # Nested fields like "files.rel_path" select the whole top-level value, which is close enough here.
+    return fields is None or any(field == key or field.startswith(f"{key}.") for field in fields)
+
+
+class SearchHandler(SimpleHTTPRequestHandler):
+    """Stands in for the search API: answers the few queries the prewarmer makes,
+    and records them."""
+
+    searches = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.searches.append(query)
+        bool_query = query["query"].get("bool", {})
+        if "ids" in query["query"]:
+            sources = [datasets[uuid] for uuid in query["query"]["ids"]["values"] if uuid in datasets]
+        elif "filter" in bool_query:
+            since = bool_query["filter"][1]["range"]["last_modified_timestamp"]["gt"]
+            after = query.get("search_after", [since, ""])
+            sources = sorted(
+                (
+                    source
+                    for source in datasets.values()
+                    if source["last_modified_timestamp"] > since
+                    and (source["last_modified_timestamp"], source["uuid"]) > tuple(after)
+                ),
+                key=lambda source: (source["last_modified_timestamp"], source["uuid"]),
+            )[: query["size"]]
+        else:
+            # No image pyramids to lift.
+            sources = []
+        hits = [
+            {
+                "_id": source["uuid"],
+                "_source": {key: value for key, value in source.items() if selected(key, query.get("_source"))},
+                "sort": [source["last_modified_timestamp"], source["uuid"]],
+            }
+            for source in sources
+        ]
+        body = json.dumps({"hits": {"total": {"value": len(hits)}, "hits": hits}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AssetsHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+@pytest.fixture
+def servers(tmp_path):
+    zarr_path = tmp_path / published_entity["uuid"] / "hubmap_ui/anndata-zarr/secondary_analysis.zarr"
+    group = zarr.open_group(str(zarr_path), mode="w")
+    group["obs/_index"] = zarr.array([str(i) for i in range(5)])
+    SearchHandler.searches = []
+    search_server, search_url = serve(SearchHandler)
+    assets_server, assets_url = serve(partial(AssetsHandler, directory=str(tmp_path)))
+    yield search_url, assets_url
+    search_server.shutdown()
+    assets_server.shutdown()
+
+
+@pytest.fixture
+def app():
+    return Flask("test")
+
+
+def test_get_modified_datasets_pages(app, servers):
+    search_url, _ = servers
+    client = ApiClient(elasticsearch_endpoint=search_url, portal_index_path="/search")
+    with app.app_context():
+        modified = list(client.get_modified_datasets(100, page_size=1))
+
+    assert [dataset["uuid"] for dataset in modified] == ["no-files", published_entity["uuid"]]
+    assert set(modified[0]) == {"uuid", "status", "last_modified_timestamp"}
+    # One page per dataset, and an empty page to finish.
+    assert [search.get("search_after") for search in SearchHandler.searches] == [
+        None,
+        [200, "no-files"],
+        [300, published_entity["uuid"]],
+    ]
+
+
+def test_prewarm_builds_confs_into_cache(app, servers):
+    search_url, assets_url = servers
+    client = ApiClient(elasticsearch_endpoint=search_url, portal_index_path="/search", assets_endpoint=assets_url)
+    cache = LRUCache()
+    prewarmer = ConfPrewarmer(client, cache, max_workers=2, requests_per_second=1000)
+    with app.app_context():
+        progress = prewarmer.run_since(100)
+
+    assert progress["total"] == 2
+    assert progress["built"] == 2
+    assert progress["pending"] == progress["failed"] == 0
+    assert progress["latest_timestamp"] == 300
+    # The AnnData builder opened one zarr store, through the limiter.
+    assert progress["rate_limiter"]["acquired"] == 1
+    # The prewarmer's copy of the client is limited, not the original.
+    assert client.asset_resolver is None
+    # Everything but reads is passed through to the default resolver.
+    assert prewarmer._client.asset_resolver.blocks is not None
+
+    warm = cache.get(cache_key(published_entity["uuid"]))
+    assert warm.last_modified_timestamp == 300
+    expected_conf = json.loads(json.dumps(published_conf).replace("https://example.com", assets_url))
+    assert json.dumps(warm.vitessce_conf.conf, sort_keys=True) == json.dumps(expected_conf, sort_keys=True)
+    assert cache.get(cache_key("no-files")).vitessce_conf.conf is None
+
+    # Nothing has changed since, so nothing is rebuilt.
+    with app.app_context():
+        progress = prewarmer.run_since(100)
+    assert (progress["built"], progress["skipped"]) == (0, 2)
+
+
+def test_prewarm_orders_and_counts_failures(app, servers):
+    search_url, _ = servers
+    client = ApiClient(elasticsearch_endpoint=search_url, portal_index_path="/search")
+    cache = LRUCache()
+    cache.set(cache_key("older"), WarmConf(0, None, None))
+    prewarmer = ConfPrewarmer(client, cache, popularity={"older": 10}, max_workers=1)
+    with app.app_context():
+        progress = prewarmer.run(["no-files", {"uuid": "older", "status": "Published"}, "missing"])
+
+    searched = [search["query"]["ids"]["values"][0] for search in SearchHandler.searches if "ids" in search["query"]]
+    assert searched == ["older", "no-files", "missing"]
+    assert progress["built"] == 2
+    assert list(prewarmer.failures) == ["missing"]
+    assert prewarmer.failures["missing"].startswith("NotFound: 404")
+    assert progress["rate_limiter"] is None
+
+
+def test_prewarm_retries_failures_and_keys_by_token(app, servers, mocker):
+    search_url, assets_url = servers
+    client = ApiClient(
+        groups_token="groups_token",
+        elasticsearch_endpoint=search_url,
+        portal_index_path="/search",
+        assets_endpoint=assets_url,
+    )
+    build = ApiClient.get_vitessce_conf_cells_and_lifted_uuid
+
+    def fail_published(self, entity, **kwargs):
+        if entity["uuid"] == published_entity["uuid"]:
+            raise ConnectionError("assets server is down")
+        return build(self, entity, **kwargs)
+
+    cache = LRUCache()
+    prewarmer = ConfPrewarmer(client, cache, max_workers=1)
+    patched = mocker.patch.object(ApiClient, "get_vitessce_conf_cells_and_lifted_uuid", fail_published)
+    with app.app_context():
+        progress = prewarmer.run_since(100)
+        mocker.stop(patched)
+        assert (progress["built"], progress["failed"]) == (1, 1)
+        # The failure, at 300, is after the latest built, at 200.
+        assert progress["latest_timestamp"] == 200
+
+        progress = prewarmer.run_since(progress["latest_timestamp"])
+    # Only the failure is tried again.
+    assert (progress["total"], progress["built"], progress["failed"]) == (1, 1, 0)
+    assert progress["latest_timestamp"] == 300
+    # Built with the client's token, so only cached for that token.
+    assert cache.get(cache_key(published_entity["uuid"])) is None
+    assert cache.get(cache_key(published_entity["uuid"], "groups_token")).last_modified_timestamp == 300